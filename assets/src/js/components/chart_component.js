@@ -1,9 +1,10 @@
 (function () {
   grice.ColumnPicker = {
-    controller: function (columns, selected, name) {
+    controller: function (columns, selected, name, onSelect) {
       this.columns = columns;
       this.selected = selected;
       this.name = name;
+      this.onSelect = onSelect;
       this.onChange = function (value) {
         var items = value.split('.');
         var tableName = items[0];
@@ -18,6 +19,10 @@
           this.selected(null);
         }
 
+        if (this.onSelect) {
+          this.onSelect();
+        }
+
         return value;
       }.bind(this);
     },
@@ -56,9 +61,9 @@
       });
 
       return m('div.chart-controls', [
-        m(grice.ColumnPicker, c.model.columns, c.model.x, 'x-axis'),
-        m(grice.ColumnPicker, yColumns, c.model.y, 'y-axis'),
-        m(grice.ColumnPicker, colorColumns, c.model.color, 'color')
+        m(grice.ColumnPicker, c.model.columns, c.model.x, 'x-axis', c.model.load),
+        m(grice.ColumnPicker, yColumns, c.model.y, 'y-axis', c.model.load),
+        m(grice.ColumnPicker, colorColumns, c.model.color, 'color', c.model.load)
       ]);
     }
   };
@@ -109,17 +114,10 @@
   grice.createChartComponent = function (model) {
     return {
       controller: function () {
-        var me = this;
-        this.loading = m.prop(true);
         this.model = model;
 
         var loadData = function () {
-          m.request({
-            url: grice.generateTableQueryUrl(model.table.name, null, -1, model.queryParams)
-          }).then(function (data) {
-            me.loading(false);
-            model.rows(data.rows);
-          });
+          model.load();
         };
 
         // TODO: I don't like this hack.
@@ -21,12 +21,14 @@
   };
 
   grice.PaginationComponent = {
-    controller: function (table, rows, page, perPage, queryParams) {
+    controller: function (table, rows, page, perPage, queryParams, nextAfter, count) {
       this.table = table;
       this.rows = rows;
       this.page = page;
       this.perPage = perPage;
       this.queryParams = queryParams;
+      this.nextAfter = nextAfter;
+      this.count = count;
     },
     view: function (c) {
       var nextUrl = grice.generateTableUrl(c.table.name, c.page + 1, c.perPage, c.queryParams);
@@ -40,15 +42,28 @@
         prevEl = m('a', {href: prevUrl}, '<');
       }
 
+      if (c.nextAfter) {
+        // Seek past the last row of this page instead of using an offset, so deep pages stay fast.
+        nextUrl += (nextUrl.indexOf('?') > -1 ? '&' : '?') + 'after=' + encodeURIComponent(c.nextAfter);
+      }
+
       if (c.rows.length < c.perPage) {
         nextEl = '>';
       } else {
         nextEl = m('a', {href: nextUrl}, '>');
       }
 
+      var pageText = 'Page ' + c.page;
+      var count = c.count();
+
+      if (count !== null && c.perPage > 0) {
+        // Counts on big tables are estimated by the database.
+        pageText += ' of ' + (count.exact ? '' : '~') + Math.max(1, Math.ceil(count.count / c.perPage));
+      }
+
       return m('div.pagination', [
           m('div.previous', prevEl),
-          m('div.page', 'Page ' + c.page),
+          m('div.page', pageText),
           m('div.next', nextEl)
       ]);
     }
@@ -324,7 +339,17 @@
       this.rows = grice._rows;
       this.page = grice._page;
       this.perPage = grice._perPage;
+      this.nextAfter = grice._nextAfter;
       this.queryParams = grice.parseQueryParams();
+      this.count = m.prop(null);
+
+      m.request({
+        url: grice.generateTableCountUrl(this.table.name, this.queryParams),
+        background: true
+      }).then(function (data) {
+        this.count(data);
+        m.redraw();
+      }.bind(this));
       this.showChart = function (column) {
         window.location = grice.generateChartUrl(this.table.name, column, this.queryParams);
       }.bind(this);
@@ -332,9 +357,9 @@
     view: function (c) {
       return m('div.db-table', [
         m('h3.table-name', c.table.name),
-        m(grice.PaginationComponent, c.table, c.rows, c.page, c.perPage, c.queryParams),
+        m(grice.PaginationComponent, c.table, c.rows, c.page, c.perPage, c.queryParams, c.nextAfter, c.count),
         m(grice.TableDataComponent, c.table, c.columns, c.rows, c.queryParams, c.showChart),
-        m(grice.PaginationComponent, c.table, c.rows, c.page, c.perPage, c.queryParams)
+        m(grice.PaginationComponent, c.table, c.rows, c.page, c.perPage, c.queryParams, c.nextAfter, c.count)
       ]);
     }
   };
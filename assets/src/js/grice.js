@@ -57,41 +57,6 @@ grice = (function () {
     return 0;
   };
 
-  grice.convertScatterPlotData = function (data, xGetter, yGetter) {
-    var xMin = null, xMax = null, yMin = null, yMax = null;
-
-    data = data.filter(function(datum) {
-      var x = xGetter(datum);
-      var y = yGetter(datum);
-      var xValid = grice.isValid(x);
-      var yValid = grice.isValid(y);
-
-      if (xValid) {
-        if (xMin == null || x < xMin) {
-          xMin = x;
-        }
-
-        if (xMax == null || x > xMax) {
-          xMax = x;
-        }
-      }
-
-      if (yValid) {
-        if (yMin == null || y < yMin) {
-          yMin = y;
-        }
-
-        if (yMax == null || y > yMax) {
-          yMax = y;
-        }
-      }
-
-      return xValid && yValid;
-    });
-
-    return {data: data, xDomain: [xMin, xMax], yDomain: [yMin, yMax]};
-  };
-
   grice.findColumn = function (columns, columnName) {
     if (columnName) {
       return columns.find(function (column) {
@@ -102,123 +67,6 @@ grice = (function () {
     return null;
   };
 
-  var whiskerBottom = function (rows, boxBottom, iqr) {
-    var i, value;
-
-    for (i = 0; i < rows.length; i++) {
-      value =  rows[i];
-
-      if (value >= (boxBottom - iqr)) {
-        return value;
-      }
-    }
-  };
-
-  var whiskerTop = function (rows, boxTop, iqr) {
-    var i, value;
-
-    for (i = rows.length - 1; i >= 0; i--) {
-      value = rows[i];
-
-      if (value <= (boxTop + iqr)) {
-        return value;
-      }
-    }
-  };
-
-  grice.boxPlotStats = function(rows, name) {
-    /**
-     * Box:
-     *  The bottom is the first quartile
-     *  The middle is the median
-     *  The top is the third quartile
-     *
-     * Whiskers:
-     *  Bottom: the lowest datum still within 1.5 IQR of the first quartile
-     *  Top: the highest datum still within 1.5 IQR of the second quartile
-     */
-
-    var boxBottom = d3.quantile(rows, .25);
-    var boxMiddle = d3.quantile(rows, .5);
-    var boxTop = d3.quantile(rows, .75);
-    var iqr = 1.5 * (boxTop - boxBottom);
-
-    return {
-      name: name,
-      box: {
-        bottom: boxBottom,
-        middle: boxMiddle,
-        top: boxTop
-      },
-      whiskers: {
-        bottom: whiskerBottom(rows, boxBottom, iqr),
-        top: whiskerTop(rows, boxTop, iqr)
-      }
-    };
-  };
-
-  grice.groupData = function (rows, getGroup, getValue) {
-    /**
-     * Groups data based on the getGroup value of each row.
-     */
-    var groupedData = {};
-
-    rows.forEach(function (row) {
-      var group = getGroup(row);
-      var value = getValue(row);
-
-      if (!(group in groupedData)) {
-        groupedData[group] = [];
-      }
-
-      groupedData[group].push(value);
-    });
-
-    return groupedData;
-  };
-
-  grice.convertBoxPlotData = function (table, rows, getGroup, getValue) {
-    /**
-     * Filters groups rows if needed, then converts each group to box plot stats. Assumes rows are sorted.
-     */
-    var groupedRows;
-    var data = {
-      rows: [],
-      min: null,
-      max: null
-    };
-
-    rows = rows.filter(function (row) {
-      var value = getValue(row);
-      var isValid = grice.isValid(value);
-
-      if (isValid) {
-        if (data.min == null || value < data.min) {
-          data.min = value;
-        }
-
-        if (data.max == null || value > data.max) {
-          data.max = value;
-        }
-      }
-
-      return isValid;
-    }).sort(function (a, b) {
-      return grice.sortData(getValue(a), getValue(b));
-    });
-
-    if (getGroup) {
-      groupedRows = grice.groupData(rows, getGroup, getValue);
-      data.rows = Object.keys(groupedRows).map(function (group) {
-        return grice.boxPlotStats(groupedRows[group], group);
-      });
-    } else {
-      data.rows = [grice.boxPlotStats(rows.map(getValue), table.name)];
-    }
-
-    return data;
-  };
-
   grice.changeHandler = function (attr, scope) {
     return function (value) {
       return scope[attr](value);
@@ -288,17 +136,12 @@ grice = (function () {
   };
 
   var parseJoin = function (params, type, value) {
-    // Format: table_name,from_col:to_col;from_col:to_col
-    if (params.join === null) {
-      params.join = value;
-    }
-  };
-
-  var parseOuterJoin = function (params, type, value) {
-    // Format: table_name,from_col:to_col;from_col:to_col
-    if (params.outerjoin === null) {
-      params.outerjoin = value;
-    }
+    // Format: table_name,from_col:to_col;from_col:to_col or just table_name to join on the foreign keys. Joins are
+    // applied in order, so we keep join and outerjoin params in the same list.
+    params.joins.push({
+      type: type,
+      value: value
+    });
   };
 
   var parseColumns = function (params, type, value) {
@@ -317,13 +160,14 @@ grice = (function () {
     filter: parseFilter,
     sort: parseSort,
     join: parseJoin,
-    outerjoin: parseOuterJoin,
+    outerjoin: parseJoin,
     cols: parseColumns,
     x: parseColumn,
     y: parseColumn,
     color: parseColumn,
     page: noop,
-    perPage: noop
+    perPage: noop,
+    after: noop
   };
 
   var parseParam = function (param, params) {
@@ -350,8 +194,7 @@ grice = (function () {
     return {
       filters: {},
       sorts: [],
-      join: null,
-      outerjoin: null,
+      joins: [],
       columns: null,
       x: null,
       y: null,
@@ -379,14 +222,11 @@ grice = (function () {
       separator = '&';
     }
 
-    if (queryParams.join) {
-      url += separator + 'join=' + queryParams.join;
-      separator = '&';
-    }
-
-    if (queryParams.outerjoin) {
-      url += separator + 'outerjoin=' + queryParams.outerjoin;
-      separator = '&';
+    if (queryParams.joins) {
+      queryParams.joins.forEach(function (join) {
+        url += separator + join.type + '=' + join.value;
+        separator = '&';
+      });
     }
 
     if (queryParams.columns) {
@@ -429,6 +269,30 @@ grice = (function () {
     return baseUrl + queryString;
   };
 
+  grice.generateTableCountUrl = function (tableName, queryParams) {
+    return '/api/db/tables/' + tableName + '/count' + grice.generateTableQueryString(null, null, queryParams);
+  };
+
+  grice.generateChartDataUrl = function (tableName, type, x, y, color, queryParams) {
+    var baseUrl = '/api/db/tables/' + tableName + '/chart';
+    var queryString = grice.generateTableQueryString(null, null, queryParams);
+    var params = {type: type, x: x, y: y, color: color};
+
+    Object.keys(params).forEach(function (name) {
+      var value = params[name];
+
+      if (value) {
+        if (typeof value !== 'string') {
+          value = value.table + '.' + value.name;
+        }
+
+        queryString += (queryString.length ? '&' : '?') + name + '=' + value;
+      }
+    });
+
+    return baseUrl + queryString;
+  };
+
   grice.generateChartUrl = function (tableName, column, queryParams) {
     var baseUrl = '/db/tables/' + tableName + '/chart';
     var queryString = grice.generateTableQueryString(null, null, queryParams);
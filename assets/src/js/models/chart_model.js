@@ -21,7 +21,8 @@
     this.yGetter = null;
     this._color = m.prop(null);
     this.colorGetter = null;
-    this.rows = m.prop([]);
+    this.chartData = m.prop(null);
+    this.loading = m.prop(false);
 
     this.x = function (column) {
       if (arguments.length == 0) {
@@ -96,19 +97,54 @@
       }
     }.bind(this);
 
+    this.load = function () {
+      /**
+       * Fetches the chart data for the current chart type. Box plot stats and scatter plot downsampling are computed
+       * by the server, so the response size depends on the number of groups and not on the number of rows.
+       */
+      var type = this.type();
+      var url;
+
+      if (type == grice.CHART_TYPES.BOX) {
+        url = grice.generateChartDataUrl(this.table.name, 'box', this.x(), this.y(), null, this.queryParams);
+      } else if (type == grice.CHART_TYPES.SCATTER) {
+        url = grice.generateChartDataUrl(this.table.name, 'scatter', this.x(), this.y(), this.color(),
+          this.queryParams);
+      } else {
+        this.chartData(null);
+        return;
+      }
+
+      this.loading(true);
+
+      return m.request({url: url}).then(function (data) {
+        this.loading(false);
+        this.chartData(data);
+      }.bind(this));
+    }.bind(this);
+
     this.data = function () {
       var type = this.type();
-      var rows = this.rows();
+      var chartData = this.chartData();
+
+      if (chartData === null || chartData.type != type.toLowerCase()) {
+        // The data for the current chart type has not loaded yet.
+        chartData = null;
+      }
 
       if (type == grice.CHART_TYPES.BOX) {
-        return grice.convertBoxPlotData(this.table, rows, this.xGetter, this.yGetter);
+        return chartData ? chartData : {rows: [], min: null, max: null};
       }
 
       if (type == grice.CHART_TYPES.SCATTER) {
-        return grice.convertScatterPlotData(rows, this.xGetter, this.yGetter)
+        if (chartData) {
+          return {data: chartData.points, xDomain: chartData.xDomain, yDomain: chartData.yDomain};
+        }
+
+        return {data: [], xDomain: [null, null], yDomain: [null, null]};
       }
 
-      return rows;
+      return [];
     }.bind(this);
   };
 })();
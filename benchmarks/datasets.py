@@ -0,0 +1,121 @@
+import datetime
+import logging
+import random
+
+from sqlalchemy import MetaData, Table, Column, Integer, Float, String, DateTime, ForeignKey
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+FACT_TABLE = 'bench_facts'
+DIMENSION_TABLE = 'bench_groups'
+CATEGORIES = ['alpha', 'beta', 'gamma', 'delta', 'epsilon']
+RESULTS = ['pass', 'fail', 'skip']
+INSERT_BATCH_SIZE = 5000
+# Every extra column cycles through these types.
+EXTRA_COLUMN_TYPES = [Integer, Float, String(32)]
+START_TIME = datetime.datetime(2017, 1, 1)
+
+
+def extra_column_names(width: int):
+    return ['extra_{}'.format(idx) for idx in range(width)]
+
+
+def define_tables(meta: MetaData, width: int):
+    """
+    Defines the benchmark tables: a fact table with a foreign key to a small dimension table, so joins can be inferred,
+    and width extra columns to make scans wider.
+
+    :return: fact table, dimension table
+    """
+    groups = Table(DIMENSION_TABLE, meta,
+                   Column('id', Integer, primary_key=True),
+                   Column('name', String(32), nullable=False),
+                   Column('region', String(32), nullable=False))
+    columns = [
+        Column('id', Integer, primary_key=True),
+        Column('group_id', Integer, ForeignKey(DIMENSION_TABLE + '.id'), nullable=False),
+        Column('category', String(16), nullable=False),
+        Column('result', String(8), nullable=False),
+        Column('score', Integer, nullable=False),
+        Column('total_time', Float),
+        Column('start_time', DateTime, nullable=False),
+    ]
+
+    for idx, name in enumerate(extra_column_names(width)):
+        columns.append(Column(name, EXTRA_COLUMN_TYPES[idx % len(EXTRA_COLUMN_TYPES)]))
+
+    facts = Table(FACT_TABLE, meta, *columns)
+
+    return facts, groups
+
+
+def _extra_value(rnd: random.Random, idx: int):
+    column_type = EXTRA_COLUMN_TYPES[idx % len(EXTRA_COLUMN_TYPES)]
+
+    if column_type is Integer:
+        return rnd.randint(0, 1000000)
+
+    if column_type is Float:
+        return rnd.random() * 1000
+
+    return 'value-{}'.format(rnd.randint(0, 10000))
+
+
+def generate_rows(rows: int, width: int, group_count: int, seed: int):
+    """
+    Generates the fact table rows. The same arguments always generate the same rows.
+    """
+    rnd = random.Random(seed)
+
+    for row_id in range(rows):
+        row = {
+            'id': row_id,
+            'group_id': rnd.randrange(group_count),
+            'category': rnd.choice(CATEGORIES),
+            'result': rnd.choice(RESULTS),
+            'score': rnd.randint(0, 100),
+            'total_time': rnd.gauss(10, 3) if rnd.random() > 0.05 else None,
+            'start_time': START_TIME + datetime.timedelta(seconds=rnd.randint(0, 365 * 24 * 3600)),
+        }
+
+        for idx, name in enumerate(extra_column_names(width)):
+            row[name] = _extra_value(rnd, idx)
+
+        yield row
+
+
+def create_dataset(db_engine, rows: int, width: int, group_count: int = 100, seed: int = 1):  # pylint: disable=too-many-arguments
+    """
+    Drops and recreates the benchmark tables and fills them with synthetic data.
+
+    :param db_engine: SQLAlchemy engine of the benchmark database.
+    :param rows: The number of rows in the fact table.
+    :param width: The number of extra columns in the fact table.
+    :param group_count: The number of rows in the dimension table.
+    :param seed: The random seed, so runs with the same arguments query the same data.
+    """
+    meta = MetaData()
+    facts, groups = define_tables(meta, width)
+    meta.drop_all(db_engine)
+    meta.create_all(db_engine)
+
+    with db_engine.begin() as conn:
+        conn.execute(groups.insert(), [{'id': idx, 'name': 'group-{}'.format(idx), 'region': CATEGORIES[idx % 5]}
+                                       for idx in range(group_count)])
+        batch = []
+
+        for row in generate_rows(rows, width, group_count, seed):
+            batch.append(row)
+
+            if len(batch) == INSERT_BATCH_SIZE:
+                conn.execute(facts.insert(), batch)
+                batch = []
+
+        if batch:
+            conn.execute(facts.insert(), batch)
+
+    if db_engine.dialect.name == 'postgresql':
+        with db_engine.connect() as conn:
+            conn.execution_options(isolation_level='AUTOCOMMIT').execute('ANALYZE')
+
+    log.info('Created %s with %s rows and %s extra columns', FACT_TABLE, rows, width)
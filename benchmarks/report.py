@@ -0,0 +1,122 @@
+import json
+import math
+import platform
+
+import sqlalchemy
+
+# Results that got slower by more than this fraction are regressions.
+DEFAULT_THRESHOLD = 0.1
+
+
+def percentile(values: list, fraction: float):
+    """
+    Returns the nearest-rank percentile of a list of values.
+    """
+    if not values:
+        return None
+
+    ordered = sorted(values)
+    rank = max(int(math.ceil(fraction * len(ordered))), 1)
+
+    return ordered[rank - 1]
+
+
+def summarize(latencies: list, stages: list, rows: int, response_bytes: int, peak_memory: int):
+    """
+    Summarizes the iterations of one workload.
+
+    :param latencies: The duration of each iteration in seconds.
+    :param stages: The stage timings of each iteration, dicts of stage name -> milliseconds.
+    :param rows: The number of rows one iteration returns, None if unknown.
+    :param response_bytes: The size of the response of one iteration, None if there is no response.
+    :param peak_memory: The peak memory allocated during one iteration, in bytes.
+    :return: dict
+    """
+    total = sum(latencies)
+    stage_names = []
+
+    for stage_ms in stages:
+        stage_names.extend(name for name in stage_ms if name not in stage_names)
+
+    return {
+        'iterations': len(latencies),
+        'rows': rows,
+        'bytes': response_bytes,
+        'ops_per_second': round(len(latencies) / total, 2) if total else None,
+        'rows_per_second': round(rows * len(latencies) / total) if total and rows is not None else None,
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'peak_memory_kb': round(peak_memory / 1024, 1),
+        'stages_p50_ms': {name: round(percentile([s.get(name, 0.0) for s in stages], 0.5), 3) for name in stage_names},
+    }
+
+
+def environment(db_engine, rows: int, width: int):
+    return {
+        'dialect': db_engine.dialect.name,
+        'rows': rows,
+        'width': width,
+        'python': platform.python_version(),
+        'sqlalchemy': sqlalchemy.__version__,
+        'machine': platform.machine(),
+    }
+
+
+def save(path: str, env: dict, results: dict):
+    with open(path, 'w') as results_file:
+        json.dump({'environment': env, 'results': results}, results_file, indent=2, sort_keys=True)
+
+
+def load(path: str):
+    with open(path) as results_file:
+        return json.load(results_file)
+
+
+def compare(results: dict, baseline: dict, threshold: float = DEFAULT_THRESHOLD):
+    """
+    Compares results with a baseline saved by a previous run.
+
+    :param results: dict of result name -> summary.
+    :param baseline: The contents of a saved results file.
+    :param threshold: The fraction by which p50 latency may grow before it counts as a regression.
+    :return: list of (name, baseline p50 ms, p50 ms, change, is_regression) tuples, for the results in both.
+    """
+    comparisons = []
+
+    for name, summary in sorted(results.items()):
+        previous = baseline['results'].get(name, None)
+
+        if previous is None or not previous['p50_ms']:
+            continue
+
+        change = summary['p50_ms'] / previous['p50_ms'] - 1
+        comparisons.append((name, previous['p50_ms'], summary['p50_ms'], change, change > threshold))
+
+    return comparisons
+
+
+def _or_dash(value):
+    return '-' if value is None else value
+
+
+def format_results(results: dict):
+    row_format = '{:<28} {:>8} {:>10} {:>10} {:>10} {:>10} {:>12}  {}'
+    lines = [row_format.format('workload', 'rows', 'bytes', 'ops/s', 'p50 ms', 'p99 ms', 'peak KiB', 'stage p50 ms')]
+
+    for name, summary in sorted(results.items()):
+        stages = ', '.join('{}={}'.format(stage, ms) for stage, ms in summary['stages_p50_ms'].items())
+        lines.append(row_format.format(name, _or_dash(summary['rows']), _or_dash(summary['bytes']),
+                                       summary['ops_per_second'], summary['p50_ms'], summary['p99_ms'],
+                                       summary['peak_memory_kb'], stages))
+
+    return '\n'.join(lines)
+
+
+def format_comparison(comparisons: list):
+    lines = ['{:<28} {:>12} {:>10} {:>8}'.format('workload', 'baseline ms', 'p50 ms', 'change')]
+
+    for name, previous, current, change, regression in comparisons:
+        lines.append('{:<28} {:>12} {:>10} {:>+7.1%}{}'.format(name, previous, current, change,
+                                                                ' REGRESSION' if regression else ''))
+
+    return '\n'.join(lines)
@@ -0,0 +1,71 @@
+import json
+from collections import namedtuple
+
+from grice import keyset
+from benchmarks.datasets import FACT_TABLE, DIMENSION_TABLE
+
+# kind is "query" (DBService.query_table and the query API) or "export" (DBService.stream_batches and the CSV export
+# route). args is the query string, body an optional JSON body, which makes the request a POST.
+Workload = namedtuple('Workload', ['name', 'description', 'kind', 'args', 'body'])
+
+NESTED_FILTER = {
+    'AND': [
+        [FACT_TABLE + '.score', 'gt', 20],
+        {
+            'OR': [
+                ['category', 'eq', 'alpha'],
+                ['category', 'eq', 'beta'],
+                {'AND': [['result', 'eq', 'fail'], ['total_time', 'lt', 8]]},
+            ]
+        },
+    ]
+}
+
+
+def get_workloads(rows: int):
+    """
+    Returns the benchmark workloads for a fact table with the given number of rows.
+
+    :param rows: The number of rows in the fact table, deep pagination starts half way through it.
+    :return: list of Workload
+    """
+    per_page = 100
+    deep_page = max(rows // per_page // 2, 1)
+    after = keyset.encode_token([FACT_TABLE + '.id'], [rows // 2])
+
+    return [
+        Workload('wide_scan', 'First 1000 rows with every column', 'query', 'perPage=1000', None),
+        Workload('deep_offset', 'A page half way through the table with OFFSET', 'query',
+                 'perPage={}&page={}'.format(per_page, deep_page), None),
+        Workload('deep_keyset', 'The same page with an "after" token', 'query',
+                 'perPage={}&after={}'.format(per_page, after), None),
+        Workload('nested_filters', 'Nested AND/OR filter tree from a JSON body', 'query', '',
+                 {'filter': NESTED_FILTER, 'perPage': per_page}),
+        Workload('join', 'Inferred join to the dimension table, filtered on a joined column', 'query',
+                 'join={0}&cols=id,score,{0}.name&filter={0}.region,eq,alpha&perPage={1}'.format(DIMENSION_TABLE,
+                                                                                                  per_page), None),
+        Workload('group_by', 'Aggregates grouped on two columns', 'query',
+                 'cols=category,result,count:id,avg:total_time,max:score&group_by=category&group_by=result', None),
+        Workload('export_all', 'Every row of four columns, perPage=-1', 'query',
+                 'perPage=-1&cols=id,category,score,total_time', None),
+        Workload('export_csv', 'Every row of four columns, streamed as CSV', 'export',
+                 'perPage=-1&cols=id,category,score,total_time', None),
+    ]
+
+
+def request_kwargs(workload: Workload):
+    """
+    Returns the path and keyword arguments for a Flask test client (or test request context) request.
+    """
+    if workload.kind == 'export':
+        path = '/api/db/tables/{}/export.csv'.format(FACT_TABLE)
+    else:
+        path = '/api/db/tables/{}/query'.format(FACT_TABLE)
+
+    if workload.args:
+        path += '?' + workload.args
+
+    if workload.body is None:
+        return path, {'method': 'GET'}
+
+    return path, {'method': 'POST', 'data': json.dumps(workload.body), 'content_type': 'application/json'}
@@ -0,0 +1,158 @@
+"""
+Query admission control.
+
+Before a table query or export runs it is EXPLAINed, and the planner's estimates decide whether it runs:
+
+- queries estimated to cost more than max_query_cost, or to return more than max_query_rows rows, are rejected with an
+  error asking to narrow the query down.
+- queries estimated to cost more than expensive_query_cost wait until fewer than max_expensive_queries expensive queries
+  are running, so a few big queries can't take all of the database. A query that can't start within admission_timeout
+  seconds is rejected, and can be retried later.
+
+Costs are in the planner's own units (see EXPLAIN in the PostgreSQL docs), thresholds are best picked by EXPLAINing
+typical queries. Estimates are only available on PostgreSQL, on other databases every query is admitted.
+"""
+import logging
+import threading
+from contextlib import contextmanager
+
+from grice import row_counts, timing
+from grice.errors import ConfigurationError, QueryRejectedError
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+DEFAULT_MAX_EXPENSIVE_QUERIES = 2
+DEFAULT_ADMISSION_TIMEOUT = 30
+
+
+class AdmissionController:
+    def __init__(self, max_cost: float = 0, max_rows: int = 0, expensive_cost: float = 0,
+                 max_expensive: int = DEFAULT_MAX_EXPENSIVE_QUERIES, timeout: float = DEFAULT_ADMISSION_TIMEOUT):  # pylint: disable=too-many-arguments
+        """
+        Decides which queries run, see the module docstring. Every threshold can be 0 to disable it.
+
+        :param max_cost: The estimated cost above which queries are rejected.
+        :param max_rows: The estimated number of rows above which queries are rejected.
+        :param expensive_cost: The estimated cost above which queries wait for a slot.
+        :param max_expensive: The number of expensive queries that may run at the same time.
+        :param timeout: Seconds an expensive query waits for a slot before it is rejected.
+        """
+        self.max_cost = max_cost
+        self.max_rows = max_rows
+        self.expensive_cost = expensive_cost
+        self.max_expensive = max_expensive
+        self.timeout = timeout
+        self.rejected = 0
+        self.queued = 0
+        self.running = 0
+        self._slots = threading.BoundedSemaphore(max_expensive)
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.max_cost or self.max_rows or self.expensive_cost)
+
+    def _reject(self, message: str, retry: bool = False):
+        with self._lock:
+            self.rejected += 1
+
+        timing.annotate(rejected=True)
+
+        raise QueryRejectedError(message, retry)
+
+    def check(self, conn, statement, params: dict):
+        """
+        EXPLAINs a statement and rejects it if its estimates exceed max_query_cost or max_query_rows.
+
+        :param conn: SQLAlchemy connection to EXPLAIN the statement on.
+        :param statement: The compiled statement.
+        :param params: The parameters the statement will be executed with.
+        :return: The estimated cost of the statement, to pass to slot(), or None if admission control is disabled.
+        :raises QueryRejectedError: If the statement is too expensive to run.
+        """
+        if not self.enabled or statement is None:
+            return None
+
+        with timing.stage('explain'):
+            cost, rows = row_counts.explain_estimate(conn, statement, params)
+
+        timing.annotate(estimated_cost=cost, estimated_rows=rows)
+
+        if self.max_cost and cost > self.max_cost:
+            self._reject('The query is too expensive to run, its estimated cost of {:.0f} is over the limit of {:g}. Add '
+                         'filters or use pagination to narrow it down.'.format(cost, self.max_cost))
+
+        if self.max_rows and rows > self.max_rows:
+            self._reject('The query would return about {} rows, more than the limit of {}. Add filters or use '
+                         'pagination to narrow it down.'.format(rows, self.max_rows))
+
+        return cost
+
+    @contextmanager
+    def slot(self, cost: float):
+        """
+        Waits until the query can run: right away, unless its cost makes it an expensive query and max_expensive_queries
+        expensive queries are already running. The slot is held until the context exits.
+
+        :param cost: The estimated cost returned by check, can be None.
+        :raises QueryRejectedError: If no slot freed up within admission_timeout seconds.
+        """
+        if cost is None or not self.expensive_cost or cost <= self.expensive_cost:
+            yield
+            return
+
+        with self._lock:
+            self.queued += 1
+
+        with timing.stage('queue'):
+            acquired = self._slots.acquire(timeout=self.timeout)
+
+        with self._lock:
+            self.queued -= 1
+
+        if not acquired:
+            self._reject('Too many expensive queries are running, try again later.', retry=True)
+
+        with self._lock:
+            self.running += 1
+
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.running -= 1
+
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'rejected': self.rejected,
+                'queued': self.queued,
+                'running': self.running,
+            }
+
+
+def init_admission(db_config, dialect_name: str):
+    """
+    Creates the AdmissionController for the thresholds in the [database] config section.
+
+    :param db_config: The [database] config section.
+    :param dialect_name: The name of the database dialect, admission control is disabled if it has no estimates.
+    :return: AdmissionController
+    """
+    controller = AdmissionController(db_config.getfloat('max_query_cost', 0),
+                                     db_config.getint('max_query_rows', 0),
+                                     db_config.getfloat('expensive_query_cost', 0),
+                                     db_config.getint('max_expensive_queries', DEFAULT_MAX_EXPENSIVE_QUERIES),
+                                     db_config.getfloat('admission_timeout', DEFAULT_ADMISSION_TIMEOUT))
+
+    if controller.max_expensive < 1:
+        raise ConfigurationError('max_expensive_queries must be at least 1')
+
+    if controller.enabled and dialect_name not in row_counts.ESTIMATE_DIALECTS:
+        log.warning('Query admission control needs query plan estimates, which %s does not provide. Every query is '
+                    'admitted.', dialect_name)
+        return AdmissionController()
+
+    return controller
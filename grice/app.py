@@ -4,6 +4,7 @@ from grice.db_controller import DBController
 from grice.db_service import DBService
 from grice.column_encoder import ColumnEncoder
 from grice.errors import ConfigurationError
+from grice import jobs, replicas, result_spool, rollups
 from flask import Flask, send_from_directory, render_template
 
 
@@ -45,8 +46,15 @@ class App:
         if use_waitress:
             self._init_waitress(config['server'])
         self._init_flask_app()
-        self._db_service = DBService(config['database'])
-        self._db_controller = DBController(self.flask_app, self._db_service)
+        cache_config = config['cache'] if config.has_section('cache') else None
+        rollup_configs = [config[name] for name in config.sections() if name.startswith(rollups.SECTION_PREFIX)]
+        replica_configs = [config[name] for name in config.sections() if name.startswith(replicas.SECTION_PREFIX)]
+        self._db_service = DBService(config['database'], cache_config, rollup_configs, replica_configs)
+        job_config = config['jobs'] if config.has_section('jobs') else None
+        self._job_manager = jobs.init_jobs(self._db_service, job_config, ColumnEncoder)
+        spool_config = config['spool'] if config.has_section('spool') else None
+        self._spool_manager = result_spool.init_spools(self._db_service, spool_config)
+        self._db_controller = DBController(self.flask_app, self._db_service, self._job_manager, self._spool_manager)
 
     def _init_setup(self, server_config):
         self.debug = server_config.getboolean('debug', False)
@@ -60,6 +68,8 @@ class App:
         self.host = server_config.get('host', '0.0.0.0')
         self.port = server_config.getint('port', 8080)
         self.threads = server_config.getint('threads', 8)
+        # Lets waitress (2.0 and newer) notice clients that disconnect while their query runs, so it can be cancelled.
+        self.request_lookahead = server_config.getint('channel_request_lookahead', 0)
 
     def _init_flask_app(self):
         self.flask_app = Flask('grice')
@@ -72,4 +82,9 @@ class App:
     def serve(self):
         from waitress import serve
         self.flask_app.logger.info('Starting server...')
-        serve(self.flask_app, host=self.host, port=self.port, threads=self.threads)
+        options = {}
+
+        if self.request_lookahead:
+            options['channel_request_lookahead'] = self.request_lookahead
+
+        serve(self.flask_app, host=self.host, port=self.port, threads=self.threads, **options)
@@ -0,0 +1,211 @@
+import json
+import logging
+
+from sqlalchemy.sql import sqltypes
+
+from grice.db_service import column_label
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None  # pylint: disable=invalid-name
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+EXPORT_FORMATS = ['arrow', 'parquet']
+EXPORT_MIMETYPES = {
+    'arrow': 'application/vnd.apache.arrow.stream',
+    'parquet': 'application/vnd.apache.parquet'
+}
+EXPORT_EXTENSIONS = {
+    'arrow': 'arrows',
+    'parquet': 'parquet'
+}
+MAX_DECIMAL_PRECISION = 38
+
+
+def _to_float(value):
+    return None if value is None else float(value)
+
+
+def _to_string(value):
+    return None if value is None else str(value)
+
+
+def _to_bytes(value):
+    return None if value is None else bytes(value)
+
+
+def _to_json(value):
+    return None if value is None else json.dumps(value, default=str)
+
+
+def arrow_type(column_type):
+    """
+    Maps a SQLAlchemy column type to an Arrow type.
+
+    :param column_type: SQLAlchemy type instance.
+    :return: Arrow type, and a function that converts values before they are handed to Arrow (or None).
+    """
+    # Order matters: Float is a Numeric, BigInteger and SmallInteger are Integers, Text and Enum are Strings.
+    if isinstance(column_type, sqltypes.Boolean):
+        return pyarrow.bool_(), None
+
+    if isinstance(column_type, sqltypes.SmallInteger):
+        return pyarrow.int16(), None
+
+    if isinstance(column_type, sqltypes.Integer):
+        return pyarrow.int64(), None
+
+    if isinstance(column_type, sqltypes.Float):
+        return pyarrow.float64(), _to_float
+
+    if isinstance(column_type, sqltypes.Numeric):
+        precision, scale = column_type.precision, column_type.scale
+
+        if column_type.asdecimal and precision is not None and scale is not None and \
+                0 < precision <= MAX_DECIMAL_PRECISION:
+            return pyarrow.decimal128(precision, scale), None
+
+        return pyarrow.float64(), _to_float
+
+    if isinstance(column_type, sqltypes.DateTime):
+        return pyarrow.timestamp('us', tz='UTC' if column_type.timezone else None), None
+
+    if isinstance(column_type, sqltypes.Date):
+        return pyarrow.date32(), None
+
+    if isinstance(column_type, sqltypes.Time):
+        return pyarrow.time64('us'), None
+
+    if isinstance(column_type, sqltypes.Interval):
+        return pyarrow.duration('us'), None
+
+    if isinstance(column_type, sqltypes._Binary):  # pylint: disable=protected-access
+        return pyarrow.binary(), _to_bytes
+
+    if isinstance(column_type, sqltypes.String):
+        return pyarrow.string(), None
+
+    if isinstance(column_type, sqltypes.JSON):
+        return pyarrow.string(), _to_json
+
+    # UUIDs, arrays, and anything else we can't map are exported as text.
+    return pyarrow.string(), _to_string
+
+
+class RecordBatchBuilder:
+    """
+    Converts batches of result rows to Arrow record batches. The schema comes from the SQLAlchemy column types. Computed
+    columns can report a type that doesn't match their values (e.g. avg of an Integer column), so if the first batch
+    can't be converted to a column's declared type, the type Arrow infers from that batch is used instead.
+    """
+    def __init__(self, columns: list):
+        self.names = [column_label(column) for column in columns]
+        self.fields = [arrow_type(column.type) for column in columns]
+        self.schema = None
+
+    def _array(self, idx: int, values: list):
+        arrow_column_type, converter = self.fields[idx]
+
+        if converter is not None:
+            values = [converter(value) for value in values]
+
+        try:
+            return pyarrow.array(values, type=arrow_column_type)
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError, TypeError, OverflowError):
+            if self.schema is not None:
+                raise
+
+        array = pyarrow.array(values)
+        log.debug('Exporting column %s as %s instead of %s', self.names[idx], array.type, arrow_column_type)
+        self.fields[idx] = (array.type, converter)
+
+        return array
+
+    def build(self, rows: list):
+        """
+        :param rows: list of rows, each one a sequence of values in column order.
+        :return: pyarrow.RecordBatch
+        """
+        values = list(zip(*rows)) if rows else [[] for _ in self.names]
+        arrays = [self._array(idx, list(column_values)) for idx, column_values in enumerate(values)]
+
+        if self.schema is None:
+            self.schema = pyarrow.schema([pyarrow.field(name, array.type) for name, array in zip(self.names, arrays)])
+
+        return pyarrow.RecordBatch.from_arrays(arrays, schema=self.schema)
+
+
+class _ChunkSink:
+    """
+    A write-only file object that keeps what is written to it until it is drained, so the output of an Arrow writer
+    can be sent to the client as it is produced.
+    """
+    closed = False
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _open_writer(export_format: str, sink, schema):
+    if export_format == 'parquet':
+        return pyarrow.parquet.ParquetWriter(sink, schema)
+
+    return pyarrow.ipc.new_stream(sink, schema)
+
+
+def export_batches(batches, columns: list, export_format: str):
+    """
+    Generates an Arrow IPC stream or a Parquet file from batches of result rows. Every batch of rows becomes one
+    record batch (a row group for Parquet) and is sent as soon as it is written, so memory use is bounded by the batch
+    size.
+
+    :param batches: iterable of lists of rows, as returned by DBService.stream_batches.
+    :param columns: The SQLAlchemy columns of the rows.
+    :param export_format: "arrow" or "parquet".
+    :return: generator of bytes.
+    """
+    builder = RecordBatchBuilder(columns)
+    sink = _ChunkSink()
+    writer = None
+
+    for rows in batches:
+        if not rows:
+            continue
+
+        record_batch = builder.build(rows)
+
+        if writer is None:
+            writer = _open_writer(export_format, sink, builder.schema)
+
+        if export_format == 'parquet':
+            writer.write_table(pyarrow.Table.from_batches([record_batch]))
+        else:
+            writer.write_batch(record_batch)
+
+        yield sink.drain()
+
+    if writer is None:
+        builder.build([])
+        writer = _open_writer(export_format, sink, builder.schema)
+
+    writer.close()
+    yield sink.drain()
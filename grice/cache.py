@@ -0,0 +1,376 @@
+import hashlib
+import logging
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from grice.errors import ConfigurationError
+
+try:
+    import redis
+except ImportError:
+    redis = None  # pylint: disable=invalid-name
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+CACHE_BACKENDS = ['memory', 'redis']
+DEFAULT_TTL = 60
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_MAX_ROWS = 10000
+DEFAULT_STATEMENT_CACHE_SIZE = 500
+
+
+def _column_key(column_name, table_name: str):
+    """
+    Converts a ColumnFunction (or column name string) to a tuple with the table name filled in.
+    """
+    if isinstance(column_name, str):
+        return table_name, column_name
+
+    return (column_name.table_name or table_name, column_name.column_name, column_name.func_name,
+            column_name.operator_name, column_name.operator_value)
+
+
+def query_cache_key(table_name: str, quargs, schema_version: int = 0) -> str:
+    """
+    Creates a cache key from a table name and QueryArguments. Equivalent queries produce the same key: column names
+    are qualified with the main table name, and the filter tree is rendered deterministically with the children of
+    each AND/OR sorted.
+
+    :param table_name: The name of the table being queried.
+    :param quargs: QueryArguments
+    :param schema_version: The DBService.schema_version the query runs with, so results for tables that changed since
+    are not used.
+    :return: str
+    """
+    joins = tuple((join.table_name, tuple(join.column_pairs), join.outer_join) for join in quargs.joins or [])
+    canonical = (
+        tuple(_column_key(c, table_name) for c in quargs.column_names or []),
+        quargs.page,
+        quargs.per_page,
+        quargs.filters.cache_key(table_name) if quargs.filters is not None else None,
+        tuple((s.table_name or table_name, s.column_name, s.direction) for s in quargs.sorts or []),
+        joins,
+        tuple(_column_key(g, table_name) for g in quargs.group_by or []),
+        bool(quargs.format_as_list),
+        quargs.after,
+        schema_version,
+    )
+    digest = hashlib.sha1(repr(canonical).encode('utf-8')).hexdigest()
+
+    return '{}:{}'.format(table_name, digest)
+
+
+class MemoryCache:
+    """
+    A thread safe, in-process LRU cache with per entry expiration.
+    """
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key, None)
+
+            if entry is None:
+                return None
+
+            expires, value = entry
+
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+
+            return value
+
+    def set(self, key: str, value, ttl: int):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisCache:
+    """
+    A cache backed by Redis, so results can be shared between threads, processes and servers. Any client with redis-py's
+    get, set(ex=), and scan_iter methods can be used, which makes it easy to swap in a local stand-in.
+    """
+    def __init__(self, client, prefix: str = 'grice:'):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key: str):
+        data = self.client.get(self.prefix + key)
+
+        if data is None:
+            return None
+
+        return pickle.loads(data)
+
+    def set(self, key: str, value, ttl: int):
+        self.client.set(self.prefix + key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), ex=ttl)
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + '*'):
+            self.client.delete(key)
+
+
+class StatementCache:
+    """
+    A thread safe LRU cache of compiled statements keyed on query shape, with hit/miss counters. A max_size of 0
+    disables caching.
+    """
+    def __init__(self, max_size: int = DEFAULT_STATEMENT_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, shape):
+        with self._lock:
+            entry = self._entries.get(shape, None)
+
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(shape)
+
+            return entry
+
+    def set(self, shape, entry):
+        if self.max_size <= 0:
+            return
+
+        with self._lock:
+            self._entries[shape] = entry
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            hits, misses, size = self.hits, self.misses, len(self._entries)
+
+        total = hits + misses
+
+        return {
+            'hits': hits,
+            'misses': misses,
+            'size': size,
+            'hit_ratio': hits / total if total else 0.0
+        }
+
+
+class _Call:  # pylint: disable=too-few-public-methods
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Deduplicates concurrent calls: while a call for a key runs, other calls with the same key wait for it and share its
+    result, or its exception, instead of running again. Nothing is kept once the call returns, so unlike a cache this
+    never returns stale results.
+    """
+    def __init__(self, retry_errors: tuple = ()):
+        """
+        :param retry_errors: Exception types that are not shared: callers waiting on a call that raised one of them make
+        the call again.
+        """
+        self.retry_errors = retry_errors
+        self.executions = 0
+        self.coalesced = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        """
+        Calls fn, unless a call with the same key is already running, in which case its result is returned.
+
+        :param key: Hashable key, calls with equal keys must return equal results.
+        :param fn: Function without arguments.
+        :return: result, shared. shared is True if the result came from a call made by another thread.
+        """
+        while True:
+            with self._lock:
+                call = self._calls.get(key, None)
+                leader = call is None
+
+                if leader:
+                    call = _Call()
+                    self._calls[key] = call
+                    self.executions += 1
+                else:
+                    self.coalesced += 1
+
+            if leader:
+                break
+
+            call.done.wait()
+
+            if isinstance(call.error, self.retry_errors):
+                continue
+
+            if call.error is not None:
+                raise call.error
+
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+            call.done.set()
+
+        return call.result, False
+
+    def stats(self):
+        with self._lock:
+            executions, coalesced, in_flight = self.executions, self.coalesced, len(self._calls)
+
+        return {
+            'executions': executions,
+            'coalesced': coalesced,
+            'in_flight': in_flight,
+        }
+
+
+class QueryCache:
+    """
+    Caches query results keyed on the normalized QueryArguments, with a default TTL that can be overridden per table.
+    """
+    def __init__(self, backend, ttl: int = DEFAULT_TTL, table_ttls: dict = None, max_rows: int = DEFAULT_MAX_ROWS):
+        self.backend = backend
+        self.ttl = ttl
+        self.table_ttls = table_ttls or {}
+        self.max_rows = max_rows
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get_ttl(self, table_name: str):
+        return self.table_ttls.get(table_name, self.ttl)
+
+    def get(self, table_name: str, quargs, schema_version: int = 0):
+        """
+        Returns the cached value for a query, or None if it is not cached.
+        """
+        if self.get_ttl(table_name) <= 0:
+            return None
+
+        value = self.backend.get(query_cache_key(table_name, quargs, schema_version))
+
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        return value
+
+    def set(self, table_name: str, quargs, value: tuple, schema_version: int = 0):
+        """
+        Caches a query_table result, unless caching is disabled for the table or the result has more than max_rows
+        rows.
+        """
+        ttl = self.get_ttl(table_name)
+
+        if ttl <= 0 or len(value[0]) > self.max_rows:
+            return
+
+        self.backend.set(query_cache_key(table_name, quargs, schema_version), value, ttl)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        with self._lock:
+            hits, misses = self.hits, self.misses
+
+        total = hits + misses
+
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_ratio': hits / total if total else 0.0
+        }
+
+
+def parse_table_ttls(table_ttls: str):
+    """
+    Parses per table TTLs from the config.
+
+    expected format: table_name:ttl, table_name:ttl
+
+    :param table_ttls: string
+    :return: dict of table_name -> ttl in seconds
+    """
+    ttls = {}
+
+    for item in table_ttls.split(','):
+        if not item.strip():
+            continue
+
+        try:
+            table_name, ttl = [s.strip() for s in item.split(':')]
+            ttls[table_name] = int(ttl)
+        except ValueError:
+            raise ConfigurationError('Invalid table_ttls entry "{}", expected table_name:seconds'.format(item))
+
+    return ttls
+
+
+def init_cache(cache_config):
+    """
+    Creates a QueryCache from the [cache] section of the config file.
+
+    :param cache_config: The cache config section, can be None.
+    :return: QueryCache, or None if caching is not configured.
+    """
+    if cache_config is None:
+        return None
+
+    backend_name = cache_config.get('backend', 'memory')
+    ttl = cache_config.getint('ttl', DEFAULT_TTL)
+    table_ttls = parse_table_ttls(cache_config.get('table_ttls', ''))
+    max_rows = cache_config.getint('max_rows', DEFAULT_MAX_ROWS)
+
+    if backend_name not in CACHE_BACKENDS:
+        raise ConfigurationError('Invalid cache backend "{}", valid backends: {}'.format(backend_name, CACHE_BACKENDS))
+
+    if backend_name == 'redis':
+        if redis is None:
+            raise ConfigurationError('The redis package is required to use the redis cache backend')
+
+        client = redis.StrictRedis.from_url(cache_config.get('url', 'redis://localhost:6379/0'))
+        backend = RedisCache(client, cache_config.get('prefix', 'grice:'))
+    else:
+        backend = MemoryCache(cache_config.getint('max_entries', DEFAULT_MAX_ENTRIES))
+
+    log.info('Query cache enabled, backend: %s, ttl: %s', backend_name, ttl)
+
+    return QueryCache(backend, ttl, table_ttls, max_rows)
@@ -0,0 +1,253 @@
+"""
+Statement timeouts and query cancellation.
+
+Queries are cancelled by the QueryWatchdog, a background thread that asks the database to stop the statement running on
+a connection (cancel() on psycopg2 connections, interrupt() on sqlite3 connections) when:
+
+- the statement ran longer than the statement timeout of the queried table: statement_timeout seconds, or the table's
+  entry in table_statement_timeouts. Every statement gets the whole timeout, and so does every batch a streamed query
+  fetches, so slow downloads of big results are not cut off.
+- the client that sent the request disconnected. While a query executes this is only noticed if the server tells,
+  through the waitress.client_disconnected function in the WSGI environ (waitress 2.0 and newer, with
+  channel_request_lookahead set). Streamed responses stop reading from the database as soon as sending them fails.
+
+Queries on drivers that can't cancel a statement from another thread run without timeouts.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import exc
+
+from grice import timing
+from grice.errors import ConfigurationError, QueryCancelledError, QueryTimeoutError
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+# Seconds, 0 disables the timeout.
+DEFAULT_STATEMENT_TIMEOUT = 0
+# Seconds between checks of the running queries, which is how late a statement can be cancelled.
+WATCH_INTERVAL = 0.1
+
+_local = threading.local()  # pylint: disable=invalid-name
+
+
+def start_request(disconnected=None):
+    """
+    Records how to tell whether the client of the current thread's request disconnected.
+
+    :param disconnected: Function without arguments that returns True once the client disconnected, None if
+    disconnects can't be detected.
+    """
+    _local.disconnected = disconnected
+
+
+def stop_request():
+    _local.disconnected = None
+
+
+def client_disconnected():
+    """
+    :return: The disconnect check of the current thread's request (see start_request), or None.
+    """
+    return getattr(_local, 'disconnected', None)
+
+
+def parse_table_timeouts(table_timeouts: str):
+    """
+    Parses per table statement timeouts from the config.
+
+    expected format: table_name:timeout, table_name:timeout
+
+    :param table_timeouts: string
+    :return: dict of table_name -> timeout in seconds
+    """
+    timeouts = {}
+
+    for item in table_timeouts.split(','):
+        if not item.strip():
+            continue
+
+        try:
+            table_name, timeout = [s.strip() for s in item.split(':')]
+            timeouts[table_name] = float(timeout)
+        except ValueError:
+            raise ConfigurationError('Invalid table_statement_timeouts entry "{}", expected table_name:seconds'.format(
+                item))
+
+    return timeouts
+
+
+def can_cancel(dbapi_connection):
+    return hasattr(dbapi_connection, 'cancel') or hasattr(dbapi_connection, 'interrupt')
+
+
+def cancel_connection(dbapi_connection):
+    """
+    Asks the database to stop the statement running on a DBAPI connection. Safe to call from any thread, the statement
+    fails with the driver's error for cancelled statements.
+    """
+    if hasattr(dbapi_connection, 'cancel'):
+        # psycopg2 sends a cancel request over a separate connection.
+        dbapi_connection.cancel()
+    else:
+        # sqlite3
+        dbapi_connection.interrupt()
+
+
+class RunningQuery:
+    def __init__(self, dbapi_connection, timeout: float, disconnected=None):
+        """
+        The statements of one query, watched by a QueryWatchdog.
+
+        :param dbapi_connection: The DBAPI connection the statements run on.
+        :param timeout: Seconds each statement may run, 0 for no limit.
+        :param disconnected: Function that returns True once the client disconnected, can be None.
+        """
+        self.connection = dbapi_connection
+        self.timeout = timeout
+        self.disconnected = disconnected
+        self.deadline = None
+        self.running = False
+        self.reason = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def statement(self):
+        """
+        Runs a statement (or a fetch) under the watchdog: it is cancelled when it runs past the timeout or when the
+        client disconnects.
+        """
+        if self.disconnected is not None and self.disconnected():
+            self.reason = 'disconnect'
+            raise QueryCancelledError('The query was cancelled because the client disconnected')
+
+        with self._lock:
+            self.deadline = time.monotonic() + self.timeout if self.timeout else None
+            self.running = True
+
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.running = False
+                self.deadline = None
+
+    def cancel_if_due(self, now: float):
+        """
+        Cancels the running statement if it is past its deadline or the client disconnected.
+
+        :return: The reason the statement was cancelled, "timeout" or "disconnect", or None if it wasn't.
+        """
+        with self._lock:
+            if not self.running or self.reason is not None:
+                return None
+
+            if self.deadline is not None and now >= self.deadline:
+                self.reason = 'timeout'
+            elif self.disconnected is not None and self.disconnected():
+                self.reason = 'disconnect'
+            else:
+                return None
+
+            cancel_connection(self.connection)
+
+        return self.reason
+
+
+class QueryWatchdog(threading.Thread):
+    """
+    Cancels the statements of running queries that exceed their timeout or whose client disconnected, checking every
+    interval seconds while there are queries to watch.
+    """
+    def __init__(self, interval: float = WATCH_INTERVAL):
+        super().__init__(name='grice-query-watchdog', daemon=True)
+        self.interval = interval
+        self.timeouts = 0
+        self.disconnects = 0
+        self._queries = set()
+        self._lock = threading.Lock()
+        self._watching = threading.Event()
+        self._stopped = threading.Event()
+
+    @contextmanager
+    def watch(self, conn, timeout: float, disconnected=None):
+        """
+        Watches a query. Run each of its statements in the statement() context of the yielded RunningQuery.
+
+        :param conn: SQLAlchemy connection the query runs on.
+        :param timeout: Seconds each statement may run, 0 for no limit.
+        :param disconnected: Function that returns True once the client disconnected, see client_disconnected.
+        :raises QueryTimeoutError: If a statement was cancelled because it ran too long.
+        :raises QueryCancelledError: If a statement was cancelled because the client disconnected.
+        """
+        query = RunningQuery(conn.connection.connection, timeout, disconnected)
+        watched = bool(timeout or disconnected is not None) and can_cancel(query.connection)
+
+        if watched:
+            with self._lock:
+                self._queries.add(query)
+                self._watching.set()
+
+        try:
+            yield query
+        except exc.DBAPIError:
+            if query.reason is None:
+                raise
+
+            timing.annotate(cancelled=query.reason)
+
+            if query.reason == 'timeout':
+                raise QueryTimeoutError('The query was cancelled because it ran for more than {:g} seconds. Add '
+                                        'filters to narrow it down.'.format(timeout))
+
+            raise QueryCancelledError('The query was cancelled because the client disconnected')
+        finally:
+            if watched:
+                with self._lock:
+                    self._queries.discard(query)
+
+                    if not self._queries:
+                        self._watching.clear()
+
+    def check(self):
+        now = time.monotonic()
+
+        with self._lock:
+            queries = list(self._queries)
+
+        for query in queries:
+            reason = query.cancel_if_due(now)
+
+            if reason == 'timeout':
+                log.info('Cancelled a statement that ran for more than %gs', query.timeout)
+                self.timeouts += 1
+            elif reason == 'disconnect':
+                log.info('Cancelled a statement whose client disconnected')
+                self.disconnects += 1
+
+    def run(self):
+        while not self._stopped.is_set():
+            self._watching.wait()
+
+            try:
+                self.check()
+            except Exception:  # pylint: disable=broad-except
+                log.exception('Checking running queries failed')
+
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
+        self._watching.set()
+
+    def stats(self):
+        with self._lock:
+            running = len(self._queries)
+
+        return {
+            'running': running,
+            'timeouts': self.timeouts,
+            'disconnects': self.disconnects,
+        }
@@ -0,0 +1,235 @@
+import logging
+from itertools import groupby
+
+from sqlalchemy import select, func, case, cast, and_, not_, or_, Integer
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+from sqlalchemy.sql import Alias
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+DEFAULT_MAX_OUTLIERS = 100
+DEFAULT_MAX_POINTS = 5000
+DEFAULT_GRID_SIZE = 100
+WHISKER_IQR = 1.5
+PERCENTILE_DIALECTS = ['postgresql']
+
+
+def quantile(values: list, p: float):
+    """
+    Computes the p-quantile of a sorted list using linear interpolation. This matches both d3.quantile and the SQL
+    percentile_cont aggregate, so stats computed in Python and in the database agree.
+
+    :param values: sorted list of numbers.
+    :param p: a number between 0 and 1.
+    :return: the interpolated value, or None if values is empty.
+    """
+    if not values:
+        return None
+
+    index = (len(values) - 1) * p
+    lower = int(index)
+
+    if lower + 1 >= len(values):
+        return values[lower]
+
+    return values[lower] + (values[lower + 1] - values[lower]) * (index - lower)
+
+
+def _box_plot_dict(name, count, min_value, max_value, box: tuple, whiskers: tuple, outliers: list):  # pylint: disable=too-many-arguments
+    return {
+        'name': name,
+        'count': count,
+        'min': min_value,
+        'max': max_value,
+        'box': {
+            'bottom': box[0],
+            'middle': box[1],
+            'top': box[2]
+        },
+        'whiskers': {
+            'bottom': whiskers[0],
+            'top': whiskers[1]
+        },
+        'outliers': outliers
+    }
+
+
+def _values_box_plot(name, values: list, max_outliers: int):
+    """
+    Computes the box plot stats for a sorted list of values.
+    """
+    bottom = quantile(values, .25)
+    top = quantile(values, .75)
+    iqr = WHISKER_IQR * (top - bottom)
+    inner = [v for v in values if bottom - iqr <= v <= top + iqr]
+    outliers = [v for v in values if v < bottom - iqr or v > top + iqr][:max_outliers]
+    whiskers = (inner[0], inner[-1]) if inner else (None, None)
+
+    return _box_plot_dict(name, len(values), values[0], values[-1], (bottom, quantile(values, .5), top), whiskers,
+                          outliers)
+
+
+def _streamed_box_plot_stats(conn, source: Alias, max_outliers: int):
+    """
+    Computes box plot stats for dialects without percentile_cont. Rows are streamed in (group, value) order so only
+    the values of a single group are held in memory at any time.
+    """
+    query = select([source.c.grp, source.c.value]).where(source.c.value != None)  # pylint: disable=singleton-comparison
+    query = query.order_by(source.c.grp, source.c.value)
+    result = conn.execution_options(stream_results=True).execute(query)
+    groups = []
+
+    for group, rows in groupby(result, key=lambda row: row[0]):
+        values = [row[1] for row in rows]
+        groups.append(_values_box_plot(group, values, max_outliers))
+
+    return groups
+
+
+def _percentile_box_plot_stats(conn, source: Alias, max_outliers: int):
+    """
+    Computes box plot stats entirely inside the database using the percentile_cont ordered-set aggregate, in a single
+    query. The per group stats are a CTE, so the percentiles are computed once, and the whiskers and outliers are found
+    in one more pass over the source.
+    """
+    value = source.c.value
+    stats = select([
+        source.c.grp,
+        func.count(value).label('count'),
+        func.min(value).label('min'),
+        func.max(value).label('max'),
+        func.percentile_cont(.25).within_group(value).label('q1'),
+        func.percentile_cont(.5).within_group(value).label('q2'),
+        func.percentile_cont(.75).within_group(value).label('q3'),
+    ]).where(value != None).group_by(source.c.grp).cte('stats')  # pylint: disable=singleton-comparison
+
+    iqr = WHISKER_IQR * (stats.c.q3 - stats.c.q1)
+    is_outlier = or_(value < stats.c.q1 - iqr, value > stats.c.q3 + iqr)
+    joined = source.join(stats, source.c.grp.isnot_distinct_from(stats.c.grp))
+    classified = select([
+        stats.c.grp,
+        value,
+        is_outlier.label('outlier'),
+        func.row_number().over(partition_by=[stats.c.grp, is_outlier], order_by=value).label('rank')
+    ]).select_from(joined).where(value != None).alias('classified')  # pylint: disable=singleton-comparison
+
+    inner_value = case([(not_(classified.c.outlier), classified.c.value)])
+    kept_outlier = and_(classified.c.outlier, classified.c.rank <= max_outliers)
+    fences = select([
+        classified.c.grp,
+        func.min(inner_value).label('bottom'),
+        func.max(inner_value).label('top'),
+        func.array_agg(aggregate_order_by(classified.c.value, classified.c.value)).filter(kept_outlier)
+        .label('outliers'),
+    ]).group_by(classified.c.grp).alias('fences')
+
+    query = select([stats, fences.c.bottom, fences.c.top, fences.c.outliers]) \
+        .select_from(stats.outerjoin(fences, stats.c.grp.isnot_distinct_from(fences.c.grp))) \
+        .order_by(stats.c.grp)
+    groups = []
+
+    for row in conn.execute(query):
+        box = (row.q1, row.q2, row.q3)
+        groups.append(_box_plot_dict(row.grp, row.count, row.min, row.max, box, (row.bottom, row.top),
+                                     list(row.outliers or [])))
+
+    return groups
+
+
+def box_plot_stats(conn, source: Alias, max_outliers: int = DEFAULT_MAX_OUTLIERS):
+    """
+    Computes box plot stats (min, quartiles, whiskers, max and outliers) for every group of a source query.
+
+    :param conn: SQLAlchemy connection.
+    :param source: An aliased select with a "grp" column and a "value" column.
+    :param max_outliers: The maximum number of outliers to return per group.
+    :return: dict with a list of per group stats as "rows", and the overall "min" and "max".
+    """
+    if conn.dialect.name in PERCENTILE_DIALECTS:
+        rows = _percentile_box_plot_stats(conn, source, max_outliers)
+    else:
+        rows = _streamed_box_plot_stats(conn, source, max_outliers)
+
+    mins = [row['min'] for row in rows if row['min'] is not None]
+    maxes = [row['max'] for row in rows if row['max'] is not None]
+
+    return {
+        'rows': rows,
+        'min': min(mins) if mins else None,
+        'max': max(maxes) if maxes else None
+    }
+
+
+def _point_dict(keys: tuple, row, count):
+    x_key, y_key, color_key = keys
+    point = {x_key: row.x, y_key: row.y, 'count': count}
+
+    if color_key is not None:
+        point[color_key] = row.color
+
+    return point
+
+
+def _grid_cell(conn, offset, span: float, grid_size: int):
+    """
+    Returns the index of the grid cell (0 to grid_size - 1) of a value's offset from the minimum.
+    """
+    scaled = offset * (grid_size / span)
+
+    if conn.dialect.name == 'sqlite':
+        # SQLite has no floor function, but its CAST truncates, which floors the offsets as they are never negative.
+        cell = cast(scaled, Integer)
+    else:
+        cell = func.floor(scaled)
+
+    # The maximum lands on grid_size, it goes in the last cell.
+    return case([(cell >= grid_size, grid_size - 1)], else_=cell)
+
+
+def scatter_points(conn, source: Alias, keys: tuple, max_points: int = DEFAULT_MAX_POINTS,
+                   grid_size: int = DEFAULT_GRID_SIZE):  # pylint: disable=too-many-arguments, too-many-locals
+    """
+    Returns the points for a scatter plot. If the source has more than max_points rows, the points are downsampled
+    inside the database by snapping them onto a grid_size x grid_size grid, returning one averaged point (and its
+    count) per occupied cell and color.
+
+    :param conn: SQLAlchemy connection.
+    :param source: An aliased select with "x", "y", and "color" columns.
+    :param keys: The names to use for the x, y, and color values of each point, the color name can be None.
+    :param max_points: The number of rows above which points are downsampled.
+    :param grid_size: The number of grid cells along each axis when downsampling.
+    :return: dict with "points", "xDomain", "yDomain", "total", and "sampled".
+    """
+    x, y, color = source.c.x, source.c.y, source.c.color
+    not_null = (x != None) & (y != None)  # pylint: disable=singleton-comparison
+    bounds = conn.execute(select([func.count(), func.min(x), func.max(x), func.min(y), func.max(y)])
+                          .where(not_null)).first()
+    total, x_min, x_max, y_min, y_max = bounds
+    sampled = total > max_points
+
+    if not sampled:
+        query = select([x, y, color]).where(not_null)
+        points = [_point_dict(keys, row, 1) for row in conn.execute(query)]
+    else:
+        x_span = float(x_max - x_min) or 1.0
+        y_span = float(y_max - y_min) or 1.0
+        x_cell = _grid_cell(conn, x - x_min, x_span, grid_size).label('x_cell')
+        y_cell = _grid_cell(conn, y - y_min, y_span, grid_size).label('y_cell')
+        cells = select([x_cell, y_cell, color, x, y]).where(not_null).alias('cells')
+        query = select([
+            func.avg(cells.c.x).label('x'),
+            func.avg(cells.c.y).label('y'),
+            cells.c.color,
+            func.count().label('count')
+        ]).group_by(cells.c.x_cell, cells.c.y_cell, cells.c.color)
+        points = [_point_dict(keys, row, row.count) for row in conn.execute(query)]
+
+    log.debug('Scatter plot returned %s points for %s rows', len(points), total)
+
+    return {
+        'points': points,
+        'xDomain': [x_min, x_max],
+        'yDomain': [y_min, y_max],
+        'total': total,
+        'sampled': sampled
+    }
@@ -0,0 +1,98 @@
+import base64
+import datetime
+import logging
+import uuid
+from decimal import Decimal
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+def _encode_decimal(value):
+    return None if value is None else float(value)
+
+
+def _encode_isoformat(value):
+    return None if value is None else value.isoformat()
+
+
+def _encode_string(value):
+    return None if value is None else str(value)
+
+
+def _encode_bytes(value):
+    return None if value is None else base64.b64encode(bytes(value)).decode('ascii')
+
+
+def _encode_timedelta(value):
+    return None if value is None else value.total_seconds()
+
+
+# Checked in order, so datetime comes before its parent class date.
+ENCODERS = [
+    (Decimal, 'float', _encode_decimal),
+    (datetime.datetime, 'iso8601', _encode_isoformat),
+    (datetime.date, 'iso8601', _encode_isoformat),
+    (datetime.time, 'iso8601', _encode_isoformat),
+    (datetime.timedelta, 'seconds', _encode_timedelta),
+    (uuid.UUID, 'string', _encode_string),
+    ((bytes, bytearray, memoryview), 'base64', _encode_bytes),
+]
+
+
+def get_encoder(values: tuple):
+    """
+    Picks the encoder for a column from the type of its first non-null value, so the type checks are done once per
+    column instead of once per value.
+
+    :param values: The values of a column.
+    :return: encoding name, encoder function. Both are None if the values can be serialized to JSON as they are.
+    """
+    sample = next((value for value in values if value is not None), None)
+
+    for value_type, encoding, encoder in ENCODERS:
+        if isinstance(sample, value_type):
+            return encoding, encoder
+
+    return None, None
+
+
+def encode_column(values: tuple):
+    """
+    Converts the values of a column to types JSON can represent natively.
+
+    :param values: The values of a column.
+    :return: encoding name, list of encoded values.
+    """
+    encoding, encoder = get_encoder(values)
+
+    if encoder is None:
+        return encoding, list(values)
+
+    try:
+        return encoding, [encoder(value) for value in values]
+    except (AttributeError, TypeError, ValueError):
+        # The column mixes types (possible with SQLite), leave the values to the JSON encoder.
+        log.debug('Column has mixed types, not encoding it as %s', encoding)
+        return None, list(values)
+
+
+def to_columns(rows: list, column_data: list):
+    """
+    Converts list formatted query results to a columnar layout: one array of values per column, plus a schema header
+    that tells clients how each column was encoded.
+
+    :param rows: list of rows, each one a sequence of values in column order.
+    :param column_data: list of column dicts, as returned by query_table.
+    :return: dict with "columns" (the column dicts, each with an "encoding" key), "data" (a list of value arrays), and
+        "length" (the number of rows).
+    """
+    values = list(zip(*rows)) if rows else [() for _ in column_data]
+    columns = []
+    data = []
+
+    for column, column_values in zip(column_data, values):
+        encoding, encoded = encode_column(column_values)
+        columns.append(dict(column, encoding=encoding))
+        data.append(encoded)
+
+    return {'columns': columns, 'data': data, 'length': len(rows)}
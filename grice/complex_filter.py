@@ -1,7 +1,7 @@
 import logging
 from collections import namedtuple
 from typing import List, Union
-from sqlalchemy import Table, Column, not_, or_, and_
+from sqlalchemy import Table, Column, not_, or_, and_, bindparam, false
 from sqlalchemy import func as sql_func
 
 log = logging.getLogger(__name__)  # pylint: disable=C0103
@@ -24,10 +24,9 @@ def get_column(column_name: str, tables: List[Table]):
     """
     Converts a column name to a column object.
 
-    :param column_name: str, column_name strings, can be None.
-    :param table: The main table.
-    :param join_table: The table we are joining on, can be None.
-    :return: SqlAlchemy column object.
+    :param column_name: A ColumnFunction, or a column name string (optionally qualified as table_name.column_name).
+    :param tables: The main table followed by the joined tables.
+    :return: SqlAlchemy column object, or None if the column does not exist.
     """
 
     if isinstance(column_name, ColumnFunction):
@@ -43,13 +42,16 @@ def get_column(column_name: str, tables: List[Table]):
         operator_name = None
 
         try:
-            column_name, table_name = column_name.split('.')
+            table_name, column_name = column_name.split('.')
         except ValueError:
             # This is fine, this means that this isn't a fully qualified column name.
             pass
 
     column = _get_column(table_name, column_name, tables)
 
+    if column is None:
+        return None
+
     if operator_name:
         column = column.op(operator_name)(operator_value)
 
@@ -116,6 +118,16 @@ class ColumnFilter:  # pylint: disable=too-few-public-methods
         if self._column is not None and self.url_value is not None:
             self.value = convert_url_value(url_value, self.column)
 
+    @property
+    def qualified_name(self) -> str:
+        """
+        The column name as it was given, with the table name if there was one.
+        """
+        if self.table_name:
+            return self.table_name + '.' + self.column_name
+
+        return self.column_name
+
     @property
     def column(self) -> Column:
         return self._column
@@ -138,11 +150,12 @@ class ColumnFilter:  # pylint: disable=too-few-public-methods
 
         self._column = column
 
-    def _get_expression(self, column: Column):  # pylint: disable=too-many-return-statements
+    def _get_expression(self, column: Column, names=None):  # pylint: disable=too-many-return-statements
         """
         Given a Column and ColumnFilter return an expression to use as a filter.
         :param column: sqlalchemy Column object
-        :param column_filter: ColumnFilter object
+        :param names: An iterator of bind parameter names. If given, values are bound to named parameters taken from
+        it in order, so the statement can be compiled once and re-executed with other values.
         :return: sqlalchemy expression object
         """
         try:
@@ -154,6 +167,13 @@ class ColumnFilter:  # pylint: disable=too-few-public-methods
         value = self.value
         filter_type = self.filter_type
 
+        if names is not None:
+            if filter_type in LIST_FILTERS:
+                value = [bindparam(next(names), v, type_=column.type) for v in value]
+            elif value is not None:
+                # None is not bound, so eq and neq compile to IS NULL and IS NOT NULL instead of = NULL and != NULL.
+                value = bindparam(next(names), value, type_=column.type)
+
         if filter_type == 'lt':
             return column < value
         elif filter_type == 'lte':
@@ -177,35 +197,122 @@ class ColumnFilter:  # pylint: disable=too-few-public-methods
 
         return None
 
-    def get_expression(self, tables: List[Table]):
+    def get_expression(self, tables: List[Table], names=None):
         """
         Given a Column and a list of ColumnFilters return a filter expression.
 
-        :param table: The main table.
-        :param join_table: The table we are joining on, can be None.
+        :param tables: The main table followed by the joined tables.
+        :param names: An optional iterator of bind parameter names, see _get_expression.
         :return: list of sqlalchemy expression objects
         """
-        column = get_column(self.column_name, tables)
-        expr = self._get_expression(column)
+        column = _get_column(self.table_name, self.column_name, tables)
+
+        if column is None:
+            return None
+
+        expr = self._get_expression(column, names)
         return expr
 
+    def get_bind_values(self, tables: List[Table]):
+        """
+        Returns the values this filter binds to the statement, in the order get_expression binds them, without building
+        an expression.
+
+        :param tables: The tables being queried.
+        :return: shape, values. shape describes the filter without its values (invalid filters bind no values).
+        """
+        column = _get_column(self.table_name, self.column_name, tables)
+
+        if column is None:
+            return (self.table_name, self.column_name, self.filter_type, None), []
+
+        try:
+            self.column = column
+        except ValueError:
+            return (self.table_name, self.column_name, self.filter_type, None), []
+
+        if self.filter_type in LIST_FILTERS:
+            values = list(self.value)
+        elif self.value is None:
+            # None compiles to NULL instead of a parameter (see _get_expression), which is part of the statement.
+            return (self.table_name, self.column_name, self.filter_type, 'NULL'), []
+        else:
+            values = [self.value]
+
+        return (self.table_name, self.column_name, self.filter_type, len(values)), values
+
+    def cache_key(self, default_table_name: str = None):
+        """
+        Returns a hashable, deterministic representation of this filter.
+
+        :param default_table_name: The table name to use if the filter's column isn't fully qualified.
+        :return: tuple
+        """
+        value = self.url_value if self.url_value is not None else repr(self.value)
+        return self.table_name or default_table_name, self.column_name, self.filter_type, value
+
+
+class FalseFilter:
+    """
+    A filter no row matches. filter_normalization.normalize_filters returns it for contradicting filters, so queries
+    can skip the database.
+    """
+    def cache_key(self, default_table_name: str = None):  # pylint: disable=unused-argument,no-self-use
+        return ('FALSE',)
+
+    def get_bind_values(self, tables: List[Table]):  # pylint: disable=unused-argument,no-self-use
+        return ('FALSE',), []
+
+    def get_expression(self, tables: List[Table], names=None):  # pylint: disable=unused-argument,no-self-use
+        return false()
+
+
 class ComplexFilter:  # pylint: disable=too-few-public-methods
 
     def __init__(self, list_of_filters: List[Union['ComplexFilter', ColumnFilter]], is_and: bool = True):
         self.list_of_filters = list_of_filters
+        self.is_and = is_and
         self.expression_fn = and_ if is_and else or_
 
-    def get_expression(self, tables: List[Table]):
+    def cache_key(self, default_table_name: str = None):
+        """
+        Returns a hashable, deterministic representation of this filter tree. AND and OR are commutative, so children
+        are sorted, meaning filters given in a different order produce the same key.
+
+        :param default_table_name: The table name to use for columns that aren't fully qualified.
+        :return: tuple
+        """
+        children = [f.cache_key(default_table_name) for f in self.list_of_filters]
+        return 'AND' if self.is_and else 'OR', tuple(sorted(children, key=repr))
+
+    def get_bind_values(self, tables: List[Table]):
+        """
+        Returns the values the filter tree binds to the statement, in the order get_expression binds them.
+
+        :param tables: The tables being queried.
+        :return: shape, values. shape describes the filter tree without its values.
+        """
+        shapes = []
+        values = []
+
+        for column_filter in self.list_of_filters:
+            shape, filter_values = column_filter.get_bind_values(tables)
+            shapes.append(shape)
+            values.extend(filter_values)
+
+        return (self.is_and, tuple(shapes)), values
+
+    def get_expression(self, tables: List[Table], names=None):
         """
         Given a Column and a list of ColumnFilters return a filter expression.
 
-        :param table: The main table.
-        :param join_table: The table we are joining on, can be None.
+        :param tables: The main table followed by the joined tables.
+        :param names: An optional iterator of bind parameter names, see ColumnFilter._get_expression.
         :return: list of sqlalchemy expression objects
         """
         if self.list_of_filters:
-            expressions = (f.get_expression(tables) for f in self.list_of_filters)
-            expressions = [e for e in expressions if not None]
+            expressions = (f.get_expression(tables, names) for f in self.list_of_filters)
+            expressions = [e for e in expressions if e is not None]
             if expressions:
                 number_of_filters = len(expressions)
                 if number_of_filters == 1:
@@ -1,15 +1,50 @@
+import csv
+import hashlib
+import io
+import json
 import logging
+import zlib
 from collections import OrderedDict
 
-from flask import Flask, jsonify, render_template, request
+from flask import Flask, Response, jsonify, render_template, request
 
-from grice.db_service import DBService, DEFAULT_PAGE, DEFAULT_PER_PAGE, ColumnSort, SORT_DIRECTIONS, \
+from grice.db_service import DBService, column_label, DEFAULT_PAGE, DEFAULT_PER_PAGE, ColumnSort, SORT_DIRECTIONS, \
     ColumnPair, TableJoin, QueryArguments, SUPPORTED_FUNCS
+from grice import arrow_export, cancellation, columnar, metrics, timing
+from grice.arrow_export import EXPORT_FORMATS, EXPORT_MIMETYPES, EXPORT_EXTENSIONS
+from grice.chart_data import DEFAULT_MAX_OUTLIERS, DEFAULT_MAX_POINTS, DEFAULT_GRID_SIZE
 from grice.complex_filter import ComplexFilter, ColumnFilter, ColumnFunction
-from grice.errors import NotFoundError, JoinError
+from grice.errors import NotFoundError, JoinError, FilterError, QueryTimeoutError, QueryCancelledError, \
+    QueryRejectedError
 
 log = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
+CHART_TYPES = ['box', 'scatter']
+JOIN_ARGS = ['join', 'outerjoin']
+RESPONSE_FORMATS = ['rows', 'columns'] + EXPORT_FORMATS
+STREAM_FORMATS = ['ndjson', 'json']
+CSV_DELIMITERS = {
+    'csv': ',',
+    'tsv': '\t'
+}
+CSV_MIMETYPES = {
+    'csv': 'text/csv',
+    'tsv': 'text/tab-separated-values'
+}
+# Errors of queries that were stopped by a statement timeout, a client disconnect, or admission control.
+QUERY_ERRORS = (QueryTimeoutError, QueryCancelledError, QueryRejectedError)
+# Seconds after which clients should retry queries rejected because too many expensive queries were running.
+RETRY_AFTER = 5
+JOB_EXPORT_MIMETYPES = {
+    'csv': 'text/csv',
+    'tsv': 'text/tab-separated-values',
+    'ndjson': 'application/x-ndjson'
+}
+STREAM_MIMETYPES = {
+    'ndjson': 'application/x-ndjson',
+    'json': 'application/json'
+}
+
 def parse_pagination(page, per_page):
     try:
         page = int(page) - 1
@@ -113,7 +148,10 @@ def parse_filters(filter_description: dict):
     :return: ComplexFilter object
     """
 
-    filter_list = [parse_filter_obj(filter_description)]
+    try:
+        filter_list = [parse_filter_obj(filter_description)]
+    except ValueError as e:
+        raise FilterError('Invalid filter: {}'.format(e))
 
     if filter_list:
         return ComplexFilter(list_of_filters=filter_list)
@@ -167,7 +205,7 @@ def parse_sorts(sort_list):
         except ValueError:
             continue
 
-        sorts[column_sort.column_name] = column_sort
+        sorts[(column_sort.table_name, column_sort.column_name)] = column_sort
 
     if len(sorts):
         return list(sorts.values())
@@ -177,10 +215,14 @@ def parse_sorts(sort_list):
 
 def parse_join(join_str, outer_join: bool):
     """
-    Parses the join string from the URL.
+    Parses a join string from the URL.
 
     Expected format: table_name,from_col:to_col;from_col:to_col
 
+    from_col can be qualified (table_name.column_name) to join from a table that was joined earlier, otherwise it is a
+    column of the main table. If the column pairs are left out (i.e. just table_name) the join condition is inferred
+    from the foreign keys.
+
     :param join_str: The join= string from the URL
     :param outer_join: boolean, true if the join is an outer join, false for inner join.
     :return: TableJoin
@@ -190,24 +232,55 @@ def parse_join(join_str, outer_join: bool):
     if join_str is None:
         return None
 
-    try:
-        table_name, column_pair_strings = join_str.split(',')
-    except ValueError:
+    table_name, _, column_pair_strings = join_str.partition(',')
+    table_name = table_name.strip()
+    column_pairs = []
+
+    if not table_name:
         return None
 
-    column_pair_strings = column_pair_strings.split(';')
-    column_pairs = []
+    for column_pair_string in column_pair_strings.split(';'):
+        if not column_pair_string.strip():
+            continue
 
-    for column_pair_string in column_pair_strings:
-        from_column, to_column = column_pair_string.strip().split(':')
-        column_pairs.append(ColumnPair(from_column, to_column))
+        try:
+            from_column, to_column = column_pair_string.strip().split(':')
+        except ValueError:
+            return None
 
-    if len(column_pairs) == 0:
-        return None
+        column_pairs.append(ColumnPair(from_column.strip(), to_column.strip()))
 
     return TableJoin(table_name, column_pairs, outer_join)
 
 
+def parse_joins(join_args):
+    """
+    Parses the join strings from the URL. Tables are joined in the order they are given.
+
+    :param join_args: iterable of (arg_name, join string) tuples, arg_name is "join" or "outerjoin".
+    :return: list of TableJoin
+    """
+    joins = []
+
+    for arg_name, join_str in join_args:
+        join = parse_join(join_str, arg_name == 'outerjoin')
+
+        if join is not None:
+            joins.append(join)
+
+    return joins
+
+
+def _as_list(value):
+    if value is None:
+        return []
+
+    if isinstance(value, str):
+        return [value]
+
+    return value
+
+
 def parse_column_func(column_string):
     """
     Parses a column from the URL.
@@ -293,11 +366,97 @@ def parse_query_args(query_args):
     page, per_page = parse_pagination(query_args.get('page'), query_args.get('perPage'))
     filters = parse_filters(dict(AND=query_args.getlist('filter')))
     sorts = parse_sorts(query_args.getlist('sort'))
-    join = parse_join(query_args.get('join'), False) or parse_join(query_args.get('outerjoin'), True)
+    joins = parse_joins((k, v) for k, v in query_args.items(multi=True) if k in JOIN_ARGS)
     column_names = parse_column_funcs(query_args.getlist('columns')) or parse_column_funcs(query_args.get('cols', '').split(','))
     group_by = parse_column_funcs(query_args.getlist('group_by', None))
 
-    return column_names, page, per_page, filters, sorts, join, group_by
+    return column_names, page, per_page, filters, sorts, joins, group_by
+
+
+def parse_int(value, default: int):
+    try:
+        value = int(value)
+    except (ValueError, TypeError):
+        return default
+
+    if value < 1:
+        return default
+
+    return value
+
+
+def parse_chart_column(column_string):
+    """
+    Parses an optional chart axis column from the URL.
+
+    expected format: column_name or table_name.column_name
+
+    :param column_string: string, can be None.
+    :return: ColumnFunction or None
+    """
+    if not column_string:
+        return None
+
+    return parse_column_func(column_string)
+
+
+def stream_ndjson(envelope: dict, rows, encoder):
+    """
+    Generates newline delimited JSON. The first line is the envelope (table and column info), every following line is
+    a row.
+    """
+    yield json.dumps(envelope, cls=encoder) + '\n'
+
+    for row in rows:
+        yield json.dumps(row, cls=encoder) + '\n'
+
+
+def stream_json(envelope: dict, rows, encoder):
+    """
+    Generates the same JSON document as the non-streaming query API, but one row at a time.
+    """
+    envelope = json.dumps(envelope, cls=encoder)
+    separator = ''
+    yield envelope[:-1] + ', "rows": ['
+
+    for row in rows:
+        yield separator + json.dumps(row, cls=encoder)
+        separator = ', '
+
+    yield ']}'
+
+
+def stream_csv(columns: list, batches, delimiter: str):
+    """
+    Generates delimited text, a header row of column names followed by the rows. Each batch of rows is encoded and sent
+    on its own, so memory use is bounded by the batch size.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=delimiter)
+    writer.writerow([column_label(column) for column in columns])
+
+    for rows in batches:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+
+    yield buffer.getvalue().encode('utf-8')
+
+
+def gzip_stream(chunks):
+    """
+    Gzips a stream of bytes on the fly.
+    """
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+
+        if data:
+            yield data
+
+    yield compressor.flush()
 
 
 def table_not_found(name):
@@ -309,62 +468,509 @@ def table_not_found(name):
 
 
 class DBController:
-    def __init__(self, app: Flask, db_service: DBService):
+    def __init__(self, app: Flask, db_service: DBService, job_manager=None, spool_manager=None):
         self.app = app
         self.db_service = db_service
+        self.jobs = job_manager
+        self.spools = spool_manager
+        self._encoded = {}
+        self.metrics = metrics.Metrics()
         self.register_routes()
+        self.app.before_request(self.start_request_timing)
+        self.app.after_request(self.finish_request_timing)
+
+    def start_request_timing(self):
+        timing.start()
+        cancellation.start_request(request.environ.get('waitress.client_disconnected'))
+
+    def finish_request_timing(self, response: Response):
+        """
+        Adds the stage timings of the request to the Server-Timing header, records the request metrics, and writes the
+        request to the slow query log if it took longer than the configured threshold. Streamed responses are timed up
+        to the point where the body starts being sent.
+        """
+        timer = timing.stop()
+        cancellation.stop_request()
+
+        if timer is None:
+            return response
+
+        response.headers['Server-Timing'] = timer.server_timing()
+        endpoint = request.endpoint or 'unknown'
+        table = (request.view_args or {}).get('name', None)
+
+        if table not in self.db_service.table_names:
+            # Only label known tables, so requests for random table names can't create unlimited label values.
+            table = ''
+
+        response_bytes = None
+
+        if response.is_streamed:
+            response.response = self.metrics.count_bytes(response.response, endpoint, table)
+        else:
+            response_bytes = response.calculate_content_length()
+
+        self.metrics.record_request(endpoint, table, response.status_code, timer.elapsed(), timer, response_bytes)
+        timing.log_slow_request(timer, self.db_service.slow_query_threshold, method=request.method,
+                                path=request.path, endpoint=endpoint, table=table, status=response.status_code,
+                                bytes=response_bytes)
+
+        return response
+
+    def error_response(self, error: Exception, status: int, **fields):
+        """
+        Returns a JSON error response, and records the type of the error for the metrics.
+        """
+        timing.annotate(error=type(error).__name__)
+
+        return jsonify(error=str(error), **fields), status
+
+    def query_error_response(self, error: Exception):
+        """
+        Returns the error response for a query stopped by its statement timeout (504), by its client disconnecting (499,
+        which nobody reads but the metrics), or by admission control (422 if the query has to be narrowed down, 503 if
+        it can be retried later).
+        """
+        if isinstance(error, QueryTimeoutError):
+            return self.error_response(error, 504)
+
+        if isinstance(error, QueryCancelledError):
+            return self.error_response(error, 499)
+
+        if not error.retry:
+            return self.error_response(error, 422)
+
+        response, status = self.error_response(error, 503)
+        response.headers['Retry-After'] = str(RETRY_AFTER)
+
+        return response, status
+
+    def query_table(self, name, quargs: QueryArguments):
+        """
+        Queries a table, from a result spool if one can answer the query (see result_spool).
+        """
+        if self.spools is not None:
+            return self.spools.query_table(name, quargs)
+
+        return self.db_service.query_table(name, quargs)
+
+    def is_debug_request(self):
+        """
+        Returns True if the request asks for debug information (the _debug argument) in the response.
+        """
+        content = request.get_json(silent=True)
+
+        if content:
+            return bool(content.get('_debug'))
+
+        return request.args.get('_debug', '').lower() in ['t', 'true', '1']
+
+    def schema_response(self, key, build):
+        """
+        Returns a JSON response for data that only changes with the database schema. The encoded body and its ETag are
+        built once per schema version, and requests with a matching If-None-Match header get a 304.
+
+        :param key: Identifies the response, i.e. the route and table name.
+        :param build: Function that returns the data to encode.
+        :return: Response
+        """
+        version = self.db_service.schema_version
+        entry = self._encoded.get(key, None)
+
+        if entry is None or entry[0] != version:
+            body = json.dumps(build(), cls=self.app.json_encoder, separators=(',', ':')).encode('utf-8')
+            entry = (version, hashlib.sha1(body).hexdigest(), body)
+            self._encoded[key] = entry
+
+        response = Response(entry[2], mimetype='application/json')
+        response.set_etag(entry[1])
+
+        return response.make_conditional(request)
 
     def get_query_args(self):
         content = request.get_json(silent=True)
 
         if not content:
-            column_names, page, per_page, filters, sorts, join, group_by = parse_query_args(request.args)
-            quargs = QueryArguments(column_names, page, per_page, filters, sorts, join, group_by,
-                                    format_as_list=request.args.get('_list', '').lower() in ['t', 'true', '1'])
+            column_names, page, per_page, filters, sorts, joins, group_by = parse_query_args(request.args)
+            quargs = QueryArguments(column_names, page, per_page, filters, sorts, joins, group_by,
+                                    format_as_list=request.args.get('_list', '').lower() in ['t', 'true', '1'],
+                                    after=request.args.get('after') or None)
 
         else:
             page, per_page = parse_pagination(content.get('page'), content.get('perPage'))
             filters = parse_filters(content.get('filter', []))
             sorts = parse_sorts(content.get('sort', []))
-            join = parse_join(content.get('join'), False) or parse_join(content.get('outerjoin'), True)
+            joins = parse_joins([(arg_name, join_str) for arg_name in JOIN_ARGS
+                                 for join_str in _as_list(content.get(arg_name))])
             column_names = parse_column_funcs(content.get('columns', [])) or parse_column_funcs(content.get('cols', '').split(','))
             group_by = parse_column_funcs(content.get('group_by', []))
-            quargs = QueryArguments(column_names, page, per_page, filters, sorts, join, group_by, content.get('_list'))
+            quargs = QueryArguments(column_names, page, per_page, filters, sorts, joins, group_by, content.get('_list'),
+                                    content.get('after'))
+
+        return quargs
+
+    def get_export_args(self):
+        """
+        Returns the query arguments of a download. Downloads have every row of the query, unless perPage is given.
+        """
+        quargs = self.get_query_args()
+        content = request.get_json(silent=True)
+        per_page = content.get('perPage') if content else request.args.get('perPage')
+
+        if per_page is None:
+            quargs = quargs._replace(page=0, per_page=-1)
 
         return quargs
 
+    def get_format_arg(self, arg_name: str, valid_formats: list, description: str):
+        content = request.get_json(silent=True)
+
+        if content:
+            format_name = content.get(arg_name)
+        else:
+            format_name = request.args.get(arg_name)
+
+        if format_name is not None:
+            format_name = format_name.lower()
+
+            if format_name not in valid_formats:
+                raise ValueError('Invalid {} "{}", valid formats: {}'.format(description, format_name, valid_formats))
+
+        return format_name
+
+    def get_stream_format(self):
+        return self.get_format_arg('_stream', STREAM_FORMATS, 'stream format')
+
+    def get_response_format(self):
+        return self.get_format_arg('_format', RESPONSE_FORMATS, 'response format') or 'rows'
+
     def tables_api(self):
-        return jsonify(schemas=self.db_service.get_tables())
+        return self.schema_response(('tables',), lambda: {'schemas': self.db_service.get_tables()})
 
     tables_api.methods = ['GET']
 
+    def pool_api(self):
+        return jsonify(**self.db_service.pool_stats())
+
+    pool_api.methods = ['GET']
+
+    def metrics_api(self):
+        return Response(metrics.render(self.metrics, self.db_service, self.jobs, self.spools),
+                        content_type=metrics.CONTENT_TYPE)
+
+    metrics_api.methods = ['GET']
+
     def table_api(self, name):
         try:
-            table_info = self.db_service.get_table(name)
+            return self.schema_response(('table', name), lambda: self.db_service.get_table(name))
         except NotFoundError as e:
-            return jsonify(success=False, error=str(e)), 404
-
-        return jsonify(**table_info)
+            return self.error_response(e, 404, success=False)
 
     table_api.methods = ['GET', 'POST']
 
-    def query_api(self, name):
-        quargs = self.get_query_args()
+    def query_api(self, name):  # pylint: disable=too-many-return-statements
+        with timing.stage('parse'):
+            try:
+                quargs = self.get_query_args()
+                stream_format = self.get_stream_format()
+                response_format = self.get_response_format()
+
+                if stream_format is not None and response_format != 'rows':
+                    raise ValueError('The {} format can not be combined with _stream'.format(response_format))
+
+                if response_format in EXPORT_FORMATS and arrow_export.pyarrow is None:
+                    raise ValueError('The {} format requires the pyarrow package'.format(response_format))
+            except ValueError as e:
+                return self.error_response(e, 400)
 
         try:
-            table_info = self.db_service.get_table(name)
+            with timing.stage('schema'):
+                table_info = self.db_service.get_table(name)
         except NotFoundError as e:
-            return jsonify(success=False, error=str(e)), 404
+            return self.error_response(e, 404, success=False)
+
+        if stream_format is not None:
+            return self.stream_query(name, table_info, quargs, stream_format)
+
+        if response_format in EXPORT_FORMATS:
+            return self.export_query(name, quargs, response_format)
+
+        if response_format == 'columns':
+            # The columnar layout is built from list formatted rows, which are also what the result cache holds.
+            quargs = quargs._replace(format_as_list=True)
 
         try:
-            rows, columns = self.db_service.query_table(name, quargs)
-        except JoinError as e:
-            return jsonify(error=str(e)), 400
+            rows, columns, next_after = self.query_table(name, quargs)
+        except (JoinError, ValueError) as e:
+            return self.error_response(e, 400)
+        except QUERY_ERRORS as e:
+            return self.query_error_response(e)
+
+        if response_format == 'columns':
+            with timing.stage('columnar'):
+                data = dict(columnar.to_columns(rows, columns), table=table_info, next=next_after)
+        else:
+            data = dict(table=table_info, rows=rows, columns=columns, next=next_after)
 
-        return jsonify(table=table_info, rows=rows, columns=columns)
+        timer = timing.current()
+
+        if timer is not None and self.is_debug_request():
+            # The time spent encoding the response is only in the Server-Timing header.
+            data['debug'] = {'timings_ms': timer.stage_ms(), 'rows': len(rows)}
+
+        with timing.stage('encode'):
+            if response_format == 'columns':
+                body = json.dumps(data, cls=self.app.json_encoder, separators=(',', ':'))
+                return Response(body, mimetype='application/json')
+
+            return jsonify(**data)
 
     query_api.methods = ['GET', 'POST']
 
+    def count_api(self, name):
+        try:
+            with timing.stage('parse'):
+                quargs = self.get_query_args()
+
+            data = self.db_service.count_table(name, quargs)
+        except NotFoundError as e:
+            return self.error_response(e, 404, success=False)
+        except (JoinError, ValueError) as e:
+            return self.error_response(e, 400)
+        except QUERY_ERRORS as e:
+            return self.query_error_response(e)
+
+        return jsonify(table=name, **data)
+
+    count_api.methods = ['GET', 'POST']
+
+    def stream_query(self, name, table_info: dict, quargs: QueryArguments, stream_format: str):
+        """
+        Streams the query results as they are read from the database instead of building the whole response in memory.
+        """
+        try:
+            rows, columns = self.db_service.stream_table(name, quargs)
+        except (JoinError, ValueError) as e:
+            return self.error_response(e, 400)
+        except QUERY_ERRORS as e:
+            return self.query_error_response(e)
+
+        envelope = OrderedDict([('table', table_info), ('columns', columns)])
+
+        if stream_format == 'ndjson':
+            body = stream_ndjson(envelope, rows, self.app.json_encoder)
+        else:
+            body = stream_json(envelope, rows, self.app.json_encoder)
+
+        return Response(body, mimetype=STREAM_MIMETYPES[stream_format])
+
+    def export_query(self, name, quargs: QueryArguments, export_format: str):
+        """
+        Streams the query results as an Arrow IPC stream or a Parquet file, built one batch of rows at a time.
+        """
+        try:
+            batches, columns = self.db_service.stream_batches(name, quargs)
+        except (JoinError, ValueError) as e:
+            return self.error_response(e, 400)
+        except QUERY_ERRORS as e:
+            return self.query_error_response(e)
+
+        body = arrow_export.export_batches(batches, columns, export_format)
+        filename = '{}.{}'.format(name, EXPORT_EXTENSIONS[export_format])
+        headers = {'Content-Disposition': 'attachment; filename="{}"'.format(filename)}
+
+        return Response(body, mimetype=EXPORT_MIMETYPES[export_format], headers=headers)
+
+    def export_api(self, name, extension):
+        """
+        Streams the results of a query as a CSV or TSV download. Accepts the same arguments as the query API and table
+        page, but has every row unless perPage is given. Add gzip=true to compress the download.
+        """
+        compress = request.args.get('gzip', '').lower() in ['t', 'true', '1']
+
+        try:
+            quargs = self.get_export_args()
+            batches, columns = self.db_service.stream_batches(name, quargs)
+        except NotFoundError as e:
+            return self.error_response(e, 404, success=False)
+        except (JoinError, ValueError) as e:
+            return self.error_response(e, 400)
+        except QUERY_ERRORS as e:
+            return self.query_error_response(e)
+
+        body = stream_csv(columns, batches, CSV_DELIMITERS[extension])
+        filename = '{}.{}'.format(name, extension)
+        mimetype = CSV_MIMETYPES[extension]
+
+        if compress:
+            body = gzip_stream(body)
+            filename += '.gz'
+            mimetype = 'application/gzip'
+
+        headers = {'Content-Disposition': 'attachment; filename="{}"'.format(filename)}
+
+        return Response(body, mimetype=mimetype, headers=headers)
+
+    export_api.methods = ['GET', 'POST']
+
+    def chart_api(self, name):
+        """
+        Returns chart data computed by the database, box plot stats for type=box and downsampled points for
+        type=scatter, so the size of the response depends on the number of groups and not on the number of rows.
+        """
+        chart_type = request.args.get('type', 'box').lower()
+
+        if chart_type not in CHART_TYPES:
+            msg = 'Invalid chart type "{}", valid types: {}'.format(chart_type, CHART_TYPES)
+            return self.error_response(ValueError(msg), 400)
+
+        try:
+            table_info = self.db_service.get_table(name)
+        except NotFoundError as e:
+            return self.error_response(e, 404, success=False)
+
+        try:
+            quargs = self.get_query_args()
+            x = parse_chart_column(request.args.get('x'))
+            y = parse_chart_column(request.args.get('y'))
+            color = parse_chart_column(request.args.get('color'))
+
+            if y is None:
+                raise ValueError('A y column is required')
+
+            if chart_type == 'box':
+                max_outliers = parse_int(request.args.get('maxOutliers'), DEFAULT_MAX_OUTLIERS)
+                data = self.db_service.box_plot(name, quargs, y, x, max_outliers)
+            else:
+                if x is None:
+                    raise ValueError('An x column is required')
+
+                max_points = parse_int(request.args.get('maxPoints'), DEFAULT_MAX_POINTS)
+                grid_size = parse_int(request.args.get('gridSize'), DEFAULT_GRID_SIZE)
+                data = self.db_service.scatter_plot(name, quargs, x, y, color, max_points, grid_size)
+        except (JoinError, ValueError) as e:
+            return self.error_response(e, 400)
+        except QUERY_ERRORS as e:
+            return self.query_error_response(e)
+
+        return jsonify(table=table_info, type=chart_type, **data)
+
+    chart_api.methods = ['GET', 'POST']
+
+    def get_job(self, job_id):
+        """
+        :return: The Job with this id.
+        :raises NotFoundError: If jobs are disabled, or there is no such job.
+        """
+        if self.jobs is None:
+            raise NotFoundError('Jobs are disabled, add a [jobs] section to the config file to enable them')
+
+        return self.jobs.get(job_id)
+
+    def submit_job_api(self, name):
+        """
+        Submits a query as a job, see grice.jobs. Accepts the same arguments as the query API, page and perPage are
+        ignored because a job fetches the whole result.
+        """
+        if self.jobs is None:
+            return self.error_response(NotFoundError('Jobs are disabled'), 404, success=False)
+
+        try:
+            quargs = self.get_query_args()
+            self.db_service.get_table(name)
+            job = self.jobs.submit(name, quargs)
+        except NotFoundError as e:
+            return self.error_response(e, 404, success=False)
+        except ValueError as e:
+            return self.error_response(e, 400)
+        except QUERY_ERRORS as e:
+            return self.query_error_response(e)
+
+        response = jsonify(job=job.to_dict())
+        response.status_code = 202
+        response.headers['Location'] = '/api/db/jobs/' + job.id
+
+        return response
+
+    submit_job_api.methods = ['POST']
+
+    def jobs_api(self):
+        if self.jobs is None:
+            return jsonify(jobs=[])
+
+        return jsonify(jobs=[job.to_dict() for job in self.jobs.list()])
+
+    jobs_api.methods = ['GET']
+
+    def job_api(self, job_id):
+        """
+        Returns the state and progress of a job. DELETE cancels a job that is queued or running, or deletes the result
+        of a finished job.
+        """
+        try:
+            job = self.get_job(job_id)
+
+            if request.method == 'DELETE':
+                job = self.jobs.cancel(job_id)
+        except NotFoundError as e:
+            return self.error_response(e, 404, success=False)
+
+        return jsonify(job=job.to_dict())
+
+    job_api.methods = ['GET', 'DELETE']
+
+    def job_rows_api(self, job_id):
+        """
+        Returns a page of the rows a job spooled so far, as dicts keyed on the column names, or as lists with _list=true.
+        """
+        try:
+            job = self.get_job(job_id)
+            page, per_page = parse_pagination(request.args.get('page'), request.args.get('perPage'))
+        except NotFoundError as e:
+            return self.error_response(e, 404, success=False)
+        except ValueError as e:
+            return self.error_response(e, 400)
+
+        if job.labels is None:
+            return jsonify(job=job.to_dict(), columns=[], rows=[], page=page + 1, perPage=per_page)
+
+        if per_page > -1:
+            rows = job.spool.read(page * per_page, (page + 1) * per_page)
+        else:
+            rows = job.spool.read(0, None)
+
+        if request.args.get('_list', '').lower() not in ['t', 'true', '1']:
+            rows = [dict(zip(job.labels, row)) for row in rows]
+
+        return jsonify(job=job.to_dict(), columns=job.columns, rows=rows, page=page + 1, perPage=per_page)
+
+    job_rows_api.methods = ['GET']
+
+    def job_export_api(self, job_id, extension):
+        """
+        Downloads the result of a finished job as CSV, TSV, or newline delimited JSON (one row per line, as lists).
+        """
+        try:
+            job = self.get_job(job_id)
+        except NotFoundError as e:
+            return self.error_response(e, 404, success=False)
+
+        if job.state != 'done':
+            msg = 'Job {} is {}, only the results of finished jobs can be downloaded'.format(job.id, job.state)
+            return self.error_response(ValueError(msg), 409)
+
+        if extension == 'ndjson':
+            body = (''.join(json.dumps(row) + '\n' for row in rows) for rows in job.spool.iter_blocks())
+        else:
+            body = stream_csv(job.labels, job.spool.iter_blocks(), CSV_DELIMITERS[extension])
+
+        filename = '{}.{}'.format(job.table_name, extension)
+        headers = {'Content-Disposition': 'attachment; filename="{}"'.format(filename)}
+
+        return Response(body, mimetype=JOB_EXPORT_MIMETYPES[extension], headers=headers)
+
+    job_export_api.methods = ['GET']
+
     def tables_page(self):
         tables = self.db_service.get_tables()
 
@@ -380,34 +986,30 @@ class DBController:
         except NotFoundError:
             return table_not_found(name)
 
-        rows, columns = self.db_service.query_table(name, quargs)
+        rows, columns, next_after = self.query_table(name, quargs)
         title = "{} - Grice".format(name)
 
         return render_template('table.html', title=title, table=table, rows=rows, columns=columns, page=quargs.page + 1,
-                               per_page=quargs.per_page)
+                               per_page=quargs.per_page, next_after=next_after)
 
     def chart_page(self, name):
         quargs = self.get_query_args()
-        join_table = None
 
         try:
             table = self.db_service.get_table(name)
         except NotFoundError:
             return table_not_found(name)
 
-        if quargs.join:
-            try:
-                join_table = self.db_service.get_table(quargs.join.table_name)
-            except NotFoundError:
-                # Bad join table name. Should probably warn the user, but ignoring for now.
-                pass
-
         title = "{} - Charting - Grice".format(name)
 
         columns = table['columns']
 
-        if join_table:
-            columns = columns + join_table['columns']
+        for join in quargs.joins:
+            try:
+                columns = columns + self.db_service.get_table(join.table_name)['columns']
+            except NotFoundError:
+                # Bad join table name. Should probably warn the user, but ignoring for now.
+                pass
 
         return render_template('chart.html', title=title, table=table, columns=columns)
 
@@ -415,9 +1017,20 @@ class DBController:
 
     def register_routes(self):
         # API Routes
+        self.app.add_url_rule('/metrics', 'metrics_api', self.metrics_api)
+        self.app.add_url_rule('/api/db/pool', 'pool_api', self.pool_api)
         self.app.add_url_rule('/api/db/tables', 'tables_api', self.tables_api)
         self.app.add_url_rule('/api/db/tables/<name>', 'table_api', self.table_api)
         self.app.add_url_rule('/api/db/tables/<name>/query', 'query_api', self.query_api)
+        self.app.add_url_rule('/api/db/tables/<name>/chart', 'chart_api', self.chart_api)
+        self.app.add_url_rule('/api/db/tables/<name>/count', 'count_api', self.count_api)
+        self.app.add_url_rule('/api/db/tables/<name>/export.<any(csv, tsv):extension>', 'export_api', self.export_api)
+        self.app.add_url_rule('/api/db/tables/<name>/jobs', 'submit_job_api', self.submit_job_api)
+        self.app.add_url_rule('/api/db/jobs', 'jobs_api', self.jobs_api)
+        self.app.add_url_rule('/api/db/jobs/<job_id>', 'job_api', self.job_api)
+        self.app.add_url_rule('/api/db/jobs/<job_id>/rows', 'job_rows_api', self.job_rows_api)
+        self.app.add_url_rule('/api/db/jobs/<job_id>/export.<any(csv, tsv, ndjson):extension>', 'job_export_api',
+                              self.job_export_api)
 
         # HTML Pages
         self.app.add_url_rule('/db', 'db_index', self.tables_page)
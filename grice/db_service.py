@@ -1,35 +1,39 @@
 import logging
+import numbers
+import threading
 from collections import namedtuple
+from itertools import chain, count
 from typing import Union
 import urllib
 
-from sqlalchemy import create_engine, MetaData, Column, Table, select, asc, desc, and_
+from sqlalchemy import create_engine, MetaData, Column, Table, Integer, select, asc, desc, null, bindparam
 from sqlalchemy import engine
-from sqlalchemy.sql import Select
 from sqlalchemy.sql.functions import Function
 from sqlalchemy.sql.expression import BinaryExpression
 from sqlalchemy.engine import reflection
-from grice.complex_filter import ComplexFilter, get_column
-from grice.errors import ConfigurationError, NotFoundError, JoinError
+from sqlalchemy.exc import NoSuchTableError
+from grice import admission, cancellation, chart_data, keyset, pool, replicas, rollups, row_counts, schema, timing, \
+    value_lists
+from grice.cache import init_cache, query_cache_key, MemoryCache, SingleFlight, StatementCache, \
+    DEFAULT_STATEMENT_CACHE_SIZE
+from grice.complex_filter import ComplexFilter, FalseFilter, ColumnFunction, get_column
+from grice.filter_normalization import normalize_filters
+from grice.joins import plan_joins, prune_joins, referenced_tables, apply_joins
+from grice.errors import ConfigurationError, NotFoundError, JoinError, QueryCancelledError
 
 log = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
 DEFAULT_PAGE = 0
 DEFAULT_PER_PAGE = 50
+STREAM_BATCH_SIZE = 1000
 SORT_DIRECTIONS = ['asc', 'desc']
 SUPPORTED_FUNCS = ['avg', 'count', 'min', 'max', 'sum', 'stddev_pop']
 ColumnSort = namedtuple('ColumnSort', ['table_name', 'column_name', 'direction'])
 ColumnPair = namedtuple('ColumnPair', ['from_column', 'to_column'])
 TableJoin = namedtuple('TableJoin', ['table_name', 'column_pairs', 'outer_join'])
-QueryArguments = namedtuple('QueryArguments', ['column_names', 'page', 'per_page', 'filters', 'sorts', 'join', 'group_by', 'format_as_list'])
+QueryArguments = namedtuple('QueryArguments', ['column_names', 'page', 'per_page', 'filters', 'sorts', 'joins', 'group_by', 'format_as_list', 'after'])
 
-def init_database(db_config):
-    """
-    Creates a SqlAlchemy engine object from a config file.
-
-    :param db_config:
-    :return: SqlAlchemy engine object.
-    """
+def _database_url(db_config):
     driver = db_config.get('driver', 'postgresql')
     try:
         db_args = {
@@ -45,9 +49,26 @@ def init_database(db_config):
         msg = '"username", "password", "host", "port", and "database" are required fields of database config'
         raise ConfigurationError(msg)
 
-    eng_url = engine.url.URL(driver, **db_args)
+    return engine.url.URL(driver, **db_args)
+
+
+def init_database(db_config):
+    """
+    Creates a SqlAlchemy engine object from a config file.
+
+    :param db_config:
+    :return: SqlAlchemy engine object.
+    """
+    if 'url' in db_config:
+        # A full database URL, i.e. for SQLite databases which have no host or credentials.
+        eng_url = engine.url.make_url(db_config['url'])
+    else:
+        eng_url = _database_url(db_config)
+
+    db_engine = create_engine(eng_url, **pool.pool_options(db_config, eng_url.get_backend_name()))
+    pool.instrument_engine(db_engine, db_config.getboolean('pool_pre_ping', False))
 
-    return create_engine(eng_url)
+    return db_engine
 
 
 def computed_column_to_dict(column: Union[Function, BinaryExpression]):
@@ -122,27 +143,34 @@ def table_to_dict(table: Table):
     }
 
 
-def names_to_columns(column_names, table: Table, join_table: Table):
+def column_label(column):
+    """
+    Returns the full (table_name.column_name) name of a column, or the name of a computed column.
+
+    :param column: a column
+    :return: str
+    """
+    if isinstance(column, Column):
+        return column.table.name + '.' + column.name
+
+    return getattr(column, 'name', None) or str(column)
+
+
+def names_to_columns(column_names, tables: list):
     """
     Converts column names to columns. If column_names is None then we assume all columns are wanted.
 
     :param column_names: list of column_name strings, can be None.
-    :param table: The main table.
-    :param join_table: The table we are joining on, can be None.
+    :param tables: The main table followed by the joined tables.
     :return: list of SqlAlchemy column objects.
     """
     if not column_names:
-        columns = table.columns.values()
-
-        if join_table is not None:
-            columns = columns + join_table.columns.values()
-
-        return columns
+        return list(chain.from_iterable(table.columns.values() for table in tables))
 
     columns = []
 
     for column_name in column_names:
-        column = get_column(column_name, [table, join_table])
+        column = get_column(column_name, tables)
 
         if column is not None:
             columns.append(column)
@@ -150,7 +178,47 @@ def names_to_columns(column_names, table: Table, join_table: Table):
     return columns
 
 
-def apply_column_filters(query, table: Table, join_table: Table, filters: ComplexFilter):
+def format_rows(rows, columns: list, format_as_list: bool, width: int = None):
+    """
+    Formats result rows for the query API.
+
+    :param rows: An iterable of SQLAlchemy result rows.
+    :param columns: The columns that were selected.
+    :param format_as_list: If true rows are returned as is, otherwise each row is converted to a dict keyed on the
+    full (table_name.column_name) column name.
+    :param width: If set, only the first width values of each row are kept. Used to drop the keyset columns.
+    :return: generator of rows.
+    """
+    if format_as_list:
+        if width is None:
+            # SQLalchemy is giving us the data in the correct format
+            yield from rows
+        else:
+            for row in rows:
+                yield list(row)[:width]
+        return
+
+    column_name_map = None
+
+    for row in rows:
+        # Make friendlier names if possible
+        if column_name_map is None:
+            column_name_map = {}
+
+            for column, column_label in zip(columns, row.keys()):
+                if isinstance(column, Column):
+                    full_column_name = column.table.name + '.' + column.name
+                    column_name_map[column_label] = full_column_name
+
+        items = row.items() if width is None else list(row.items())[:width]
+        yield {column_name_map.get(key, key): val for key, val in items}
+
+
+def filter_param_name(idx: int):
+    return 'filter_{}'.format(idx)
+
+
+def apply_column_filters(query, tables: list, filters: ComplexFilter, names=None):
     """
     Apply the ColumnFilters from the filters object to the query.
 
@@ -162,91 +230,179 @@ def apply_column_filters(query, table: Table, join_table: Table, filters: Comple
         - Filter sets between columns should be AND'ed.
 
     :param query: SQLAlchemy Select object.
-    :param table: SQLAlchemy Table object.
-    :param join_table: SQLAlchemy Table object.
+    :param tables: The main table followed by the joined tables.
     :param filters: The filters dict from db_controller.parse_filters: in form of column_name -> filters list
-    :return: A SQLAlchemy select object with filters applied.
+    :param names: An optional iterator of bind parameter names for the filter values.
+    :return: A SQLAlchemy select object with filters applied, and the filter expression (None if no filter applies).
     """
 
-    expression = filters.get_expression([table, join_table])
+    expression = filters.get_expression(tables, names)
     if expression is not None:
         query = query.where(expression)
 
-    return query
+    return query, expression
 
 
-def apply_column_sorts(query, table: Table, join_table: Table, sorts: dict):
+def normalize_query_filters(tables: list, quargs: 'QueryArguments'):
     """
-    Adds sorts to a query object.
+    Returns the query arguments with their filter tree simplified, see filter_normalization.normalize_filters. If the
+    filters contradict each other the filters are a FalseFilter, and the query can't match any rows.
 
-    :param query: A SQLAlchemy select object.
-    :param table: The Table we are joining from.
-    :param join_table: The Table we are joining to.
+    :param tables: The main table followed by the joined tables.
+    :param quargs: QueryArguments
+    :return: QueryArguments
+    """
+    if quargs.filters is None:
+        return quargs
+
+    return quargs._replace(filters=normalize_filters(quargs.filters, tables))
+
+
+def matches_nothing(quargs: 'QueryArguments'):
+    return isinstance(quargs.filters, FalseFilter)
+
+
+def get_sort_columns(tables: list, sorts: list):
+    """
+    Resolves ColumnSort objects to columns. Sorts without a table name are assumed to be on the main table.
+
+    :param tables: The main table followed by the joined tables.
     :param sorts: List of ColumnSort objects.
-    :return: A SQLAlchemy select object modified to with sorts.
+    :return: List of (column, direction) tuples.
     """
+    sort_columns = []
+
     for sort in sorts:
-        if sort.table_name == table.name:
-            column = table.columns.get(sort.column_name, None)
-        elif join_table is not None and sort.table_name == join_table.name:
-            column = join_table.columns.get(sort.column_name, None)
+        column = None
+        table_name = sort.table_name or tables[0].name
 
-        if column is not None:
-            if sort.direction == 'asc':
-                query = query.order_by(asc(column))
+        for table in tables:
+            if table.name == table_name:
+                column = table.columns.get(sort.column_name, None)
 
-            if sort.direction == 'desc':
-                query = query.order_by(desc(column))
+        if column is not None and sort.direction in SORT_DIRECTIONS:
+            sort_columns.append((column, sort.direction))
+
+    return sort_columns
 
-    return query
 
-def apply_group_by(query, table: Table, join_table: Table, group_by: list):
+def apply_column_sorts(query, tables: list, sorts: dict):
     """
     Adds sorts to a query object.
 
     :param query: A SQLAlchemy select object.
-    :param table: The Table we are joining from.
-    :param join_table: The Table we are joining to.
+    :param tables: The main table followed by the joined tables.
     :param sorts: List of ColumnSort objects.
     :return: A SQLAlchemy select object modified to with sorts.
     """
-    for group in group_by:
-        column = get_column(group, [table, join_table])
+    for column, direction in get_sort_columns(tables, sorts):
+        if direction == 'asc':
+            query = query.order_by(asc(column))
 
-        if column is not None:
-            query = query.group_by(column)
+        if direction == 'desc':
+            query = query.order_by(desc(column))
 
     return query
 
 
-def apply_join(query: Select, table: Table, join_table: Table, join: TableJoin):
+def get_order_columns(tables: list, quargs: 'QueryArguments', outer_join: bool):
+    """
+    Returns the columns that uniquely identify the position of a row in the sort order of a query, i.e. the sort
+    columns followed by the primary key(s).
+
+    :param tables: The main table followed by the tables that are joined in the query.
+    :param quargs: QueryArguments
+    :param outer_join: True if the query has an outer join.
+    :return: List of (column, direction) tuples, or None if the rows of this query can't be ordered uniquely.
+    """
+    if quargs.group_by or outer_join:
+        return None
+
+    if any(len(t.primary_key.columns) == 0 for t in tables):
+        return None
+
+    keys = get_sort_columns(tables, quargs.sorts or [])
+    direction = keys[-1][1] if keys else 'asc'
+
+    for pk_table in tables:
+        for column in pk_table.primary_key.columns:
+            if not any(column is key for key, _ in keys):
+                keys.append((column, direction))
+
+    return keys
+
+
+def get_keyset_columns(tables: list, quargs: 'QueryArguments', outer_join: bool):
+    """
+    Returns the order columns of a query (see get_order_columns) if they can be used for keyset (seek) pagination.
+
+    Comparisons with NULL are never true, so seeking past a token would skip the rows with NULL sort values. Queries
+    sorted on nullable columns are paged with OFFSET instead.
+
+    :param tables: The main table followed by the tables that are joined in the query.
+    :param quargs: QueryArguments
+    :param outer_join: True if the query has an outer join.
+    :return: List of (column, direction) tuples, or None if keyset pagination is not possible for this query.
     """
-    Performs a inner or outer join between two tables on a given query object.
+    keys = get_order_columns(tables, quargs, outer_join)
+
+    if keys is None or any(column.nullable for column, _ in keys):
+        return None
+
+    return keys
+
+
+def get_group_columns(tables: list, group_by: list):
+    """
+    Resolves group_by column names to columns, ignoring names that don't resolve.
+
+    :param tables: The main table followed by the joined tables.
+    :param group_by: List of ColumnFunction objects.
+    :return: List of SQLAlchemy column objects.
+    """
+    group_columns = []
+
+    for group in group_by:
+        column = get_column(group, tables)
 
-    TODO: enable multiple joins
+        if column is not None:
+            group_columns.append(column)
+
+    return group_columns
+
+
+def apply_group_by(query, tables: list, group_by: list):
+    """
+    Adds a group by to a query object.
 
     :param query: A SQLAlchemy select object.
-    :param table: The Table we are joining from.
-    :param join_table: The Table we are joining to.
-    :param join: The Join object describing how to join the tables.
-    :return: A SQLAlchemy select object modified to join two tables.
+    :param tables: The main table followed by the joined tables.
+    :param group_by: List of ColumnFunction objects.
+    :return: A SQLAlchemy select object modified with the group by.
     """
-    error_msg = 'Invalid join, "{}" is not a column on table "{}"'
-    join_conditions = []
+    for column in get_group_columns(tables, group_by):
+        query = query.group_by(column)
+
+    return query
 
-    for column_pair in join.column_pairs:
-        from_col = table.columns.get(column_pair.from_column)
-        to_col = join_table.columns.get(column_pair.to_column)
 
-        if from_col is None:
-            raise ValueError(error_msg.format(column_pair.from_column, table.name))
+def plan_query_joins(table: Table, join_tables: list, quargs: 'QueryArguments', clauses: list):
+    """
+    Plans the joins of a query (see joins.plan_joins) and drops the ones that are not needed.
 
-        if to_col is None:
-            raise ValueError(error_msg.format(column_pair.to_column, join_table.name))
+    :param table: The main table.
+    :param join_tables: The Table of each join in quargs.joins.
+    :param quargs: QueryArguments
+    :param clauses: Everything the query selects, filters, sorts and groups on, used to find the joined tables that are
+    used.
+    :return: list of PlannedJoin
+    """
+    if not quargs.joins:
+        return []
 
-        join_conditions.append(from_col == to_col)
+    planned = plan_joins(table, quargs.joins, join_tables)
 
-    return query.select_from(table.join(join_table, onclause=and_(*join_conditions), isouter=join.outer_join))
+    return prune_joins(planned, referenced_tables(clauses))
 
 
 class DBService:
@@ -254,104 +410,865 @@ class DBService:
     TODO:
         - Add methods for saving table queries
     """
-    def __init__(self, db_config):
+    def __init__(self, db_config, cache_config=None, rollup_configs=None, replica_configs=None):
         self.meta = MetaData()
         self.db = init_database(db_config)
-        self._reflect_database()
-
-    def _reflect_database(self):
+        self.replicas = replicas.init_replicas(self.db, db_config, replica_configs, init_database)
+        self.replica_checker = None
+        self.cache = init_cache(cache_config)
+        self.statements = StatementCache(db_config.getint('statement_cache_size', DEFAULT_STATEMENT_CACHE_SIZE))
+        self.counts = MemoryCache()
+        self.in_flight = None
+        self.statement_timeout = db_config.getfloat('statement_timeout', cancellation.DEFAULT_STATEMENT_TIMEOUT)
+        self.table_statement_timeouts = cancellation.parse_table_timeouts(db_config.get('table_statement_timeouts', ''))
+        self.watchdog = cancellation.QueryWatchdog()
+        self.watchdog.start()
+        self.admission = admission.init_admission(db_config, self.db.dialect.name)
+        self.count_cache_ttl = db_config.getint('count_cache_ttl', row_counts.DEFAULT_COUNT_CACHE_TTL)
+        self.exact_count_threshold = db_config.getint('exact_count_threshold',
+                                                      row_counts.DEFAULT_EXACT_COUNT_THRESHOLD)
+        self.slow_query_threshold = db_config.getint('slow_query_threshold', timing.DEFAULT_SLOW_QUERY_THRESHOLD)
+        self.value_list_threshold = db_config.getint('value_list_threshold', value_lists.DEFAULT_VALUE_LIST_THRESHOLD)
+
+        if db_config.getboolean('coalesce_queries', True):
+            # A query cancelled because its client went away is run again for the clients still waiting on it.
+            self.in_flight = SingleFlight(retry_errors=(QueryCancelledError,))
+
+        self._reflect_lock = threading.RLock()
+        self._fingerprints = None
+        self.schema_version = 0
+        self._table_dicts = {}
+        self._tables_dict = None
+        self._snapshot_dirty = False
+        self._snapshot_timer = None
+        self.snapshot_path = db_config.get('schema_snapshot', None)
+        self.schema_refresher = None
+        self._reflect_database(db_config.getint('schema_refresh_interval', schema.DEFAULT_REFRESH_INTERVAL))
+        self.rollups = rollups.init_rollups(rollup_configs)
+        self.rollup_refresher = None
+
+        if self.rollups:
+            self.rollup_refresher = rollups.RollupRefresher(self, self.rollups)
+            self.rollup_refresher.start()
+
+        if self.replicas is not None:
+            self.replica_checker = replicas.ReplicaChecker(self.replicas)
+            self.replica_checker.start()
+
+    def _reflect_database(self, refresh_interval: int):
         """
-        This method reflects the database and also instantiates an Inspector.
+        This method instantiates an Inspector and lists the tables in the database. Tables are reflected lazily, the
+        first time they are used (see _get_table), or loaded from the schema snapshot if one is configured and still
+        matches the database. If refresh_interval is greater than zero a background thread checks for schema changes
+        every refresh_interval seconds.
         :return:
         """
-        self.meta.reflect(bind=self.db)
         self.inspector = reflection.Inspector.from_engine(self.db)
 
+        if refresh_interval > 0 or self.snapshot_path:
+            with self.db.connect() as conn:
+                self._fingerprints = schema.table_fingerprints(conn)
+
+            self.table_names = set(self._fingerprints)
+        else:
+            self.table_names = set(self.inspector.get_table_names())
+
+        if self.snapshot_path:
+            meta = schema.load_snapshot(self.snapshot_path, self._fingerprints, repr(self.db.url))
+
+            if meta is not None:
+                self.meta = meta
+
+        if refresh_interval > 0:
+            self.schema_refresher = schema.SchemaRefresher(self, refresh_interval)
+            self.schema_refresher.start()
+
+    def _mark_schema_dirty(self):
+        """
+        Records that the reflected schema changed since the snapshot was saved. Without a background refresher to save
+        it later, a timer saves the snapshot schema.SNAPSHOT_SAVE_DELAY seconds later, so the tables reflected in the
+        meantime are saved at once instead of one snapshot being written per table.
+        """
+        self._snapshot_dirty = True
+
+        if self.snapshot_path and self.schema_refresher is None and self._snapshot_timer is None:
+            self._snapshot_timer = threading.Timer(schema.SNAPSHOT_SAVE_DELAY, self._save_delayed_snapshot)
+            self._snapshot_timer.start()
+
+    def _save_delayed_snapshot(self):
+        # Tables reflected from now on start a new timer.
+        self._snapshot_timer = None
+
+        try:
+            self.save_schema_snapshot()
+        except Exception:  # pylint: disable=broad-except
+            log.exception('Saving schema snapshot %s failed', self.snapshot_path)
+
+    def save_schema_snapshot(self):
+        """
+        Saves the reflected schema to the snapshot file, if a snapshot is configured and the schema changed since it was
+        last saved.
+        """
+        if not self.snapshot_path or not self._snapshot_dirty:
+            return
+
+        with self._reflect_lock:
+            self._snapshot_dirty = False
+            schema.save_snapshot(self.snapshot_path, self.meta, self._fingerprints, repr(self.db.url))
+
+        log.debug('Saved schema snapshot %s', self.snapshot_path)
+
+    def refresh_schema(self):
+        """
+        Compares the current table fingerprints with the ones from the last refresh. Tables that were changed or dropped
+        are removed from the MetaData so they are reflected again on their next use, and new tables become available.
+        Queries that are already running keep using the Table objects they started with.
+
+        :return: set of names of the tables that were added, changed, or dropped.
+        """
+        with self.db.connect() as conn:
+            fingerprints = schema.table_fingerprints(conn)
+
+        previous = self._fingerprints or {}
+        changed = {name for name in set(previous) | set(fingerprints) if previous.get(name) != fingerprints.get(name)}
+
+        if changed:
+            with self._reflect_lock:
+                schema.remove_tables(self.meta, changed)
+                self.table_names = set(fingerprints)
+                self._fingerprints = fingerprints
+                self.schema_version += 1
+
+            # Cached statements reference the old Table objects.
+            self.statements.clear()
+            self._mark_schema_dirty()
+
+        return changed
+
+    def _get_table(self, table_name: str):
+        """
+        Returns the Table object for a table, reflecting it if this is the first time it is used.
+
+        :param table_name: The name of the table.
+        :return: SQLAlchemy Table, or None if the table does not exist.
+        """
+        table = self.meta.tables.get(table_name, None)
+
+        if table is not None or table_name not in self.table_names:
+            return table
+
+        with self._reflect_lock:
+            table = self.meta.tables.get(table_name, None)
+
+            if table is None:
+                log.debug('Reflecting table %s', table_name)
+
+                try:
+                    table = Table(table_name, self.meta, autoload=True, autoload_with=self.db)
+                except NoSuchTableError:
+                    return None
+
+                self._mark_schema_dirty()
+
+        return table
+
+    def pool_stats(self):
+        data = pool.pool_stats(self.db)
+
+        if self.replicas is not None:
+            data['replicas'] = self.replicas.stats()
+
+        return data
+
+    def read_connection(self):
+        """
+        Returns a connection for read queries: from a read replica if any are configured (see replicas.ReplicaRouter),
+        otherwise from the primary database. Use it as a context manager.
+        """
+        if self.replicas is not None:
+            return self.replicas.connect()
+
+        return self.db.connect()
+
+    def table_timeout(self, table_name: str):
+        """
+        :return: The statement timeout in seconds for queries on a table, 0 if they have no timeout.
+        """
+        return self.table_statement_timeouts.get(table_name, self.statement_timeout)
+
+    def watch_query(self, conn, table_name: str, disconnected=None, timeout: float = None):
+        """
+        Watches a query on a table for its statement timeout and for the client disconnecting, see
+        cancellation.QueryWatchdog.watch. Use it as a context manager.
+
+        :param conn: SQLAlchemy connection the query runs on.
+        :param table_name: The name of the queried table.
+        :param disconnected: The disconnect check of the request, defaults to the one of the current thread's request.
+        :param timeout: The statement timeout in seconds, defaults to the table's timeout (see table_timeout).
+        """
+        if disconnected is None:
+            disconnected = cancellation.client_disconnected()
+
+        if timeout is None:
+            timeout = self.table_timeout(table_name)
+
+        return self.watchdog.watch(conn, timeout, disconnected)
+
+    def admit_query(self, statement, params: dict):
+        """
+        Checks a query's estimated cost and rows against the admission thresholds, see admission.AdmissionController.
+
+        :return: The estimated cost to pass to admission.slot, None if the query wasn't estimated.
+        :raises QueryRejectedError: If the query is too expensive to run.
+        """
+        if not self.admission.enabled or statement is None:
+            return None
+
+        with self.read_connection() as conn:
+            return self.admission.check(conn, statement, params)
+
+    def refresh_rollup(self, rollup: rollups.Rollup, create_only: bool = False):
+        """
+        Creates and refreshes a rollup, see Rollup.refresh.
+
+        :param rollup: The Rollup to refresh.
+        :param create_only: If True an existing rollup is only checked, not refreshed.
+        """
+        base_table = self._get_table(rollup.table_name)
+
+        if base_table is None:
+            raise NotFoundError('Rollup "{}": table "{}" does not exist'.format(rollup.name, rollup.table_name))
+
+        with self.db.begin() as conn:
+            rollup.refresh(conn, base_table, create_only)
+
+    def _find_rollup(self, table: Table, join_tables: list, quargs: QueryArguments, check_columns: bool = True):
+        """
+        Returns the rollup a query can be answered from, or None (see rollups.find_rollup).
+        """
+        if not self.rollups or join_tables:
+            return None
+
+        rollup = rollups.find_rollup(self.rollups, table, quargs, check_columns)
+
+        if rollup is not None:
+            log.debug('Answering query on table %s from rollup %s', table.name, rollup.name)
+
+        return rollup
+
+    def _table_to_dict(self, table: Table):
+        """
+        Returns table_to_dict(table), built once per Table object. The same dict is returned on every call, so it must
+        not be modified.
+        """
+        entry = self._table_dicts.get(table.key, None)
+
+        if entry is None or entry[0] is not table:
+            entry = (table, table_to_dict(table))
+            self._table_dicts[table.key] = entry
+
+        return entry[1]
+
     def get_tables(self):
+        """
+        Returns the dicts of all tables, grouped by schema. The result is built once per schema_version, and must not
+        be modified.
+
+        :return: dict of schema_name -> {table_name -> table dict}
+        """
+        version = self.schema_version
+        cached = self._tables_dict
+
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
         schemas = {}
 
-        for table in self.meta.sorted_tables:
-            schema = table.schema
+        for table_name in sorted(self.table_names):
+            table = self._get_table(table_name)
+
+            if table is None:
+                continue
+
+            schema_name = table.schema
 
-            if schema not in schemas:
-                schemas[schema] = {}
+            if schema_name not in schemas:
+                schemas[schema_name] = {}
 
-            schemas[schema][table.name] = table_to_dict(table)
+            schemas[schema_name][table.name] = self._table_to_dict(table)
+
+        self._tables_dict = (version, schemas)
 
         return schemas
 
     def get_table(self, table_name):
-        table = self.meta.tables.get(table_name, None)
+        table = self._get_table(table_name)
 
         if table is None:
             raise NotFoundError('Table "{}" does exist'.format(table_name))
 
-        return table_to_dict(table)
+        return self._table_to_dict(table)
 
-    def query_table(self, table_name: str, quargs: QueryArguments):  # pylint: disable=too-many-branches, too-many-statements, too-many-locals
+    def _get_query_tables(self, table_name: str, joins: list):
+        """
+        Looks up the main table and the join tables (if any) for a query.
 
-        table = self.meta.tables.get(table_name, None)
-        join_table = None
+        :param table_name: The name of the main table.
+        :param joins: List of TableJoin objects, can be None.
+        :return: table, join_tables. join_tables has the Table of each join, in order.
+        """
+        table = self._get_table(table_name)
+        join_tables = []
 
-        if quargs.join is not None:
-            join_table = self.meta.tables.get(quargs.join.table_name, None)
+        if table is None:
+            raise NotFoundError('Table "{}" does exist'.format(table_name))
 
-        rows = []
+        for join in joins or []:
+            join_table = self._get_table(join.table_name)
 
-        if table is None:
-            raise NotFoundError('Table "{}" does exist'.format(quargs.table_name))
+            if join_table is None:
+                raise JoinError('Invalid join. Table with name "{}" does not exist.'.format(join.table_name))
+
+            if join_table is table or join_table in join_tables:
+                raise JoinError('Invalid join. Table "{}" can only be used once in a query.'.format(join.table_name))
+
+            join_tables.append(join_table)
+
+        return table, join_tables
+
+    def _prepare_filters(self, tables: list, quargs: QueryArguments):
+        """
+        Normalizes the filters of a query (see normalize_query_filters) and replaces long IN lists by value lists (see
+        value_lists.use_value_lists).
+
+        :param tables: The main table followed by the joined tables.
+        :param quargs: QueryArguments
+        :return: QueryArguments
+        """
+        quargs = normalize_query_filters(tables, quargs)
 
-        if quargs.join is not None and join_table is None:
-            raise JoinError('Invalid join. Table with name "{}" does not exist.'.format(quargs.join.table_name))
+        if quargs.filters is None or matches_nothing(quargs):
+            return quargs
 
-        columns = names_to_columns(quargs.column_names, table, join_table)
+        filters = value_lists.use_value_lists(quargs.filters, self.db.dialect.name, self.value_list_threshold)
+
+        return quargs._replace(filters=filters)
+
+    def _get_chart_column(self, column_func: ColumnFunction, tables: list, numeric: bool = False):
+        column = get_column(column_func, tables)
+
+        if not isinstance(column, Column):
+            raise ValueError('Invalid column "{}"'.format(column_func.column_name))
+
+        if numeric:
+            try:
+                is_numeric = issubclass(column.type.python_type, numbers.Number)
+            except NotImplementedError:
+                is_numeric = False
+
+            if not is_numeric:
+                raise ValueError('Column "{}" is not numeric'.format(column.name))
+
+        return column
+
+    def _chart_source(self, columns: list, table: Table, join_tables: list, quargs: QueryArguments):
+        """
+        Builds the filtered and joined query that chart stats are computed from. The filters must be prepared, see
+        _prepare_filters.
+        """
+        query = select(columns)
+        where = None
+
+        if quargs.filters is not None:
+            query, where = apply_column_filters(query, [table] + join_tables, quargs.filters)
+
+        planned = plan_query_joins(table, join_tables, quargs, columns + [where])
+        query = apply_joins(query, table, planned)
+
+        return query.alias('source')
+
+    def box_plot(self, table_name: str, quargs: QueryArguments, value_column: ColumnFunction,
+                 group_column: ColumnFunction = None, max_outliers: int = chart_data.DEFAULT_MAX_OUTLIERS):  # pylint: disable=too-many-arguments
+        """
+        Computes box plot stats for value_column, grouped by group_column, without fetching the rows of the table.
+
+        :param table_name: The name of the table to query.
+        :param quargs: QueryArguments, only the filters and join are used.
+        :param value_column: The numeric column to compute stats for.
+        :param group_column: The column to group by, can be None.
+        :param max_outliers: The maximum number of outliers to return per group.
+        :return: dict with per group stats as "rows", and the overall "min" and "max".
+        """
+        table, join_tables = self._get_query_tables(table_name, quargs.joins)
+        tables = [table] + join_tables
+        value = self._get_chart_column(value_column, tables, numeric=True)
+        group = null()
+
+        if group_column is not None:
+            group = self._get_chart_column(group_column, tables)
+
+        quargs = self._prepare_filters(tables, quargs)
+        source = self._chart_source([group.label('grp'), value.label('value')], table, join_tables, quargs)
+
+        with self.read_connection() as conn, value_lists.loaded(conn, value_lists.value_tables(quargs.filters)), \
+                self.watch_query(conn, table_name) as running, running.statement():
+            data = chart_data.box_plot_stats(conn, source, max_outliers)
+
+        if group_column is None:
+            for row in data['rows']:
+                row['name'] = table.name
+
+        return data
+
+    def scatter_plot(self, table_name: str, quargs: QueryArguments, x_column: ColumnFunction, y_column: ColumnFunction,
+                     color_column: ColumnFunction = None, max_points: int = chart_data.DEFAULT_MAX_POINTS,
+                     grid_size: int = chart_data.DEFAULT_GRID_SIZE):  # pylint: disable=too-many-arguments, too-many-locals
+        """
+        Returns the (possibly downsampled) points of a scatter plot of x_column against y_column.
+
+        :param table_name: The name of the table to query.
+        :param quargs: QueryArguments, only the filters and join are used.
+        :param x_column: The numeric column for the x axis.
+        :param y_column: The numeric column for the y axis.
+        :param color_column: The discrete column used to color points, can be None.
+        :param max_points: The number of rows above which points are downsampled.
+        :param grid_size: The number of grid cells along each axis when downsampling.
+        :return: dict with "points", "xDomain", "yDomain", "total", and "sampled".
+        """
+        table, join_tables = self._get_query_tables(table_name, quargs.joins)
+        tables = [table] + join_tables
+        x = self._get_chart_column(x_column, tables, numeric=True)
+        y = self._get_chart_column(y_column, tables, numeric=True)
+        color = null()
+        color_key = None
+
+        if color_column is not None:
+            color = self._get_chart_column(color_column, tables)
+            color_key = color.table.name + '.' + color.name
+
+        keys = (x.table.name + '.' + x.name, y.table.name + '.' + y.name, color_key)
+        quargs = self._prepare_filters(tables, quargs)
+        source = self._chart_source([x.label('x'), y.label('y'), color.label('color')], table, join_tables, quargs)
+
+        with self.read_connection() as conn, value_lists.loaded(conn, value_lists.value_tables(quargs.filters)), \
+                self.watch_query(conn, table_name) as running, running.statement():
+            return chart_data.scatter_points(conn, source, keys, max_points, grid_size)
+
+    def _build_query(self, table_name: str, quargs: QueryArguments, rollup: rollups.Rollup = None):  # pylint: disable=too-many-branches,too-many-locals
+        """
+        Builds the select for a table query.
+
+        If a rollup is given (it must be able to answer the query, see Rollup.can_answer) the query reads from the
+        rollup instead of the table, and the returned columns are still the table's columns.
+
+        Paged queries that can be uniquely ordered (see get_order_columns) are ordered by their order columns. If these
+        can be used for keyset pagination (see get_keyset_columns) they are appended to the select so the caller can
+        build the "after" token for the next page. If quargs.after is set the query seeks past that token instead of
+        using OFFSET, so deep pages cost the same as the first page.
+
+        Filter values, the limit, the offset, and the "after" values are bound to named parameters (see
+        _get_query_params), so the compiled statement can be reused for queries with the same shape.
+
+        :param table_name: The name of the table to query.
+        :param quargs: QueryArguments
+        :param rollup: An optional Rollup to read from.
+        :return: query, columns, keys. query is None if no valid columns were selected, keys is a list of
+        (column, direction) tuples appended to the select, or None.
+        """
+        table, join_tables = self._get_query_tables(table_name, quargs.joins)
+        columns = names_to_columns(quargs.column_names, [table] + join_tables)
+        select_columns = columns
+        keys = None
 
         if len(columns) == 0:
-            return [], []
+            return None, [], None
+
+        if rollup is not None:
+            base_table, table = table, rollup.source(table)
+            select_columns = rollup.rewrite_columns(table, quargs.column_names, columns, base_table)
+
+        tables = [table] + join_tables
+        query = select(select_columns).apply_labels()
+        where = None
+
+        if quargs.filters is not None:
+            names = (filter_param_name(idx) for idx in count())
+            query, where = apply_column_filters(query, tables, quargs.filters, names)
+
+        sort_columns = [column for column, _ in get_sort_columns(tables, quargs.sorts or [])]
+        group_columns = get_group_columns(tables, quargs.group_by or [])
+        planned = plan_query_joins(table, join_tables, quargs,
+                                   select_columns + sort_columns + group_columns + [where])
+
+        order = None
+
+        if quargs.per_page > -1 or quargs.after is not None:
+            query_tables = [table] + [join.table for join in planned]
+            outer_join = any(join.outer_join for join in planned)
+            order = get_order_columns(query_tables, quargs, outer_join)
+            keys = get_keyset_columns(query_tables, quargs, outer_join)
+
+        if quargs.after is not None:
+            if keys is None:
+                raise ValueError('Keyset pagination is not supported for this query')
+
+            key_columns = [column for column, _ in keys]
+            key_names = [column.table.name + '.' + column.name for column in key_columns]
+            values = keyset.decode_token(quargs.after, key_names)
+            query = query.where(keyset.seek_condition(key_columns, [d for _, d in keys], values))
+
+            if quargs.per_page > -1:
+                query = query.limit(bindparam('limit', quargs.per_page, type_=Integer))
+        elif quargs.per_page > -1:
+            query = query.limit(bindparam('limit', quargs.per_page, type_=Integer))
+            query = query.offset(bindparam('offset', quargs.page * quargs.per_page, type_=Integer))
+
+        if keys is not None:
+            for idx, (column, direction) in enumerate(keys):
+                query = query.column(column.label('_key_{}'.format(idx)))
+                query = query.order_by(asc(column) if direction == 'asc' else desc(column))
+        elif order is not None:
+            # Pages that use OFFSET still need a unique order, or rows with equal sort values can move between pages.
+            for column, direction in order:
+                query = query.order_by(asc(column) if direction == 'asc' else desc(column))
+        elif quargs.sorts is not None:
+            query = apply_column_sorts(query, tables, quargs.sorts)
+
+        query = apply_joins(query, table, planned)
+
+        if quargs.group_by is not None:
+            query = apply_group_by(query, tables, quargs.group_by)
 
-        query = select(columns).apply_labels()
+        return query, columns, keys
+
+    def _get_query_params(self, tables: list, quargs: QueryArguments):
+        """
+        Extracts the values _build_query binds to named parameters, without building the query.
+
+        :return: shape, params. shape describes everything about the query except its parameter values, so queries with
+        equal shapes compile to the same statement.
+        """
+        filter_shape = None
+        params = {}
+
+        if quargs.filters is not None:
+            filter_shape, filter_values = quargs.filters.get_bind_values(tables)
+            params = {filter_param_name(idx): value for idx, value in enumerate(filter_values)}
 
         if quargs.per_page > -1:
-            query = query.limit(quargs.per_page).offset(quargs.page * quargs.per_page)
+            params['limit'] = quargs.per_page
+
+            if quargs.after is None:
+                params['offset'] = quargs.page * quargs.per_page
+
+        joins = tuple((join.table_name, tuple(join.column_pairs), join.outer_join) for join in quargs.joins or [])
+        shape = (tables[0].name, tuple(quargs.column_names or []), quargs.per_page > -1, quargs.after is not None,
+                 filter_shape, tuple(quargs.sorts or []), joins, tuple(quargs.group_by or []))
+
+        return shape, params
+
+    def _prepare_query(self, table_name: str, quargs: QueryArguments):
+        """
+        Returns the compiled statement for a query and the parameters to execute it with. Compiled statements are
+        cached by query shape, so queries that only differ in filter values, page, or "after" token skip building and
+        compiling the SQLAlchemy expression. Queries a rollup can answer are read from the rollup.
+
+        The filters are prepared first (see _prepare_filters). If they contradict each other there is nothing to
+        execute, and the statement is None.
+
+        :param table_name: The name of the table to query.
+        :param quargs: QueryArguments
+        :return: statement, params, columns, keys, value_filters. statement is None if no valid columns were selected,
+        or if the query can't match any rows. value_filters are the ValueListFilters whose temporary tables must be
+        loaded on the connection the statement is executed on (see value_lists.loaded).
+        """
+        table, join_tables = self._get_query_tables(table_name, quargs.joins)
+        quargs = self._prepare_filters([table] + join_tables, quargs)
+
+        if matches_nothing(quargs):
+            timing.annotate(contradiction=True)
+            return None, {}, names_to_columns(quargs.column_names, [table] + join_tables), None, []
+
+        rollup = self._find_rollup(table, join_tables, quargs)
+        shape, params = self._get_query_params([table] + join_tables, quargs)
+        shape += (rollup.name if rollup is not None else None,)
+        entry = self.statements.get(shape)
+
+        if entry is None:
+            with timing.stage('build'):
+                query, columns, keys = self._build_query(table_name, quargs, rollup)
+
+            with timing.stage('compile'):
+                statement = query.compile(dialect=self.db.dialect) if query is not None else None
+
+            entry = (statement, columns, keys)
+            self.statements.set(shape, entry)
+
+        statement, columns, keys = entry
+
+        if quargs.after is not None and keys is not None:
+            key_names = [column.table.name + '.' + column.name for column, _ in keys]
+            values = keyset.decode_token(quargs.after, key_names)
+            params.update({keyset.seek_param_name(idx): value for idx, value in enumerate(values)})
+
+        if statement is not None:
+            timing.annotate(sql=str(statement), params=params, rollup=rollup.name if rollup is not None else None)
+
+        return statement, params, columns, keys, value_lists.value_tables(quargs.filters)
+
+    def count_table(self, table_name: str, quargs: QueryArguments):
+        """
+        Counts the rows matched by the filters and join of a query, or the number of groups if the query has a group_by.
+
+        Tables with fewer than exact_count_threshold rows (according to the planner's statistics) are counted exactly.
+        On bigger tables the count is estimated: from the table statistics if the query has no filters or join,
+        otherwise by EXPLAINing the query. Counts are cached for count_cache_ttl seconds. Groups are counted on a rollup
+        if one can answer the query. Queries whose filters contradict each other are counted as 0 without a query.
+
+        :param table_name: The name of the table to count.
+        :param quargs: QueryArguments, only the filters, join and group_by are used.
+        :return: dict with "count" and "exact", a boolean that is false if the count is an estimate.
+        """
+        table, join_tables = self._get_query_tables(table_name, quargs.joins)
+        quargs = quargs._replace(column_names=None, page=0, per_page=-1, sorts=None, format_as_list=False, after=None)
+        quargs = self._prepare_filters([table] + join_tables, quargs)
+
+        if matches_nothing(quargs):
+            timing.annotate(contradiction=True)
+            return {'count': 0, 'exact': True}
+
+        key = query_cache_key(table_name, quargs, self.schema_version)
+        data = self.counts.get(key)
+
+        if data is not None:
+            return data
+
+        rollup = self._find_rollup(table, join_tables, quargs, check_columns=False)
+        counted_table = table
+
+        if rollup is not None:
+            counted_table = rollup.table(table)
+            table = rollup.source(table)
+
+        tables = [table] + join_tables
+        query = select([null().label('row')]).select_from(table)
+        where = None
 
         if quargs.filters is not None:
-            query = apply_column_filters(query, table, join_table, quargs.filters)
+            query, where = apply_column_filters(query, tables, quargs.filters)
 
-        if quargs.sorts is not None:
-            query = apply_column_sorts(query, table, join_table, quargs.sorts)
+        group_columns = get_group_columns(tables, quargs.group_by or [])
+        planned = plan_query_joins(table, join_tables, quargs, group_columns + [where])
+        query = apply_joins(query, table, planned)
 
-        if quargs.join is not None:
-            query = apply_join(query, table, join_table, quargs.join)
+        if quargs.group_by:
+            query = apply_group_by(query, tables, quargs.group_by)
 
-        if quargs.group_by is not None:
-            query = apply_group_by(query, table, join_table, quargs.group_by)
+        with self.read_connection() as conn, value_lists.loaded(conn, value_lists.value_tables(quargs.filters)), \
+                self.watch_query(conn, table_name) as running, running.statement(), timing.stage('count'):
+            timing.annotate(sql=str(query))
+            count = None
+            table_rows = row_counts.table_row_estimate(conn, counted_table)
 
-        with self.db.connect() as conn:
-            log.debug("Query %s", query)
-            result = conn.execute(query)
-
-            if quargs.format_as_list:
-                # SQLalchemy is giving us the data in the correct format
-                rows = result
-            else:
-                column_name_map = {}
-                first_row = True
-                for row in result:
-                    # Make friendlier names if possible
-                    if first_row:
-                        for column, column_label in zip(columns, row.keys()):
-                            if isinstance(column, Column):
-                                full_column_name = column.table.name + '.' + column.name
-                                column_name_map[column_label] = full_column_name
-                        first_row = False
-
-                    data = {column_name_map.get(key, key): val for key, val in row.items()}
-                    rows.append(data)
+            if table_rows is not None and table_rows >= self.exact_count_threshold:
+                if where is None and not planned and not quargs.group_by:
+                    count = table_rows
+                else:
+                    count = row_counts.explain_row_estimate(conn, query)
+
+            data = {'count': count, 'exact': count is None}
+
+            if count is None:
+                data['count'] = row_counts.exact_count(conn, query)
+
+        self.counts.set(key, data, self.count_cache_ttl)
+
+        return data
+
+    def query_table(self, table_name: str, quargs: QueryArguments):
+        """
+        Queries a table. If a cache is configured, results are served from and saved to the cache.
+
+        Unless coalesce_queries is disabled, identical queries (see query_cache_key) that arrive while the query runs
+        wait for it and share its result or error, instead of running the same query again (see SingleFlight).
+
+        :param table_name: The name of the table to query.
+        :param quargs: QueryArguments
+        :return: rows, column_data, next_after. next_after is the token for the next page, or None if there is no next
+        page or keyset pagination is not possible for this query.
+        """
+        # Read once, so a result is cached for the schema version it was read with, not one set while it ran.
+        schema_version = self.schema_version
+
+        if self.cache is not None:
+            with timing.stage('cache'):
+                result = self.cache.get(table_name, quargs, schema_version)
+
+            timing.annotate(cached=result is not None)
+
+            if result is not None:
+                return result
+
+        if self.in_flight is None:
+            return self._execute_query(table_name, quargs, schema_version)
+
+        key = query_cache_key(table_name, quargs, schema_version)
+        result, shared = self.in_flight.do(key, lambda: self._execute_query(table_name, quargs, schema_version))
+
+        if shared:
+            timing.annotate(coalesced=True, rows=len(result[0]))
+
+        return result
 
+    def _execute_query(self, table_name: str, quargs: QueryArguments, schema_version: int):
+        result = self._query_table(table_name, quargs)
+
+        if self.cache is not None:
+            with timing.stage('cache'):
+                self.cache.set(table_name, quargs, result, schema_version)
+
+        return result
+
+    def _query_table(self, table_name: str, quargs: QueryArguments):
+        statement, params, columns, keys, value_filters = self._prepare_query(table_name, quargs)
+        next_after = None
+        width = None
+
+        if statement is None:
+            return [], [column_to_dict(column) for column in columns], None
+
+        cost = self.admit_query(statement, params)
+
+        with self.admission.slot(cost), self.read_connection() as conn, value_lists.loaded(conn, value_filters), \
+                self.watch_query(conn, table_name) as running:
+            log.debug("Query %s %s", statement, params)
+
+            with timing.stage('execute'), running.statement():
+                cursor = conn.execute(statement, params)
+
+            with timing.stage('fetch'), running.statement():
+                result = cursor.fetchall()
+
+        timing.annotate(rows=len(result))
+
+        if keys is not None:
+            width = len(columns)
+
+            if result and len(result) == quargs.per_page:
+                key_names = [column.table.name + '.' + column.name for column, _ in keys]
+                next_after = keyset.encode_token(key_names, list(result[-1])[width:])
+
+        with timing.stage('format'):
+            rows = list(format_rows(result, columns, quargs.format_as_list, width))
+            column_data = [column_to_dict(column) for column in columns]
+
+        return rows, column_data, next_after
+
+    def stream_table(self, table_name: str, quargs: QueryArguments, batch_size: int = STREAM_BATCH_SIZE):
+        """
+        Like query_table, but the rows are returned as a generator that reads from a server side cursor in batches of
+        batch_size rows, so memory use does not grow with the size of the result.
+
+        The query is built and checked by admission control (and any NotFoundError, JoinError or QueryRejectedError
+        raised) before this method returns, but it is not executed until the generator is iterated.
+
+        :param table_name: The name of the table to query.
+        :param quargs: QueryArguments
+        :param batch_size: The number of rows to fetch from the cursor at a time.
+        :return: rows generator, column_data
+        """
+        statement, params, columns, keys, value_filters = self._prepare_query(table_name, quargs)
+        cost = self.admit_query(statement, params)
         column_data = [column_to_dict(column) for column in columns]
+        width = len(columns) if keys is not None else None
+        batches = self._fetch_batches(table_name, statement, params, batch_size, value_filters, cost)
+        rows = format_rows(chain.from_iterable(batches), columns, quargs.format_as_list, width)
 
         return rows, column_data
 
+    def stream_batches(self, table_name: str, quargs: QueryArguments, batch_size: int = STREAM_BATCH_SIZE,
+                       timeout: float = None, disconnected=None, admit: bool = True):  # pylint: disable=too-many-arguments
+        """
+        Like stream_table, but returns the rows in batches of up to batch_size rows, each row being a tuple of values in
+        column order, along with the SQLAlchemy columns so callers can use their types.
+
+        :param table_name: The name of the table to query.
+        :param quargs: QueryArguments
+        :param batch_size: The number of rows to fetch from the cursor at a time.
+        :param timeout: The statement timeout in seconds, defaults to the table's timeout (see table_timeout).
+        :param disconnected: Function that returns True when the query should be cancelled, defaults to the disconnect
+        check of the current thread's request.
+        :param admit: False to skip admission control, for callers that limit how many queries they run themselves.
+        :return: batches generator, list of SQLAlchemy columns
+        """
+        statement, params, columns, keys, value_filters = self._prepare_query(table_name, quargs)
+        cost = self.admit_query(statement, params) if admit else None
+        width = len(columns) if keys is not None else None
+        batches = self._fetch_batches(table_name, statement, params, batch_size, value_filters, cost, timeout,
+                                      disconnected)
+
+        def generate_batches():
+            for batch in batches:
+                yield [tuple(row) if width is None else row[:width] for row in batch]
+
+        return generate_batches(), columns
+
+    def stream_keyed_batches(self, table_name: str, quargs: QueryArguments, batch_size: int = STREAM_BATCH_SIZE,
+                             disconnected=None):
+        """
+        Like stream_batches, but each row keeps the values of the keyset columns (see get_keyset_columns) after the
+        selected columns, and the query is not checked by admission control. Used to spool results, see result_spool.
+
+        :param table_name: The name of the table to query.
+        :param quargs: QueryArguments
+        :param batch_size: The number of rows to fetch from the cursor at a time.
+        :param disconnected: Function that returns True when the query should be cancelled.
+        :return: batches generator, list of SQLAlchemy columns, keys. keys is the list of (column, direction) tuples of
+        the keyset columns, or None if the query has none.
+        """
+        statement, params, columns, keys, value_filters = self._prepare_query(table_name, quargs)
+        batches = self._fetch_batches(table_name, statement, params, batch_size, value_filters,
+                                      disconnected=disconnected)
+
+        return batches, columns, keys
+
+    def _fetch_batches(self, table_name: str, statement, params: dict, batch_size: int, value_filters: list = None,
+                       cost: float = None, timeout: float = None, disconnected=None):  # pylint: disable=too-many-arguments
+        """
+        Executes a statement with a server side cursor and yields the result rows in batches of up to batch_size rows.
+        Nothing runs until the generator is iterated, which is usually after the request returned, so the disconnect
+        check of the request is taken now.
+
+        :param cost: The estimated cost of the statement, see admit_query.
+        :param timeout: The statement timeout, see watch_query.
+        :param disconnected: The disconnect check, defaults to the one of the current thread's request.
+        """
+        if disconnected is None:
+            disconnected = cancellation.client_disconnected()
+
+        def generate_batches():
+            if statement is None:
+                return
+
+            with self.admission.slot(cost), self.read_connection() as conn, \
+                    value_lists.loaded(conn, value_filters or []), \
+                    self.watch_query(conn, table_name, disconnected, timeout) as running:
+                log.debug("Streaming query %s %s", statement, params)
+
+                with running.statement():
+                    result = conn.execution_options(stream_results=True).execute(statement, params)
+
+                while True:
+                    with running.statement():
+                        batch = result.fetchmany(batch_size)
+
+                    if not batch:
+                        return
+
+                    yield batch
+
+        return generate_batches()
+
 if __name__ == '__main__':
     import configparser
     config = configparser.ConfigParser()
@@ -8,3 +8,25 @@ class NotFoundError(Exception):
 
 class JoinError(Exception):
     pass
+
+
+class FilterError(ValueError):
+    pass
+
+
+class QueryTimeoutError(Exception):
+    pass
+
+
+class QueryCancelledError(Exception):
+    pass
+
+
+class QueryRejectedError(Exception):
+    def __init__(self, message: str, retry: bool = False):
+        """
+        :param message: Why the query was rejected, shown to the user.
+        :param retry: True if the same query may be accepted later, False if it has to be narrowed down.
+        """
+        super().__init__(message)
+        self.retry = retry
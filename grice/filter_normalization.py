@@ -0,0 +1,453 @@
+"""
+Simplifies filter trees before they are turned into SQL.
+
+Filters built by the UI are often redundant: the same filter repeated, nested single-child ANDs and ORs, overlapping
+ranges, and long chains of ORed equalities. normalize_filters rewrites a filter tree into an equivalent, smaller one:
+
+- nested groups of the same kind are flattened, and groups with a single child are replaced by the child.
+- identical filters are removed.
+- ANDed filters on a column are intersected: ranges are merged into the tightest range (as a BETWEEN if both ends are
+  inclusive), equalities and IN lists are intersected, and filters made redundant by an equality are dropped.
+- ORed filters on a column are united: equalities and IN lists become one IN list, overlapping ranges are merged, and
+  values already covered by a range are dropped.
+- ANDed filters that contradict each other (e.g. x = 1 AND x = 2, or x > 10 AND x < 5) make the whole tree a
+  FalseFilter, so the query can return no rows without touching the database.
+
+The tree has no NOT, so a predicate that is NULL may be treated as false anywhere in it: WHERE drops NULL and false
+rows alike. Reasoning about values (ranges, contradictions) is only done for numbers, dates and times, because string
+comparisons depend on the database collation. Filters on strings are only deduplicated and folded into IN lists.
+
+Filters on columns that don't exist, or with values that can't be converted to the column type, are dropped, the same
+as ComplexFilter.get_expression ignores them.
+"""
+import datetime
+import logging
+import numbers
+from collections import namedtuple, OrderedDict
+from typing import List
+
+from sqlalchemy import Table
+
+from grice.complex_filter import ColumnFilter, ComplexFilter, FalseFilter, get_column
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+RANGE_FILTERS = ['lt', 'lte', 'gt', 'gte', 'bt']
+POINT_FILTERS = ['eq', 'in']
+
+# A range of values, low or high is None if that end is unbounded.
+Interval = namedtuple('Interval', ['low', 'low_inclusive', 'high', 'high_inclusive'])
+UNBOUNDED = Interval(None, False, None, False)
+
+
+def _values(column_filter: ColumnFilter):
+    if isinstance(column_filter.value, (list, tuple)):
+        return list(column_filter.value)
+
+    return [column_filter.value]
+
+
+def _has_null(column_filter: ColumnFilter):
+    return any(value is None for value in _values(column_filter))
+
+
+def _unique(values: list):
+    """
+    Removes duplicate values, keeping the first of each.
+    """
+    try:
+        return list(OrderedDict.fromkeys(values))
+    except TypeError:
+        # Unhashable values, i.e. lists from a JSON body.
+        unique = []
+
+        for value in values:
+            if value not in unique:
+                unique.append(value)
+
+        return unique
+
+
+def _intersection(values: list, others: list):
+    """
+    Returns the values that are also in others, in order. IN lists can be long, so hashable values are looked up in a
+    set.
+    """
+    try:
+        others = set(others)
+    except TypeError:
+        pass
+
+    return [value for value in values if value in others]
+
+
+def _value_kind(value):
+    """
+    Returns the kind of a value if Python compares values of that kind the way databases do, otherwise None.
+    """
+    if isinstance(value, numbers.Number):
+        # NaN isn't equal to itself.
+        return 'number' if value == value else None  # pylint: disable=comparison-with-itself
+
+    if isinstance(value, datetime.datetime):
+        # Naive and aware datetimes can't be compared.
+        return 'datetime' if value.tzinfo is None else 'aware datetime'
+
+    for kind in (datetime.date, datetime.time, datetime.timedelta):
+        if isinstance(value, kind):
+            return kind.__name__
+
+    return None
+
+
+def _can_compare(column_filters: list):
+    """
+    Returns True if the values of the filters can be reasoned about, see _value_kind.
+    """
+    kinds = set()
+
+    for column_filter in column_filters:
+        values = _values(column_filter)
+
+        if column_filter.filter_type in ['bt', 'nbt'] and len(values) != 2:
+            return False
+
+        kinds.update(_value_kind(value) for value in values)
+
+    return len(kinds) == 1 and None not in kinds
+
+
+def _to_interval(column_filter: ColumnFilter):
+    filter_type, value = column_filter.filter_type, column_filter.value
+
+    if filter_type == 'lt':
+        return Interval(None, False, value, False)
+    elif filter_type == 'lte':
+        return Interval(None, False, value, True)
+    elif filter_type == 'gt':
+        return Interval(value, False, None, False)
+    elif filter_type == 'gte':
+        return Interval(value, True, None, False)
+    elif filter_type == 'bt':
+        return Interval(value[0], True, value[1], True)
+
+    return Interval(value, True, value, True)
+
+
+def _intersect(first: Interval, second: Interval):
+    low, low_inclusive = first.low, first.low_inclusive
+    high, high_inclusive = first.high, first.high_inclusive
+
+    if second.low is not None:
+        if low is None or second.low > low:
+            low, low_inclusive = second.low, second.low_inclusive
+        elif second.low == low:
+            low_inclusive = low_inclusive and second.low_inclusive
+
+    if second.high is not None:
+        if high is None or second.high < high:
+            high, high_inclusive = second.high, second.high_inclusive
+        elif second.high == high:
+            high_inclusive = high_inclusive and second.high_inclusive
+
+    return Interval(low, low_inclusive, high, high_inclusive)
+
+
+def _is_empty(interval: Interval):
+    if interval.low is None or interval.high is None:
+        return False
+
+    if interval.low == interval.high:
+        return not (interval.low_inclusive and interval.high_inclusive)
+
+    return interval.low > interval.high
+
+
+def _contains(interval: Interval, value):
+    if interval.low is not None:
+        if value < interval.low or (value == interval.low and not interval.low_inclusive):
+            return False
+
+    if interval.high is not None:
+        if value > interval.high or (value == interval.high and not interval.high_inclusive):
+            return False
+
+    return True
+
+
+def _union(intervals: list):
+    """
+    Merges overlapping and adjacent intervals.
+
+    :return: list of disjoint intervals, sorted by their lower end.
+    """
+    ordered = sorted(intervals, key=lambda i: (i.low is not None, i.low, not i.low_inclusive))
+    merged = [ordered[0]]
+
+    for interval in ordered[1:]:
+        last = merged[-1]
+
+        # Intervals unbounded below are sorted first, so they always overlap.
+        if last.high is not None and interval.low is not None:
+            if interval.low > last.high:
+                merged.append(interval)
+                continue
+
+            if interval.low == last.high and not (last.high_inclusive or interval.low_inclusive):
+                merged.append(interval)
+                continue
+
+        if last.high is None or interval.high is None:
+            high, high_inclusive = None, False
+        elif interval.high > last.high:
+            high, high_inclusive = interval.high, interval.high_inclusive
+        elif interval.high == last.high:
+            high, high_inclusive = last.high, last.high_inclusive or interval.high_inclusive
+        else:
+            high, high_inclusive = last.high, last.high_inclusive
+
+        merged[-1] = Interval(last.low, last.low_inclusive, high, high_inclusive)
+
+    return merged
+
+
+def _new_filter(template: ColumnFilter, filter_type: str, value):
+    return ColumnFilter(template.qualified_name, filter_type, value=value, column=template.column)
+
+
+def _points_filter(template: ColumnFilter, values: list):
+    if len(values) == 1:
+        return _new_filter(template, 'eq', values[0])
+
+    return _new_filter(template, 'in', values)
+
+
+def _interval_filters(template: ColumnFilter, interval: Interval):
+    """
+    Returns the filters that select an interval, ANDed together if there is more than one.
+    """
+    if interval.low is not None and interval.high is not None and interval.low_inclusive and interval.high_inclusive:
+        if interval.low == interval.high:
+            return [_new_filter(template, 'eq', interval.low)]
+
+        return [_new_filter(template, 'bt', [interval.low, interval.high])]
+
+    filters = []
+
+    if interval.low is not None:
+        filters.append(_new_filter(template, 'gte' if interval.low_inclusive else 'gt', interval.low))
+
+    if interval.high is not None:
+        filters.append(_new_filter(template, 'lte' if interval.high_inclusive else 'lt', interval.high))
+
+    return filters
+
+
+def _dedupe(column_filters: list):
+    unique = []
+    seen = []
+
+    for column_filter in column_filters:
+        key = (column_filter.filter_type, column_filter.value)
+
+        if key not in seen:
+            seen.append(key)
+            unique.append(column_filter)
+
+    return unique
+
+
+def _simplify_and(column_filters: list):
+    """
+    Simplifies ANDed filters on one column.
+
+    :return: list of filters to AND, or None if the filters contradict each other.
+    """
+    column_filters = _dedupe(column_filters)
+
+    # None is not a value: eq and neq None are IS NULL and IS NOT NULL, and a NULL in a NOT IN list makes it match no
+    # row. Filters with a None are left as they are.
+    if len(column_filters) == 1 or any(_has_null(f) for f in column_filters) or not _can_compare(column_filters):
+        return column_filters
+
+    template = column_filters[0]
+    interval = UNBOUNDED
+    points = None
+    excluded = []
+    excluded_ranges = []
+
+    for column_filter in column_filters:
+        filter_type = column_filter.filter_type
+
+        if filter_type in POINT_FILTERS:
+            values = _values(column_filter)
+            points = _unique(values) if points is None else _intersection(points, values)
+        elif filter_type in RANGE_FILTERS:
+            interval = _intersect(interval, _to_interval(column_filter))
+        elif filter_type in ['neq', 'not_in']:
+            excluded.extend(_values(column_filter))
+        else:
+            excluded_ranges.append(Interval(column_filter.value[0], True, column_filter.value[1], True))
+
+    if _is_empty(interval):
+        return None
+
+    if points is not None:
+        # The values are all that can match, so the other filters are only needed to remove values.
+        excluded = set(excluded)
+        points = [value for value in points if _contains(interval, value) and value not in excluded and
+                  not any(_contains(excluded_range, value) for excluded_range in excluded_ranges)]
+
+        return [_points_filter(template, points)] if points else None
+
+    filters = _interval_filters(template, interval)
+    # Excluded values outside of the range can't match anyway.
+    excluded = [value for value in _unique(excluded) if _contains(interval, value)]
+
+    if excluded:
+        filters.append(_new_filter(template, 'neq', excluded[0]) if len(excluded) == 1 else
+                       _new_filter(template, 'not_in', excluded))
+
+    filters.extend(column_filter for column_filter in column_filters if column_filter.filter_type == 'nbt')
+
+    return filters
+
+
+def _simplify_or(column_filters: list):
+    """
+    Simplifies ORed filters on one column.
+
+    :return: list of filters and ComplexFilters to OR.
+    """
+    column_filters = _dedupe(column_filters)
+
+    if len(column_filters) == 1:
+        return column_filters
+
+    template = column_filters[0]
+    # eq None is IS NULL. It stays a filter of its own, a NULL in an IN list never matches.
+    null_filters = [f for f in column_filters if f.filter_type == 'eq' and f.value is None]
+    point_filters = [f for f in column_filters if f.filter_type in POINT_FILTERS and f not in null_filters]
+    range_filters = [f for f in column_filters if f.filter_type in RANGE_FILTERS]
+    others = [f for f in column_filters if f.filter_type not in POINT_FILTERS + RANGE_FILTERS]
+    points = _unique([value for column_filter in point_filters for value in _values(column_filter)
+                      if value is not None])
+    ranges = range_filters
+
+    if range_filters and _can_compare(point_filters + range_filters):
+        intervals = _union([_to_interval(column_filter) for column_filter in range_filters])
+
+        # A range unbounded at both ends means IS NOT NULL, which no filter type can express.
+        if all(interval.low is not None or interval.high is not None for interval in intervals):
+            points = [value for value in points if not any(_contains(interval, value) for interval in intervals)]
+            ranges = []
+
+            for interval in intervals:
+                filters = _interval_filters(template, interval)
+                ranges.append(filters[0] if len(filters) == 1 else ComplexFilter(filters, True))
+
+    simplified = [_points_filter(template, points)] if points else []
+
+    return simplified + null_filters + ranges + others
+
+
+def _column_key(column_filter: ColumnFilter):
+    column = column_filter.column
+    return column.table.name, column.name
+
+
+def _normalize(filters, tables: List[Table]):
+    """
+    Normalizes a filter or filter tree.
+
+    :return: ColumnFilter, ComplexFilter, FalseFilter if no row can match, or None if no valid filter is left.
+    """
+    if isinstance(filters, ColumnFilter):
+        column = get_column(filters.qualified_name, tables)
+
+        if column is None:
+            return None
+
+        try:
+            filters.column = column
+        except ValueError:
+            return None
+
+        return filters
+
+    if isinstance(filters, FalseFilter):
+        return filters
+
+    children = []
+    contradiction = False
+
+    for child in filters.list_of_filters:
+        child = _normalize(child, tables)
+
+        if child is None:
+            continue
+
+        if isinstance(child, FalseFilter):
+            if filters.is_and:
+                return child
+
+            contradiction = True
+        elif isinstance(child, ComplexFilter) and child.is_and == filters.is_and:
+            children.extend(child.list_of_filters)
+        else:
+            children.append(child)
+
+    columns = OrderedDict()
+    groups = []
+
+    for child in children:
+        if isinstance(child, ColumnFilter):
+            columns.setdefault(_column_key(child), []).append(child)
+        elif child.cache_key() not in [group.cache_key() for group in groups]:
+            groups.append(child)
+
+    # Sorting the filters by column makes equivalent trees bind their values in the same order, so they share a cached
+    # statement (see DBService._prepare_query).
+    column_filters = []
+
+    for key in sorted(columns):
+        if filters.is_and:
+            simplified = _simplify_and(columns[key])
+
+            if simplified is None:
+                log.debug('Filters on %s.%s contradict each other', *key)
+                return FalseFilter()
+
+            column_filters.extend(simplified)
+        else:
+            for child in _simplify_or(columns[key]):
+                if isinstance(child, ComplexFilter):
+                    groups.append(child)
+                else:
+                    column_filters.append(child)
+
+    children = column_filters + groups
+
+    if not children:
+        return FalseFilter() if contradiction else None
+
+    if len(children) == 1:
+        return children[0]
+
+    return ComplexFilter(children, filters.is_and)
+
+
+def normalize_filters(filters, tables: List[Table]):
+    """
+    Returns a simplified filter tree equivalent to the given one, see the module docstring.
+
+    :param filters: ComplexFilter, as parsed by db_controller.parse_filters.
+    :param tables: The main table followed by the joined tables.
+    :return: ComplexFilter, FalseFilter if no row can match the filters, or None if no valid filter is left.
+    """
+    normalized = _normalize(filters, tables)
+
+    if isinstance(normalized, ColumnFilter):
+        return ComplexFilter([normalized])
+
+    return normalized
@@ -0,0 +1,365 @@
+"""
+Asynchronous query jobs.
+
+Queries that take too long for a request, i.e. reports that run for minutes, can be submitted as jobs instead. A job
+runs the whole query (page and perPage are ignored) on a pool of worker threads separate from the request threads, and
+spools the rows to a file in spool_dir as they arrive. Clients poll the job for its state and progress, page through
+the rows spooled so far, download the result once the job is done, or cancel the job.
+
+A spool file is a sequence of blocks, each a zlib compressed JSON array of rows in list format. The job keeps the
+offsets of its blocks, so reading a page only decompresses the blocks the page overlaps.
+
+Jobs are not checked by admission control, the size of the worker pool limits how many run at once, and their
+statements get the statement_timeout of the [jobs] section instead of the table's. A job's result is deleted ttl
+seconds after the job finished. Jobs only live in memory, spool files left from a previous run (<job id>.spool) are deleted at startup.
+"""
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from grice.db_service import QueryArguments, column_label, column_to_dict
+from grice.errors import ConfigurationError, NotFoundError, JoinError, QueryCancelledError, QueryRejectedError, \
+    QueryTimeoutError
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+JOB_STATES = ['queued', 'running', 'done', 'failed', 'cancelled']
+FINISHED_STATES = ['done', 'failed', 'cancelled']
+DEFAULT_WORKERS = 2
+DEFAULT_TTL = 3600
+DEFAULT_MAX_JOBS = 100
+# Seconds, 0 disables the timeout.
+DEFAULT_STATEMENT_TIMEOUT = 0
+SPOOL_SUFFIX = '.spool'
+# The spool files of jobs, only these are removed from spool_dir at startup.
+SPOOL_FILE_PATTERN = re.compile(r'^[0-9a-f]{{32}}{}$'.format(re.escape(SPOOL_SUFFIX)))
+# Spools are written while the query runs, so compression has to keep up with the database.
+COMPRESSION_LEVEL = 1
+# Errors whose message is shown to the user as the reason a job failed, other errors are only logged.
+USER_ERRORS = (NotFoundError, JoinError, ValueError, QueryTimeoutError)
+
+
+class RowSpool:
+    def __init__(self, path: str):
+        """
+        The rows of a job's result, in a file of compressed blocks, see the module docstring. One thread appends while
+        others read the blocks appended so far.
+
+        :param path: The path of the spool file, it is created by the first append.
+        """
+        self.path = path
+        # (first row, number of rows, offset, size) of every block.
+        self.blocks = []
+        self.rows = 0
+        self.bytes = 0
+        self._file = None
+
+    def append(self, rows: list, encoder):
+        """
+        Appends a block of rows.
+
+        :param rows: list of rows, each a sequence of values in column order.
+        :param encoder: The JSON encoder class for the values.
+        """
+        if self._file is None:
+            self._file = open(self.path, 'wb')
+
+        data = json.dumps([list(row) for row in rows], cls=encoder, separators=(',', ':')).encode('utf-8')
+        data = zlib.compress(data, COMPRESSION_LEVEL)
+        self._file.write(data)
+        self._file.flush()
+        self.blocks.append((self.rows, len(rows), self.bytes, len(data)))
+        self.rows += len(rows)
+        self.bytes += len(data)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+    def iter_blocks(self, start: int = 0, stop: int = None):
+        """
+        Yields the blocks spooled so far that overlap rows start to stop, each as a list of rows.
+        """
+        blocks = list(self.blocks)
+
+        if not blocks:
+            return
+
+        with open(self.path, 'rb') as spool_file:
+            for first, count, offset, size in blocks:
+                if stop is not None and first >= stop:
+                    return
+
+                if first + count <= start:
+                    continue
+
+                spool_file.seek(offset)
+                rows = json.loads(zlib.decompress(spool_file.read(size)).decode('utf-8'))
+                yield rows[max(start - first, 0):None if stop is None else stop - first]
+
+    def read(self, start: int, stop: int):
+        """
+        Returns rows start to stop (exclusive) of the rows spooled so far.
+        """
+        return [row for rows in self.iter_blocks(start, stop) for row in rows]
+
+    def delete(self):
+        self.close()
+
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class Job:  # pylint: disable=too-many-instance-attributes
+    def __init__(self, table_name: str, quargs: QueryArguments, spool_dir: str):
+        """
+        A query that runs in the background, see the module docstring.
+
+        :param table_name: The name of the table to query.
+        :param quargs: QueryArguments, the whole result is fetched whatever the page and perPage.
+        :param spool_dir: The directory to spool the result to.
+        """
+        self.id = uuid.uuid4().hex  # pylint: disable=invalid-name
+        self.table_name = table_name
+        self.quargs = quargs._replace(page=0, per_page=-1, after=None)
+        self.state = 'queued'
+        self.error = None
+        self.columns = None
+        self.labels = None
+        self.spool = RowSpool(os.path.join(spool_dir, self.id + SPOOL_SUFFIX))
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.cancel_requested = False
+        self.future = None
+
+    @property
+    def is_finished(self):
+        return self.state in FINISHED_STATES
+
+    def to_dict(self):
+        now = self.finished or time.time()
+
+        return {
+            'id': self.id,
+            'table': self.table_name,
+            'state': self.state,
+            'rows': self.spool.rows,
+            'bytes': self.spool.bytes,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+            'elapsed': round(now - self.started, 3) if self.started is not None else None,
+            'error': self.error,
+        }
+
+
+class JobManager:
+    def __init__(self, db_service, encoder, spool_dir: str, workers: int = DEFAULT_WORKERS, ttl: int = DEFAULT_TTL,
+                 max_jobs: int = DEFAULT_MAX_JOBS, statement_timeout: float = DEFAULT_STATEMENT_TIMEOUT):  # pylint: disable=too-many-arguments
+        """
+        Runs jobs on a pool of worker threads and keeps them until their result expires.
+
+        :param db_service: The DBService to run the queries with.
+        :param encoder: The JSON encoder class for the spooled values.
+        :param spool_dir: The directory for the spool files, created if it doesn't exist.
+        :param workers: The number of jobs that run at the same time, other jobs wait in a queue.
+        :param ttl: Seconds a finished job and its result are kept.
+        :param max_jobs: The number of jobs (queued, running, or finished and not expired) above which new jobs are
+        rejected.
+        :param statement_timeout: The statement timeout of the jobs' queries in seconds, 0 for no timeout.
+        """
+        self.db_service = db_service
+        self.encoder = encoder
+        self.spool_dir = spool_dir
+        self.workers = workers
+        self.ttl = ttl
+        self.max_jobs = max_jobs
+        self.statement_timeout = statement_timeout
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        os.makedirs(spool_dir, exist_ok=True)
+        self._remove_old_spools()
+
+    def _remove_old_spools(self):
+        for file_name in os.listdir(self.spool_dir):
+            if SPOOL_FILE_PATTERN.match(file_name):
+                log.debug('Removing spool file %s of a previous run', file_name)
+                os.remove(os.path.join(self.spool_dir, file_name))
+
+    def expire(self):
+        """
+        Deletes the jobs that finished more than ttl seconds ago, and their results.
+        """
+        cutoff = time.time() - self.ttl
+
+        with self._lock:
+            expired = [job for job in self._jobs.values() if job.is_finished and job.finished < cutoff]
+
+            for job in expired:
+                del self._jobs[job.id]
+
+        for job in expired:
+            job.spool.delete()
+
+    def submit(self, table_name: str, quargs: QueryArguments):
+        """
+        Queues a job.
+
+        :return: Job
+        :raises QueryRejectedError: If there are max_jobs jobs already.
+        """
+        self.expire()
+
+        with self._lock:
+            if len(self._jobs) >= self.max_jobs:
+                raise QueryRejectedError('There are too many jobs, try again once some have finished or expired.',
+                                         retry=True)
+
+            job = Job(table_name, quargs, self.spool_dir)
+            self._jobs[job.id] = job
+
+        job.future = self._executor.submit(self._run, job)
+        log.info('Queued job %s on table %s', job.id, table_name)
+
+        return job
+
+    def _run(self, job: Job):
+        if job.cancel_requested:
+            # Cancelled after the job was handed to a worker, when the future could no longer be cancelled.
+            job.state = 'cancelled'
+            job.finished = time.time()
+            return
+
+        job.state = 'running'
+        job.started = time.time()
+
+        try:
+            batches, columns = self.db_service.stream_batches(job.table_name, job.quargs,
+                                                              timeout=self.statement_timeout,
+                                                              disconnected=lambda: job.cancel_requested, admit=False)
+            job.columns = [column_to_dict(column) for column in columns]
+            job.labels = [column_label(column) for column in columns]
+
+            for batch in batches:
+                job.spool.append(batch, self.encoder)
+        except QueryCancelledError:
+            job.state = 'cancelled'
+        except USER_ERRORS as e:
+            job.error = str(e)
+            job.state = 'failed'
+        except Exception:  # pylint: disable=broad-except
+            log.exception('Job %s failed', job.id)
+            job.error = 'The query failed'
+            job.state = 'failed'
+        else:
+            job.state = 'done'
+        finally:
+            job.spool.close()
+            job.finished = time.time()
+
+        log.info('Job %s %s after %.1fs with %s rows', job.id, job.state, job.finished - job.started, job.spool.rows)
+
+    def get(self, job_id: str):
+        """
+        :return: Job
+        :raises NotFoundError: If there is no job with this id, or its result expired.
+        """
+        self.expire()
+
+        with self._lock:
+            job = self._jobs.get(job_id, None)
+
+        if job is None:
+            raise NotFoundError('A job with id "{}" could not be found, results expire {} seconds after the job '
+                                'finished.'.format(job_id, self.ttl))
+
+        return job
+
+    def list(self):
+        self.expire()
+
+        with self._lock:
+            return list(self._jobs.values())
+
+    def cancel(self, job_id: str):
+        """
+        Cancels a job that is queued or running, or deletes the result of a job that finished.
+
+        :return: Job
+        """
+        job = self.get(job_id)
+
+        if job.is_finished:
+            with self._lock:
+                self._jobs.pop(job.id, None)
+
+            job.spool.delete()
+            return job
+
+        job.cancel_requested = True
+
+        if job.future.cancel():
+            # It never started.
+            job.state = 'cancelled'
+            job.finished = time.time()
+
+        return job
+
+    def stats(self):
+        with self._lock:
+            jobs = list(self._jobs.values())
+
+        states = OrderedDict((state, 0) for state in JOB_STATES)
+
+        for job in jobs:
+            states[job.state] += 1
+
+        return {
+            'states': states,
+            'spool_bytes': sum(job.spool.bytes for job in jobs),
+        }
+
+    def shutdown(self):
+        with self._lock:
+            jobs = list(self._jobs.values())
+
+        for job in jobs:
+            job.cancel_requested = True
+
+        self._executor.shutdown(wait=True)
+
+
+def init_jobs(db_service, job_config, encoder):
+    """
+    Creates the JobManager for the [jobs] config section.
+
+    :param db_service: The DBService to run the queries with.
+    :param job_config: The [jobs] config section, None disables jobs.
+    :param encoder: The JSON encoder class for the spooled values.
+    :return: JobManager, or None if jobs are disabled.
+    """
+    if job_config is None:
+        return None
+
+    spool_dir = job_config.get('spool_dir', os.path.join(tempfile.gettempdir(), 'grice_jobs'))
+    workers = job_config.getint('workers', DEFAULT_WORKERS)
+
+    if workers < 1:
+        raise ConfigurationError('The [jobs] workers must be at least 1')
+
+    return JobManager(db_service, encoder, spool_dir, workers,
+                      job_config.getint('ttl', DEFAULT_TTL),
+                      job_config.getint('max_jobs', DEFAULT_MAX_JOBS),
+                      job_config.getfloat('statement_timeout', DEFAULT_STATEMENT_TIMEOUT))
@@ -0,0 +1,219 @@
+import logging
+from collections import namedtuple
+from typing import List
+
+from sqlalchemy import Column, Table, and_
+from sqlalchemy.exc import NoReferenceError
+from sqlalchemy.sql import Select, visitors
+
+from grice.errors import JoinError
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+PlannedJoin = namedtuple('PlannedJoin', ['table', 'from_columns', 'to_columns', 'outer_join'])
+
+
+def _find_table(tables: List[Table], table_name: str):
+    for table in tables:
+        if table.name == table_name:
+            return table
+
+    return None
+
+
+def _references(foreign_key, table: Table):
+    """
+    Returns True if a ForeignKey points at a column of the given table.
+    """
+    try:
+        return foreign_key.column.table is table
+    except NoReferenceError:
+        return False
+
+
+def _explicit_join_columns(join, join_table: Table, joined: List[Table]):
+    """
+    Resolves the column pairs given in the URL. A from column can be qualified with the name of any table that is
+    already part of the query (i.e. "table_name.column_name"), unqualified from columns are on the main table.
+    """
+    error_msg = 'Invalid join, "{}" is not a column on table "{}"'
+    from_columns = []
+    to_columns = []
+
+    for column_pair in join.column_pairs:
+        from_table_name, _, from_column_name = column_pair.from_column.rpartition('.')
+        from_table = joined[0]
+
+        if from_table_name:
+            from_table = _find_table(joined, from_table_name)
+
+            if from_table is None:
+                msg = 'Invalid join. Table "{}" must be joined before it can be joined to "{}".'
+                raise JoinError(msg.format(from_table_name, join_table.name))
+
+        from_col = from_table.columns.get(from_column_name)
+        to_col = join_table.columns.get(column_pair.to_column)
+
+        if from_col is None:
+            raise ValueError(error_msg.format(from_column_name, from_table.name))
+
+        if to_col is None:
+            raise ValueError(error_msg.format(column_pair.to_column, join_table.name))
+
+        from_columns.append(from_col)
+        to_columns.append(to_col)
+
+    return from_columns, to_columns
+
+
+def _inferred_join_columns(join_table: Table, joined: List[Table]):
+    """
+    Finds the join condition from the foreign keys between join_table and the tables that are already part of the
+    query, in either direction. Exactly one foreign key constraint must connect them.
+    """
+    candidates = []
+
+    for table in joined:
+        for constraint in join_table.foreign_key_constraints:
+            elements = constraint.elements
+
+            if elements and all(_references(fk, table) for fk in elements):
+                candidates.append(([fk.column for fk in elements], [fk.parent for fk in elements]))
+
+        for constraint in table.foreign_key_constraints:
+            elements = constraint.elements
+
+            if elements and all(_references(fk, join_table) for fk in elements):
+                candidates.append(([fk.parent for fk in elements], [fk.column for fk in elements]))
+
+    if not candidates:
+        msg = 'Invalid join. No foreign key connects table "{}" to {}, specify the join columns.'
+        raise JoinError(msg.format(join_table.name, ', '.join('"{}"'.format(t.name) for t in joined)))
+
+    if len(candidates) > 1:
+        msg = 'Invalid join. More than one foreign key connects table "{}" to the query, specify the join columns.'
+        raise JoinError(msg.format(join_table.name))
+
+    return candidates[0]
+
+
+def plan_joins(table: Table, joins: list, join_tables: List[Table]):
+    """
+    Resolves the join conditions of a query. Joins are applied in order, and each one can join to the main table or
+    any table joined before it. Joins without column pairs are inferred from the reflected foreign keys.
+
+    :param table: The main table.
+    :param joins: List of TableJoin objects.
+    :param join_tables: The Table of each join, in the same order.
+    :return: list of PlannedJoin
+    """
+    joined = [table]
+    planned = []
+
+    for join, join_table in zip(joins, join_tables):
+        if join.column_pairs:
+            from_columns, to_columns = _explicit_join_columns(join, join_table, joined)
+        else:
+            from_columns, to_columns = _inferred_join_columns(join_table, joined)
+
+        planned.append(PlannedJoin(join_table, from_columns, to_columns, join.outer_join))
+        joined.append(join_table)
+
+    return planned
+
+
+def referenced_tables(clauses: list):
+    """
+    Returns the tables referenced by a list of columns and expressions (None entries are ignored).
+
+    :return: set of Tables
+    """
+    tables = set()
+
+    for clause in clauses:
+        if clause is None:
+            continue
+
+        for element in visitors.iterate(clause, {}):
+            if isinstance(element, Column) and isinstance(element.table, Table):
+                tables.add(element.table)
+
+    return tables
+
+
+def _is_removable(join: PlannedJoin, outer_tables: set):
+    """
+    A join can be dropped from a query that doesn't use any of its columns if it can't change which rows the query
+    returns. That is the case if every row matches at most one row of the joined table (the join columns include its
+    primary key), and either the join is an outer join, or every row is guaranteed to match (the join follows a
+    non-nullable foreign key from a table that is not outer joined, which could make the key NULL).
+    """
+    to_columns = set(join.to_columns)
+    primary_key = set(join.table.primary_key.columns)
+    unique = (primary_key and primary_key <= to_columns) or any(column.unique for column in to_columns)
+
+    if not unique:
+        return False
+
+    if join.outer_join:
+        return True
+
+    for from_col, to_col in zip(join.from_columns, join.to_columns):
+        follows_key = any(_references(fk, join.table) and fk.column is to_col for fk in from_col.foreign_keys)
+
+        if from_col.nullable or from_col.table in outer_tables or not follows_key:
+            return False
+
+    return True
+
+
+def prune_joins(planned: List[PlannedJoin], used_tables: set):
+    """
+    Removes joins whose table is not used by the query, when removing them does not change the result (see
+    _is_removable). Joins that a kept join depends on are never removed.
+
+    :param planned: list of PlannedJoin, from plan_joins.
+    :param used_tables: The tables whose columns are selected, filtered, sorted, or grouped on.
+    :return: list of PlannedJoin
+    """
+    kept = list(planned)
+    outer_tables = {join.table for join in planned if join.outer_join}
+    removed = True
+
+    while removed:
+        removed = False
+
+        for join in reversed(kept):
+            needed = any(other is not join and any(col.table is join.table for col in other.from_columns)
+                         for other in kept)
+
+            if join.table in used_tables or needed or not _is_removable(join, outer_tables):
+                continue
+
+            log.debug('Pruned unused join to table %s', join.table.name)
+            kept.remove(join)
+            removed = True
+            break
+
+    return kept
+
+
+def apply_joins(query: Select, table: Table, planned: List[PlannedJoin]):
+    """
+    Joins the tables of a join plan onto a query.
+
+    :param query: A SQLAlchemy select object.
+    :param table: The main table.
+    :param planned: list of PlannedJoin.
+    :return: A SQLAlchemy select object.
+    """
+    if not planned:
+        return query
+
+    from_clause = table
+
+    for join in planned:
+        onclause = and_(*[from_col == to_col for from_col, to_col in zip(join.from_columns, join.to_columns)])
+        from_clause = from_clause.join(join.table, onclause=onclause, isouter=join.outer_join)
+
+    return query.select_from(from_clause)
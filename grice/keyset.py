@@ -0,0 +1,136 @@
+import base64
+import binascii
+import datetime
+import json
+import uuid
+from decimal import Decimal
+from typing import List
+
+from sqlalchemy import Column, and_, or_, tuple_, bindparam
+
+
+def _encode_value(value):
+    """
+    Converts a column value to something JSON can represent without losing its type.
+    """
+    if isinstance(value, datetime.datetime):
+        offset = value.utcoffset()
+        offset = offset.days * 86400 + offset.seconds if offset is not None else None
+        parts = [value.year, value.month, value.day, value.hour, value.minute, value.second, value.microsecond]
+        return {'datetime': parts, 'offset': offset}
+
+    if isinstance(value, datetime.date):
+        return {'date': [value.year, value.month, value.day]}
+
+    if isinstance(value, datetime.time):
+        return {'time': [value.hour, value.minute, value.second, value.microsecond]}
+
+    if isinstance(value, Decimal):
+        return {'decimal': str(value)}
+
+    if isinstance(value, uuid.UUID):
+        return {'uuid': str(value)}
+
+    return value
+
+
+def _decode_value(value):
+    if not isinstance(value, dict):
+        return value
+
+    if 'datetime' in value:
+        tzinfo = None
+
+        if value.get('offset') is not None:
+            tzinfo = datetime.timezone(datetime.timedelta(seconds=value['offset']))
+
+        return datetime.datetime(*value['datetime'], tzinfo=tzinfo)
+
+    if 'date' in value:
+        return datetime.date(*value['date'])
+
+    if 'time' in value:
+        return datetime.time(*value['time'])
+
+    if 'decimal' in value:
+        return Decimal(value['decimal'])
+
+    if 'uuid' in value:
+        return uuid.UUID(value['uuid'])
+
+    raise ValueError('Invalid keyset value')
+
+
+def encode_token(key_names: List[str], values: list):
+    """
+    Creates an opaque pagination token from the sort key values of the last row of a page.
+
+    :param key_names: The full names (table_name.column_name) of the key columns.
+    :param values: The values of the key columns for the last row.
+    :return: A URL safe string, or None if any value is NULL (NULLs can't be compared so we can't seek past them).
+    """
+    if any(value is None for value in values):
+        return None
+
+    data = json.dumps({'k': key_names, 'v': [_encode_value(value) for value in values]}, separators=(',', ':'))
+
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_token(token: str, key_names: List[str]):
+    """
+    Decodes a token created by encode_token.
+
+    :param token: the token from the "after" URL parameter.
+    :param key_names: the key columns of the current query, the token must have been created with the same keys.
+    :return: list of key values.
+    """
+    try:
+        data = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        data = json.loads(data.decode('utf-8'))
+        values = [_decode_value(value) for value in data['v']]
+    except (binascii.Error, UnicodeDecodeError, ValueError, TypeError, KeyError):
+        raise ValueError('Invalid "after" token')
+
+    if data['k'] != key_names or len(values) != len(key_names):
+        raise ValueError('The "after" token does not match the sort order of this query')
+
+    return values
+
+
+def seek_param_name(idx: int):
+    return 'after_{}'.format(idx)
+
+
+def seek_condition(key_columns: List[Column], directions: List[str], values: list):
+    """
+    Builds the WHERE clause that selects the rows after the given key values for a given sort order.
+
+    When every key is sorted in the same direction this is a single row comparison, i.e. (a, b) > (1, 2), which
+    databases can satisfy with an index range scan. Mixed directions are expanded to
+    (a > 1) OR (a = 1 AND b < 2).
+
+    :param key_columns: The key columns, in sort order.
+    :param directions: 'asc' or 'desc' for each key column.
+    :param values: The key values of the last row of the previous page.
+    :return: SQLAlchemy expression
+    """
+    binds = [bindparam(seek_param_name(idx), value, type_=column.type)
+             for idx, (column, value) in enumerate(zip(key_columns, values))]
+
+    if len(set(directions)) == 1:
+        if len(key_columns) == 1:
+            left, right = key_columns[0], binds[0]
+        else:
+            left, right = tuple_(*key_columns), tuple_(*binds)
+
+        return left > right if directions[0] == 'asc' else left < right
+
+    clauses = []
+
+    for idx, (column, direction, bind) in enumerate(zip(key_columns, directions, binds)):
+        equal = [key_columns[i] == binds[i] for i in range(idx)]
+        compare = column > bind if direction == 'asc' else column < bind
+        clauses.append(and_(*(equal + [compare])))
+
+    return or_(*clauses)
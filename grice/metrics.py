@@ -0,0 +1,340 @@
+import bisect
+import logging
+import threading
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+# The request stages (see timing.stage) that are spent waiting on the database.
+DB_STAGES = ['load', 'explain', 'execute', 'fetch', 'count']
+
+# name -> (type, help)
+METRICS = {
+    'grice_request_duration_seconds': ('histogram', 'Request latency by route and table.'),
+    'grice_responses_total': ('counter', 'Responses by route and status code.'),
+    'grice_db_duration_seconds': ('histogram', 'Time spent executing queries and fetching rows, per request.'),
+    'grice_rows_returned_total': ('counter', 'Rows returned by the query API.'),
+    'grice_response_bytes_total': ('counter', 'Response body bytes sent, including streamed responses.'),
+    'grice_errors_total': ('counter', 'Error responses by route and error type.'),
+    'grice_pool_connections': ('gauge', 'Connections in the pool by state.'),
+    'grice_pool_events_total': ('counter', 'Connection pool overflows, checkout timeouts, and invalidations.'),
+    'grice_pool_wait_seconds': ('histogram', 'Time spent waiting to check out a connection.'),
+    'grice_cache_requests_total': ('counter', 'Cache lookups by cache and result.'),
+    'grice_cache_hit_ratio': ('gauge', 'Share of cache lookups that were hits.'),
+    'grice_query_executions_total': ('counter', 'Queries executed, and queries that shared the result of an identical '
+                                                'query already running (coalesced).'),
+    'grice_queries_in_flight': ('gauge', 'Queries running that identical queries can wait on.'),
+    'grice_queries_cancelled_total': ('counter', 'Statements cancelled because they ran past their statement timeout, '
+                                                 'or because the client disconnected.'),
+    'grice_admission_rejected_total': ('counter', 'Queries rejected by admission control.'),
+    'grice_admission_queued_queries': ('gauge', 'Expensive queries waiting for a slot to run.'),
+    'grice_admission_running_queries': ('gauge', 'Expensive queries running.'),
+    'grice_jobs': ('gauge', 'Query jobs by state.'),
+    'grice_job_spool_bytes': ('gauge', 'Disk space used by the results of query jobs.'),
+    'grice_spool_requests_total': ('counter', 'Table queries a result spool could answer, by whether one did (hit) or '
+                                              'not (miss).'),
+    'grice_spools': ('gauge', 'Query results spooled to disk.'),
+    'grice_spool_bytes': ('gauge', 'Disk space used by spooled query results.'),
+    'grice_replica_up': ('gauge', 'Whether a read replica is healthy and within its max lag (1) or not (0).'),
+    'grice_replica_lag_seconds': ('gauge', 'Replication lag of a read replica at its last check.'),
+    'grice_replica_outstanding_queries': ('gauge', 'Read queries running on a replica.'),
+    'grice_replica_queries_total': ('counter', 'Read queries sent to a replica.'),
+    'grice_replica_failures_total': ('counter', 'Failed checks and connections of a replica.'),
+    'grice_replica_fallbacks_total': ('counter', 'Read queries sent to the primary because no replica was available.'),
+}
+
+
+class Metrics:
+    """
+    Counters and histograms for the /metrics endpoint. Every thread records into its own shard, a dict only that thread
+    writes to, so recording takes no lock and threads never wait on each other. Collecting sums the shards, which is
+    fine because scrapes are rare compared to requests.
+    """
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+
+        if shard is None:
+            shard = {}
+            self._local.shard = shard
+
+            with self._lock:
+                self._shards.append(shard)
+
+        return shard
+
+    def inc(self, name: str, labels: tuple, value=1):
+        """
+        Increments a counter.
+
+        :param name: The metric name.
+        :param labels: tuple of (label name, value) pairs.
+        :param value: The amount to add.
+        """
+        shard = self._shard()
+        key = (name, labels)
+        shard[key] = shard.get(key, 0) + value
+
+    def observe(self, name: str, labels: tuple, value: float, buckets: list = None):
+        """
+        Records a value in a histogram. The histogram's buckets are set by its first observation.
+
+        :param name: The metric name.
+        :param labels: tuple of (label name, value) pairs.
+        :param value: The observed value.
+        :param buckets: Sorted bucket upper bounds, defaults to LATENCY_BUCKETS.
+        """
+        buckets = self._buckets.setdefault(name, buckets or LATENCY_BUCKETS)
+        shard = self._shard()
+        key = (name, labels)
+        cell = shard.get(key, None)
+
+        if cell is None:
+            # One count per bucket, the +Inf count, and the sum.
+            cell = [0] * (len(buckets) + 1) + [0.0]
+            shard[key] = cell
+
+        cell[bisect.bisect_left(buckets, value)] += 1
+        cell[-1] += value
+
+    def collect(self):
+        """
+        Sums the shards of all threads.
+
+        :return: counters, histograms. counters is a dict of (name, labels) -> value, histograms a dict of
+            (name, labels) -> stats dict in the format of pool.Histogram.stats.
+        """
+        with self._lock:
+            shards = list(self._shards)
+
+        counters = {}
+        cells = {}
+
+        for shard in shards:
+            # dict.copy doesn't release the GIL, so the owning thread can't change the shard while it is copied.
+            for key, value in shard.copy().items():
+                if isinstance(value, list):
+                    total = cells.setdefault(key, [0] * len(value))
+
+                    for idx, count in enumerate(list(value)):
+                        total[idx] += count
+                else:
+                    counters[key] = counters.get(key, 0) + value
+
+        histograms = {key: _histogram_stats(self._buckets[key[0]], cell) for key, cell in cells.items()}
+
+        return counters, histograms
+
+    def record_request(self, endpoint: str, table: str, status: int, seconds: float, timer=None,  # pylint: disable=too-many-arguments
+                       response_bytes: int = None):
+        """
+        Records a finished request.
+
+        :param endpoint: The name of the route.
+        :param table: The table the request was for, or an empty string.
+        :param status: The response status code.
+        :param seconds: The request duration.
+        :param timer: The timing.RequestTimer of the request, for the database time, row count and error type.
+        :param response_bytes: The response size, None for streamed responses (see count_bytes).
+        """
+        labels = (('endpoint', endpoint), ('table', table))
+        self.observe('grice_request_duration_seconds', labels, seconds)
+        self.inc('grice_responses_total', (('endpoint', endpoint), ('status', str(status))))
+
+        if response_bytes is not None:
+            self.inc('grice_response_bytes_total', labels, response_bytes)
+
+        info = timer.info if timer is not None else {}
+        error = info.get('error', None)
+
+        if error is None and status >= 500:
+            error = 'InternalError'
+
+        if error is not None:
+            self.inc('grice_errors_total', (('endpoint', endpoint), ('type', error)))
+
+        if 'rows' in info:
+            self.inc('grice_rows_returned_total', labels, info['rows'])
+
+        db_seconds = sum(timer.stages.get(name, 0.0) for name in DB_STAGES) if timer is not None else 0.0
+
+        if db_seconds:
+            self.observe('grice_db_duration_seconds', (('table', table),), db_seconds)
+
+    def count_bytes(self, chunks, endpoint: str, table: str):
+        """
+        Wraps the body of a streamed response to count its bytes as they are sent.
+        """
+        labels = (('endpoint', endpoint), ('table', table))
+
+        try:
+            for chunk in chunks:
+                self.inc('grice_response_bytes_total', labels, len(chunk))
+                yield chunk
+        finally:
+            # Close the wrapped body right away (i.e. when the client disconnects), so its connection is released.
+            close = getattr(chunks, 'close', None)
+
+            if close is not None:
+                close()
+
+
+def _histogram_stats(buckets: list, cell: list):
+    cumulative = []
+    running = 0
+
+    for bound, count in zip(buckets + ['+Inf'], cell):
+        running += count
+        cumulative.append([bound, running])
+
+    return {'buckets': cumulative, 'count': running, 'sum': cell[-1]}
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels: tuple):
+    if not labels:
+        return ''
+
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value)) for name, value in labels) + '}'
+
+
+def _format_histogram(name: str, labels: tuple, stats: dict):
+    lines = []
+
+    for bound, count in stats['buckets']:
+        lines.append('{}_bucket{} {}'.format(name, _format_labels(labels + (('le', bound),)), count))
+
+    lines.append('{}_sum{} {}'.format(name, _format_labels(labels), stats['sum']))
+    lines.append('{}_count{} {}'.format(name, _format_labels(labels), stats['count']))
+
+    return lines
+
+
+def _service_metrics(db_service):
+    """
+    Reads the connection pool, replica, cache, query coalescing, cancellation, and admission statistics of a DBService.
+
+    :return: values, histograms. values is a dict of (name, labels) -> value, histograms a dict of (name, labels) ->
+        stats dict.
+    """
+    values = {}
+    histograms = {}
+    pool_stats = db_service.pool_stats()
+
+    for state in ['size', 'checked_in', 'checked_out', 'overflow']:
+        if state in pool_stats:
+            values[('grice_pool_connections', (('state', state),))] = pool_stats[state]
+
+    for event in ['overflows', 'timeouts', 'invalidations']:
+        if event in pool_stats:
+            values[('grice_pool_events_total', (('event', event),))] = pool_stats[event]
+
+    if 'wait_seconds' in pool_stats:
+        histograms[('grice_pool_wait_seconds', ())] = pool_stats['wait_seconds']
+
+    caches = [('statement', db_service.statements)]
+
+    if db_service.cache is not None:
+        caches.append(('query', db_service.cache))
+
+    for cache_name, cache in caches:
+        stats = cache.stats()
+        values[('grice_cache_requests_total', (('cache', cache_name), ('result', 'hit')))] = stats['hits']
+        values[('grice_cache_requests_total', (('cache', cache_name), ('result', 'miss')))] = stats['misses']
+        values[('grice_cache_hit_ratio', (('cache', cache_name),))] = stats['hit_ratio']
+
+    if 'replicas' in pool_stats:
+        values[('grice_replica_fallbacks_total', ())] = pool_stats['replicas']['fallbacks']
+
+        for name, replica in pool_stats['replicas']['replicas'].items():
+            labels = (('replica', name),)
+            values[('grice_replica_up', labels)] = int(replica['available'])
+            values[('grice_replica_outstanding_queries', labels)] = replica['outstanding']
+            values[('grice_replica_queries_total', labels)] = replica['queries']
+            values[('grice_replica_failures_total', labels)] = replica['failures']
+
+            if replica['lag'] is not None:
+                values[('grice_replica_lag_seconds', labels)] = replica['lag']
+
+    if db_service.in_flight is not None:
+        stats = db_service.in_flight.stats()
+        values[('grice_query_executions_total', (('result', 'executed'),))] = stats['executions']
+        values[('grice_query_executions_total', (('result', 'coalesced'),))] = stats['coalesced']
+        values[('grice_queries_in_flight', ())] = stats['in_flight']
+
+    stats = db_service.watchdog.stats()
+    values[('grice_queries_cancelled_total', (('reason', 'timeout'),))] = stats['timeouts']
+    values[('grice_queries_cancelled_total', (('reason', 'disconnect'),))] = stats['disconnects']
+
+    if db_service.admission.enabled:
+        stats = db_service.admission.stats()
+        values[('grice_admission_rejected_total', ())] = stats['rejected']
+        values[('grice_admission_queued_queries', ())] = stats['queued']
+        values[('grice_admission_running_queries', ())] = stats['running']
+
+    return values, histograms
+
+
+def _job_metrics(job_manager):
+    stats = job_manager.stats()
+    values = {('grice_jobs', (('state', state),)): count for state, count in stats['states'].items()}
+    values[('grice_job_spool_bytes', ())] = stats['spool_bytes']
+
+    return values
+
+
+def _spool_metrics(spool_manager):
+    stats = spool_manager.stats()
+
+    return {
+        ('grice_spool_requests_total', (('result', 'hit'),)): stats['hits'],
+        ('grice_spool_requests_total', (('result', 'miss'),)): stats['misses'],
+        ('grice_spools', ()): stats['spools'],
+        ('grice_spool_bytes', ()): stats['bytes'],
+    }
+
+
+def render(metrics: Metrics, db_service, job_manager=None, spool_manager=None):
+    """
+    Renders the request metrics and the pool and cache statistics in the Prometheus text exposition format.
+
+    :param metrics: Metrics
+    :param db_service: DBService
+    :param job_manager: jobs.JobManager, None if jobs are disabled.
+    :param spool_manager: result_spool.SpoolManager, None if result spools are disabled.
+    :return: str
+    """
+    values, histograms = metrics.collect()
+    service_values, service_histograms = _service_metrics(db_service)
+    values.update(service_values)
+    histograms.update(service_histograms)
+
+    if job_manager is not None:
+        values.update(_job_metrics(job_manager))
+
+    if spool_manager is not None:
+        values.update(_spool_metrics(spool_manager))
+
+    lines = []
+
+    for name, (metric_type, description) in sorted(METRICS.items()):
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} {}'.format(name, metric_type))
+
+        if metric_type == 'histogram':
+            for (_, labels), stats in sorted(((key, stats) for key, stats in histograms.items() if key[0] == name), key=lambda item: item[0]):
+                lines.extend(_format_histogram(name, labels, stats))
+        else:
+            for (_, labels), value in sorted(((key, value) for key, value in values.items() if key[0] == name), key=lambda item: item[0]):
+                lines.append('{}{} {}'.format(name, _format_labels(labels), value))
+
+    return '\n'.join(lines) + '\n'
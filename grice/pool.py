@@ -0,0 +1,222 @@
+import bisect
+import logging
+import threading
+import time
+
+from sqlalchemy import event, exc, select
+from sqlalchemy.pool import QueuePool
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+DEFAULT_POOL_SIZE = 5
+DEFAULT_MAX_OVERFLOW = 10
+DEFAULT_POOL_TIMEOUT = 30
+DEFAULT_POOL_RECYCLE = -1
+WAIT_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30]
+
+
+class Histogram:
+    """
+    A thread safe histogram with fixed bucket upper bounds. Counts are cumulative, so each bucket holds the number of
+    observations less than or equal to its bound, the same way Prometheus histograms are reported.
+    """
+    def __init__(self, buckets: list):
+        self.buckets = sorted(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        idx = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            self._counts[idx] += 1
+            self._sum += value
+
+    def stats(self):
+        """
+        :return: dict with "buckets" (a list of [upper bound, cumulative count] pairs, the last bound is "+Inf"),
+            "count" and "sum".
+        """
+        with self._lock:
+            counts, total = list(self._counts), self._sum
+
+        cumulative = []
+        running = 0
+
+        for bound, bucket_count in zip(self.buckets + ['+Inf'], counts):
+            running += bucket_count
+            cumulative.append([bound, running])
+
+        return {'buckets': cumulative, 'count': running, 'sum': total}
+
+
+class PoolStats:
+    """
+    Counters for the events of a connection pool.
+    """
+    def __init__(self):
+        self.waits = Histogram(WAIT_BUCKETS)
+        self.overflows = 0
+        self.timeouts = 0
+        self.invalidations = 0
+        # Only counted for pools that don't report it themselves, see instrument_engine.
+        self.checked_out = 0
+        self._lock = threading.Lock()
+
+    def increment(self, name: str, amount: int = 1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+
+class InstrumentedQueuePool(QueuePool):
+    """
+    A QueuePool that records how long each checkout waits for a connection, how often connections beyond pool_size are
+    opened, and how often checkouts time out.
+    """
+    def __init__(self, creator, **kwargs):
+        super().__init__(creator, **kwargs)
+        self.stats = PoolStats()
+
+    def _do_get(self):
+        overflow = self.overflow()
+        start = time.monotonic()
+
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            self.stats.increment('timeouts')
+            raise
+        finally:
+            self.stats.waits.observe(time.monotonic() - start)
+
+        if self.overflow() > max(overflow, 0):
+            self.stats.increment('overflows')
+
+        return connection
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.stats = self.stats
+
+        return pool
+
+
+def pool_options(db_config, dialect_name: str = None):
+    """
+    Reads the connection pool settings from the database config section.
+
+    SQLite connections can only be used by the thread that opened them, so SQLite databases keep SQLAlchemy's default
+    pool, which doesn't hand connections to other threads and has no size, overflow or timeout.
+
+    :param db_config: The database config section.
+    :param dialect_name: The name of the database dialect, i.e. "postgresql" or "sqlite".
+    :return: dict of create_engine keyword arguments.
+    """
+    options = {
+        'pool_recycle': db_config.getint('pool_recycle', DEFAULT_POOL_RECYCLE),
+    }
+
+    if dialect_name == 'sqlite':
+        return options
+
+    options.update({
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': db_config.getint('pool_size', DEFAULT_POOL_SIZE),
+        'max_overflow': db_config.getint('max_overflow', DEFAULT_MAX_OVERFLOW),
+        'pool_timeout': db_config.getint('pool_timeout', DEFAULT_POOL_TIMEOUT),
+    })
+
+    return options
+
+
+def _ping_connection(connection, branch):
+    """
+    Tests a connection when it is checked out, so connections the server closed while they sat in the pool are replaced
+    instead of failing the request that gets them.
+    """
+    if branch:
+        return
+
+    save_should_close_with_result = connection.should_close_with_result
+    connection.should_close_with_result = False
+
+    try:
+        connection.scalar(select([1]))
+    except exc.DBAPIError as err:
+        if not err.connection_invalidated:
+            raise
+
+        # The failed ping invalidated the pool, so this reconnects.
+        connection.scalar(select([1]))
+    finally:
+        connection.should_close_with_result = save_should_close_with_result
+
+
+def instrument_engine(db_engine, pre_ping: bool = False):
+    """
+    Registers the pool event listeners on an engine.
+
+    :param db_engine: SQLAlchemy engine created with pool_options.
+    :param pre_ping: If True every checkout tests its connection first.
+    """
+    def on_invalidate(dbapi_connection, connection_record, exception):  # pylint: disable=unused-argument
+        stats = getattr(db_engine.pool, 'stats', None)
+
+        if stats is not None:
+            stats.increment('invalidations')
+
+        log.warning('Database connection invalidated: %s', exception)
+
+    event.listen(db_engine.pool, 'invalidate', on_invalidate)
+
+    if not isinstance(db_engine.pool, QueuePool):
+        # Other pools, i.e. SQLite's default pool, don't count their connections.
+        db_engine.pool.stats = PoolStats()
+
+        def on_checkout(dbapi_connection, connection_record, connection_proxy):  # pylint: disable=unused-argument
+            db_engine.pool.stats.increment('checked_out')
+
+        def on_checkin(dbapi_connection, connection_record):  # pylint: disable=unused-argument
+            db_engine.pool.stats.increment('checked_out', -1)
+
+        event.listen(db_engine.pool, 'checkout', on_checkout)
+        event.listen(db_engine.pool, 'checkin', on_checkin)
+
+    if pre_ping:
+        event.listen(db_engine, 'engine_connect', _ping_connection)
+
+
+def pool_stats(db_engine):
+    """
+    Returns the current state and the event counters of an engine's connection pool.
+
+    :param db_engine: SQLAlchemy engine.
+    :return: dict
+    """
+    pool = db_engine.pool
+    stats = getattr(pool, 'stats', None)
+    data = {'status': pool.status()}
+
+    if isinstance(pool, QueuePool):
+        data.update({
+            'size': pool.size(),
+            'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(),
+            'overflow': max(pool.overflow(), 0),
+            'max_overflow': pool._max_overflow,  # pylint: disable=protected-access
+        })
+    elif stats is not None:
+        data['checked_out'] = stats.checked_out
+
+    if isinstance(pool, InstrumentedQueuePool):
+        data.update({
+            'wait_seconds': stats.waits.stats(),
+            'overflows': stats.overflows,
+            'timeouts': stats.timeouts,
+        })
+
+    if stats is not None:
+        data['invalidations'] = stats.invalidations
+
+    return data
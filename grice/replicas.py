@@ -0,0 +1,275 @@
+"""
+Read replicas.
+
+Every [replica:<name>] section of the config file declares a read replica of the [database], with the same connection
+and pool settings as the [database] section. Read queries (table queries, exports, counts and charts) are spread over
+the replicas, everything else (reflection, rollup refreshes) runs on the primary.
+
+Replicas are checked every replica_check_interval seconds. A replica is taken out of rotation when its check fails,
+when connecting to it fails, or when it lags more than its max_lag seconds behind the primary, and is put back once a
+check succeeds. If no replica is available reads go to the primary.
+"""
+import logging
+import threading
+from contextlib import contextmanager
+
+from sqlalchemy import exc, select
+
+from grice import pool
+from grice.errors import ConfigurationError
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+SECTION_PREFIX = 'replica:'
+BALANCING_POLICIES = ['least_outstanding', 'round_robin']
+DEFAULT_BALANCING = 'least_outstanding'
+DEFAULT_CHECK_INTERVAL = 10
+DEFAULT_MAX_LAG = 30
+# Seconds since the last transaction replayed from the primary, or 0 if the replica replayed all the WAL it received,
+# so an idle primary doesn't look like lag. Requires PostgreSQL 10 or newer. Replicas that don't stream WAL have no
+# receive LSN, they always report the time since the last replayed transaction, which grows while the primary is idle.
+LAG_QUERIES = {
+    'postgresql': 'SELECT CASE WHEN NOT pg_is_in_recovery() THEN 0 '
+                  'WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+                  'ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END',
+}
+
+
+class Replica:
+    def __init__(self, name: str, db_engine, max_lag: int = DEFAULT_MAX_LAG, lag_query: str = None):
+        """
+        A read replica and its state.
+
+        :param name: The name of the replica, from its config section.
+        :param db_engine: SQLAlchemy engine connected to the replica.
+        :param max_lag: Seconds the replica may lag behind the primary, 0 to ignore lag.
+        :param lag_query: A query returning the replica's lag in seconds, None if the lag can't be measured.
+        """
+        self.name = name
+        self.engine = db_engine
+        self.max_lag = max_lag
+        self.lag_query = lag_query
+        self.healthy = True
+        self.lag = None
+        self.error = None
+        self.outstanding = 0
+        self.queries = 0
+        self.failures = 0
+
+    @property
+    def available(self):
+        if not self.healthy:
+            return False
+
+        return not self.max_lag or self.lag is None or self.lag <= self.max_lag
+
+    def mark_failed(self, error: Exception):
+        if self.healthy:
+            log.warning('Replica %s failed, reads go to other replicas until it recovers: %s', self.name, error)
+
+        self.healthy = False
+        self.error = str(error)
+        self.failures += 1
+
+    def check(self):
+        """
+        Tests the connection to the replica and measures its lag.
+        """
+        try:
+            with self.engine.connect() as conn:
+                if self.lag_query is not None:
+                    lag = conn.scalar(self.lag_query)
+                    lag = float(lag) if lag is not None else None
+                else:
+                    conn.scalar(select([1]))
+                    lag = None
+        except exc.DBAPIError as e:
+            self.mark_failed(e)
+            return
+
+        if not self.healthy:
+            log.info('Replica %s recovered', self.name)
+
+        self.healthy = True
+        self.error = None
+        self.lag = lag
+
+        if not self.available:
+            log.warning('Replica %s lags %.1fs behind the primary, more than its max_lag of %ss', self.name, lag,
+                        self.max_lag)
+
+    def stats(self):
+        return {
+            'healthy': self.healthy,
+            'available': self.available,
+            'lag': self.lag,
+            'error': self.error,
+            'outstanding': self.outstanding,
+            'queries': self.queries,
+            'failures': self.failures,
+            'pool': pool.pool_stats(self.engine),
+        }
+
+
+class ReplicaRouter:
+    """
+    Chooses the connection for each read query.
+
+    With the least_outstanding policy reads go to the available replica running the fewest queries, ties are broken
+    round-robin. With round_robin reads go to each available replica in turn.
+    """
+    def __init__(self, primary, replicas: list, balancing: str = DEFAULT_BALANCING,
+                 check_interval: int = DEFAULT_CHECK_INTERVAL):
+        self.primary = primary
+        self.replicas = replicas
+        self.balancing = balancing
+        self.check_interval = check_interval
+        self.fallbacks = 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def _candidates(self):
+        """
+        Returns the available replicas in the order they should be tried.
+        """
+        with self._lock:
+            available = [replica for replica in self.replicas if replica.available]
+
+            if not available:
+                return []
+
+            start = self._next % len(available)
+            self._next += 1
+            ordered = available[start:] + available[:start]
+
+            if self.balancing == 'least_outstanding':
+                ordered.sort(key=lambda replica: replica.outstanding)
+
+            return ordered
+
+    def _connect_replica(self):
+        """
+        Connects to the first replica that accepts a connection, in the order of the balancing policy.
+
+        :return: replica, connection. Both are None if no replica accepted a connection.
+        """
+        for replica in self._candidates():
+            try:
+                conn = replica.engine.connect()
+            except exc.DBAPIError as e:
+                replica.mark_failed(e)
+                continue
+
+            with self._lock:
+                replica.outstanding += 1
+                replica.queries += 1
+
+            return replica, conn
+
+        return None, None
+
+    @contextmanager
+    def connect(self):
+        """
+        Returns a connection for a read query, from a replica if one is available, otherwise from the primary. A
+        replica whose connection breaks during the query is taken out of rotation, but the query's error is raised.
+        """
+        replica, conn = self._connect_replica()
+
+        if replica is None:
+            with self._lock:
+                self.fallbacks += 1
+
+            with self.primary.connect() as conn:
+                yield conn
+
+            return
+
+        try:
+            with conn:
+                yield conn
+        except exc.DBAPIError as e:
+            if e.connection_invalidated:
+                replica.mark_failed(e)
+
+            raise
+        finally:
+            with self._lock:
+                replica.outstanding -= 1
+
+    def check(self):
+        for replica in self.replicas:
+            replica.check()
+
+    def stats(self):
+        with self._lock:
+            fallbacks = self.fallbacks
+
+        return {
+            'balancing': self.balancing,
+            'fallbacks': fallbacks,
+            'replicas': {replica.name: replica.stats() for replica in self.replicas},
+        }
+
+
+class ReplicaChecker(threading.Thread):
+    """
+    Checks the replicas every check_interval seconds, starting right away.
+    """
+    def __init__(self, router: ReplicaRouter):
+        super().__init__(name='grice-replica-checker', daemon=True)
+        self.router = router
+        self._stopped = threading.Event()
+
+    def run(self):
+        while True:
+            try:
+                self.router.check()
+            except Exception:  # pylint: disable=broad-except
+                log.exception('Checking replicas failed')
+
+            if self._stopped.wait(self.router.check_interval):
+                return
+
+    def stop(self):
+        self._stopped.set()
+
+
+def init_replicas(primary, db_config, replica_configs, init_database):
+    """
+    Creates a ReplicaRouter for the replicas declared in the config file.
+
+    :param primary: SQLAlchemy engine of the primary database.
+    :param db_config: The [database] config section, for the balancing and check interval settings.
+    :param replica_configs: list of [replica:<name>] config sections, can be None.
+    :param init_database: Function that creates an engine from a config section, see db_service.init_database.
+    :return: ReplicaRouter, or None if no replicas are configured.
+    """
+    if not replica_configs:
+        return None
+
+    balancing = db_config.get('replica_balancing', DEFAULT_BALANCING)
+    check_interval = db_config.getint('replica_check_interval', DEFAULT_CHECK_INTERVAL)
+
+    if balancing not in BALANCING_POLICIES:
+        raise ConfigurationError('Invalid replica_balancing "{}", valid policies: {}'.format(balancing,
+                                                                                            BALANCING_POLICIES))
+
+    if check_interval <= 0:
+        raise ConfigurationError('replica_check_interval must be greater than 0')
+
+    replicas = []
+
+    for replica_config in replica_configs:
+        name = replica_config.name[len(SECTION_PREFIX):]
+        db_engine = init_database(replica_config)
+
+        if db_engine.dialect.name != primary.dialect.name:
+            raise ConfigurationError('Replica "{}" uses {}, the primary database uses {}'.format(
+                name, db_engine.dialect.name, primary.dialect.name))
+
+        lag_query = replica_config.get('lag_query', LAG_QUERIES.get(db_engine.dialect.name, None))
+        replicas.append(Replica(name, db_engine, replica_config.getint('max_lag', DEFAULT_MAX_LAG), lag_query))
+        log.info('Read replica %s at %s', name, db_engine.url.host or db_engine.url.database)
+
+    return ReplicaRouter(primary, replicas, balancing, check_interval)
@@ -0,0 +1,954 @@
+"""
+Result spools.
+
+Tables are mostly browsed by paging through a slow query, then sorting it and narrowing it down. When a table query
+takes longer than threshold milliseconds, its whole result (the selected columns, without page, perPage or sort) is
+fetched in the background and written to a spool file in dir, an uncompressed Arrow IPC file that is memory-mapped
+once written. Later queries with the same table, columns and join are answered from the spool instead of the database
+when:
+
+- their filters are the spool's filters with more filters ANDed to them, on columns of the spool. Filters on strings
+  are only evaluated on databases that compare strings the way Arrow does (byte by byte), on other databases they go to
+  the database.
+- they sort on columns of the spool, under the same string rule.
+
+Pages are slices of the memory-mapped file, so the first pages of the unsorted result are read without copying. Sorted
+or filtered views of the result are computed once and kept with the spool. Rows come out in the order the database
+returns them, ties included, and "after" tokens work the same way on the database and the spool.
+
+A spool is dropped ttl seconds after it was written, when the database schema changes, and on PostgreSQL when the
+statistics of one of its tables (pg_stat_user_tables) show rows were inserted, updated or deleted. They are checked at
+most every check_interval seconds, and changes show up in them within about a second. Other databases only drop spools
+by their ttl, so set it to the staleness the users can live with.
+
+Results with more than max_rows rows, or with columns whose values don't survive the round trip through Arrow (i.e.
+JSON, binary data, computed columns), are not spooled. The background query skips admission control, one spool is
+written at a time.
+"""
+import bisect
+import datetime
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import accumulate
+
+from sqlalchemy import Column
+from sqlalchemy.sql import sqltypes
+
+from grice import keyset, row_counts, timing
+from grice.arrow_export import RecordBatchBuilder, arrow_type
+from grice.complex_filter import ColumnFilter, ComplexFilter
+from grice.db_service import QueryArguments, column_label, column_to_dict, get_sort_columns, matches_nothing, \
+    names_to_columns, normalize_query_filters
+from grice.errors import ConfigurationError, QueryCancelledError
+
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None  # pylint: disable=invalid-name
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+DEFAULT_THRESHOLD = 1000
+DEFAULT_MAX_ROWS = 1000000
+DEFAULT_TTL = 600
+DEFAULT_MAX_SPOOLS = 10
+DEFAULT_CHECK_INTERVAL = 5
+SPOOL_PREFIX = 'grice-spool-'
+SPOOL_SUFFIX = '.arrow'
+# The spool files and their temporary files, only these are removed from dir at startup.
+SPOOL_FILE_PATTERN = re.compile(r'^{}[0-9a-f]{{32}}{}(\.tmp)?$'.format(re.escape(SPOOL_PREFIX),
+                                                                   re.escape(SPOOL_SUFFIX)))
+# Sorted and filtered views kept per spool.
+MAX_VIEWS = 8
+# Pages of sorted or filtered views with more rows are copied with a take instead of slicing out every row.
+MAX_ROW_SLICES = 1000
+# Databases that sort NULL after every other value, the others sort it first.
+NULLS_LAST_DIALECTS = ['postgresql', 'oracle']
+# Databases whose default collation compares strings byte by byte, like Arrow, and those whose string equality does.
+STRING_ORDER_DIALECTS = ['sqlite']
+STRING_EQUALITY_DIALECTS = ['postgresql', 'sqlite']
+STRING_EQUALITY_FILTERS = ['eq', 'neq', 'in', 'not_in']
+
+
+def _and_children(filters):
+    """
+    Returns the filters ANDed at the top of a normalized filter tree.
+    """
+    if filters is None:
+        return []
+
+    if isinstance(filters, ComplexFilter) and filters.is_and:
+        return list(filters.list_of_filters)
+
+    return [filters]
+
+
+def extra_filters(spool_filters, filters, table_name: str):
+    """
+    Returns the filters a query adds to the filters of a spool.
+
+    :param spool_filters: The normalized filters of the spool.
+    :param filters: The normalized filters of the query.
+    :param table_name: The name of the queried table, for the filter keys.
+    :return: list of filters, or None if the query doesn't keep every filter of the spool.
+    """
+    spool_keys = {f.cache_key(table_name) for f in _and_children(spool_filters)}
+    children = _and_children(filters)
+    keys = {f.cache_key(table_name) for f in children}
+
+    if not spool_keys <= keys:
+        return None
+
+    return [f for f in children if f.cache_key(table_name) not in spool_keys]
+
+
+def _compare(array, filter_type: str, value):
+    compute = pyarrow.compute
+
+    if filter_type == 'lt':
+        return compute.less(array, value)
+
+    if filter_type == 'lte':
+        return compute.less_equal(array, value)
+
+    if filter_type == 'eq':
+        return compute.equal(array, value)
+
+    if filter_type == 'neq':
+        return compute.not_equal(array, value)
+
+    if filter_type == 'gt':
+        return compute.greater(array, value)
+
+    if filter_type == 'gte':
+        return compute.greater_equal(array, value)
+
+    if filter_type in ['in', 'not_in']:
+        mask = compute.is_in(array, value_set=pyarrow.array(value, type=array.type))
+    else:
+        low, high = value
+        mask = compute.and_(compute.greater_equal(array, low), compute.less_equal(array, high))
+
+    return mask if filter_type in ['in', 'bt'] else compute.invert(mask)
+
+
+class ResultSpool:  # pylint: disable=too-many-instance-attributes
+    def __init__(self, table_name: str, tables: list, quargs: QueryArguments, columns: list, keys: list,
+                 path: str):  # pylint: disable=too-many-arguments
+        """
+        The memory-mapped result of a query, see the module docstring.
+
+        :param table_name: The name of the queried table.
+        :param tables: The main table followed by the joined tables.
+        :param quargs: QueryArguments of the spooled query, with normalized filters.
+        :param columns: The selected columns.
+        :param keys: The (column, direction) keyset columns of the spooled query: the primary keys, ascending.
+        :param path: The spool file.
+        """
+        self.table_name = table_name
+        self.tables = tables
+        self.filters = quargs.filters
+        self.columns = columns
+        self.keys = keys
+        self.path = path
+        self.table = None
+        self.batches = []
+        # The position of the first row of each record batch.
+        self.batch_starts = []
+        self.bytes = 0
+        self.expires = None
+        self.schema_version = None
+        self.versions = None
+        self.checked = None
+        # Selected and keyset columns, with the name of their field in the file.
+        self.fields = [(column, 'c{}'.format(idx)) for idx, column in enumerate(columns)]
+        self.fields += [(column, 'k{}'.format(idx)) for idx, (column, _) in enumerate(keys)]
+        # Timezone aware columns store UTC times, the offsets the database returned are kept in a separate field.
+        self.offsets = {}
+        self._views = OrderedDict()
+        self._lock = threading.Lock()
+        # Reads in progress, the spool is only removed once the last one is done.
+        self._readers = 0
+        self._deleted = False
+
+    def write(self, batches, max_rows: int):
+        """
+        Writes the rows of the spooled query and memory-maps the file.
+
+        :param batches: iterable of lists of rows, each row being the selected values followed by the keyset values.
+        :param max_rows: The number of rows above which writing stops.
+        :return: True if the result was written, False if it has too many rows or columns Arrow can't hold as is.
+        """
+        builder = RecordBatchBuilder([column for column, _ in self.fields])
+        offset_fields = [idx for idx, column in enumerate(self.columns)
+                         if isinstance(column.type, sqltypes.DateTime) and column.type.timezone]
+        names = [name for _, name in self.fields] + ['o{}'.format(idx) for idx in offset_fields]
+        temp_path = self.path + '.tmp'
+        rows = 0
+
+        def to_record_batch(batch):
+            record_batch = builder.build(batch)
+            offsets = [pyarrow.array([_utc_offset(row[idx]) for row in batch], pyarrow.int32())
+                       for idx in offset_fields]
+
+            return pyarrow.RecordBatch.from_arrays(record_batch.columns + offsets, names=names)
+
+        try:
+            with pyarrow.OSFile(temp_path, 'wb') as sink:
+                writer = None
+
+                try:
+                    for batch in batches:
+                        rows += len(batch)
+
+                        if rows > max_rows:
+                            return False
+
+                        record_batch = to_record_batch(batch)
+
+                        if writer is None:
+                            if not self._lossless(builder):
+                                return False
+
+                            writer = pyarrow.ipc.new_file(sink, record_batch.schema)
+
+                        writer.write_batch(record_batch)
+
+                    if writer is None:
+                        writer = pyarrow.ipc.new_file(sink, to_record_batch([]).schema)
+                finally:
+                    if writer is not None:
+                        writer.close()
+
+            os.replace(temp_path, self.path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+        self.table = pyarrow.ipc.open_file(pyarrow.memory_map(self.path, 'r')).read_all()
+        self.batches = self.table.to_batches()
+        self.batch_starts = list(accumulate([0] + [batch.num_rows for batch in self.batches[:-1]]))
+        self.bytes = os.path.getsize(self.path)
+        self.offsets = {'c{}'.format(idx): 'o{}'.format(idx) for idx in offset_fields}
+
+        return True
+
+    def _lossless(self, builder: RecordBatchBuilder):
+        """
+        Returns True if Arrow holds the values of every field as the database returned them, so rows read from the spool
+        are the rows the database would return.
+        """
+        for (column, _), (field_type, _) in zip(self.fields, builder.fields):
+            declared_type, converter = arrow_type(column.type)
+
+            if field_type != declared_type:
+                return False
+
+            if converter is not None and not isinstance(column.type, sqltypes.Float):
+                return False
+
+        return True
+
+    @contextmanager
+    def pinned(self):
+        """
+        Keeps the spool from being removed while the context runs, so it can be read while another thread drops it.
+
+        :return: Context manager that yields True, or False if the spool was deleted and can't be read anymore.
+        """
+        with self._lock:
+            readable = not self._deleted
+
+            if readable:
+                self._readers += 1
+
+        if not readable:
+            yield False
+            return
+
+        try:
+            yield True
+        finally:
+            with self._lock:
+                self._readers -= 1
+                remove = self._deleted and self._readers == 0
+
+            if remove:
+                self._remove()
+
+    def delete(self):
+        """
+        Deletes the spool. If it is being read, it is removed when the last read is done (see pinned).
+        """
+        with self._lock:
+            self._deleted = True
+            remove = self._readers == 0
+
+        if remove:
+            self._remove()
+
+    def _remove(self):
+        self.table = None
+        self.batches = []
+        self._views.clear()
+
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def field_name(self, column):
+        for field_column, name in self.fields:
+            if field_column is column:
+                return name
+
+        return None
+
+    def _array(self, column, dialect_name: str, filter_type: str = None):
+        """
+        Returns the values of a column, or None if the column isn't spooled, or if Arrow can't filter or sort on it
+        the way the database does.
+        """
+        name = self.field_name(column)
+
+        if name is None:
+            return None
+
+        array = self.table.column(name)
+
+        if pyarrow.types.is_string(array.type):
+            if filter_type in STRING_EQUALITY_FILTERS:
+                if dialect_name not in STRING_EQUALITY_DIALECTS:
+                    return None
+            elif dialect_name not in STRING_ORDER_DIALECTS:
+                return None
+
+        return array
+
+    def _filter_mask(self, column_filter, dialect_name: str):
+        """
+        Evaluates a filter on the spool.
+
+        :return: Boolean array, or None if the filter can't be evaluated on the spool.
+        """
+        if isinstance(column_filter, ComplexFilter):
+            mask = None
+
+            for child in column_filter.list_of_filters:
+                child_mask = self._filter_mask(child, dialect_name)
+
+                if child_mask is None:
+                    return None
+
+                if mask is None:
+                    mask = child_mask
+                elif column_filter.is_and:
+                    mask = pyarrow.compute.and_(mask, child_mask)
+                else:
+                    mask = pyarrow.compute.or_(mask, child_mask)
+
+            return mask
+
+        if not isinstance(column_filter, ColumnFilter) or column_filter.column is None:
+            return None
+
+        value = column_filter.value
+        values = list(value) if isinstance(value, (list, tuple)) else [value]
+
+        # NULL values compile to IS NULL, or make NOT IN match nothing.
+        if any(v is None for v in values):
+            return None
+
+        array = self._array(column_filter.column, dialect_name, column_filter.filter_type)
+
+        if array is None:
+            return None
+
+        try:
+            mask = _compare(array, column_filter.filter_type, value)
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowNotImplementedError, pyarrow.ArrowTypeError, TypeError,
+                ValueError):
+            return None
+
+        # A comparison with NULL is never true in SQL, not even under NOT.
+        return pyarrow.compute.if_else(pyarrow.compute.is_valid(array), mask, False)
+
+    def _sort_keys(self, sort_columns: list, dialect_name: str):
+        """
+        Returns the table of sort keys and the sort keys for pyarrow.compute.sort_indices, or None, None if a sort can't
+        be done on the spool. NULLs are sorted where the database puts them by sorting on whether a value is NULL first.
+        """
+        arrays = OrderedDict()
+        sort_keys = []
+
+        for idx, (column, direction) in enumerate(sort_columns):
+            array = self._array(column, dialect_name)
+
+            if array is None:
+                return None, None
+
+            order = 'ascending' if direction == 'asc' else 'descending'
+
+            if array.null_count:
+                nulls_last = dialect_name in NULLS_LAST_DIALECTS
+                arrays['n{}'.format(idx)] = pyarrow.compute.is_null(array)
+                null_order = order if nulls_last else ('descending' if order == 'ascending' else 'ascending')
+                sort_keys.append(('n{}'.format(idx), null_order))
+
+            arrays['s{}'.format(idx)] = array
+            sort_keys.append(('s{}'.format(idx), order))
+
+        return pyarrow.table(arrays), sort_keys
+
+    def view(self, sort_columns: list, filters: list, dialect_name: str):
+        """
+        Returns the rows of the spool that match filters, in the order of sort_columns, as positions in the spool.
+
+        The spool is in primary key order, and the database orders ties on the sort columns by the primary keys, in
+        the direction of the last sort. Arrow's sort is stable, so ties keep the spool's order. For a descending last
+        sort the rows are sorted with every direction reversed, and the result is reversed.
+
+        :param sort_columns: list of (column, direction) tuples.
+        :param filters: The filters to apply on top of the spool's filters.
+        :param dialect_name: The name of the database dialect.
+        :return: Array of positions, or None if all rows match in spool order. False if the view can't be computed on
+            the spool.
+        """
+        key = (tuple((column_label(column), direction) for column, direction in sort_columns),
+               tuple(sorted(repr(f.cache_key(self.table_name)) for f in filters)))
+
+        with self._lock:
+            if key in self._views:
+                self._views.move_to_end(key)
+                return self._views[key]
+
+        positions = self._compute_view(sort_columns, filters, dialect_name)
+
+        with self._lock:
+            self._views[key] = positions
+
+            while len(self._views) > MAX_VIEWS:
+                self._views.popitem(last=False)
+
+        return positions
+
+    def _compute_view(self, sort_columns: list, filters: list, dialect_name: str):
+        mask = None
+
+        for column_filter in filters:
+            filter_mask = self._filter_mask(column_filter, dialect_name)
+
+            if filter_mask is None:
+                return False
+
+            mask = filter_mask if mask is None else pyarrow.compute.and_(mask, filter_mask)
+
+        positions = pyarrow.compute.indices_nonzero(mask) if mask is not None else None
+
+        if not sort_columns:
+            return positions
+
+        reverse = sort_columns[-1][1] == 'desc'
+
+        if reverse:
+            sort_columns = [(column, 'desc' if direction == 'asc' else 'asc') for column, direction in sort_columns]
+
+        keys_table, sort_keys = self._sort_keys(sort_columns, dialect_name)
+
+        if keys_table is None:
+            return False
+
+        if mask is not None:
+            keys_table = keys_table.filter(mask)
+
+        order = pyarrow.compute.sort_indices(keys_table, sort_keys=sort_keys)
+
+        if reverse:
+            order = order[::-1]
+
+        return positions.take(order) if positions is not None else order
+
+    def locate(self, key_columns: list, values: list, positions):
+        """
+        Finds the row of an "after" token in a view.
+
+        :param key_columns: The keyset columns of the query.
+        :param values: The values of the token.
+        :param positions: The view, see view.
+        :return: The index of the row in the view, or None if it isn't in the view.
+        """
+        mask = None
+
+        for column, _ in self.keys:
+            idx = next(idx for idx, key_column in enumerate(key_columns) if key_column is column)
+            array = self.table.column(self.field_name(column))
+            column_mask = pyarrow.compute.equal(array, values[idx])
+            mask = column_mask if mask is None else pyarrow.compute.and_(mask, column_mask)
+
+        matches = pyarrow.compute.indices_nonzero(mask)
+
+        if len(matches) != 1:
+            return None
+
+        position = matches[0].as_py()
+
+        if positions is None:
+            return position
+
+        index = pyarrow.compute.index(positions, position).as_py()
+
+        return index if index >= 0 else None
+
+    def read(self, positions, start: int, stop: int):
+        """
+        Returns rows start to stop (exclusive, None for all) of a view. Unfiltered, unsorted pages are zero-copy slices
+        of the memory-mapped file.
+
+        :return: pyarrow.Table
+        """
+        if positions is None:
+            return self.table.slice(start, None if stop is None else stop - start)
+
+        positions = positions.slice(start, None if stop is None else stop - start)
+
+        if len(positions) > MAX_ROW_SLICES:
+            return self.table.take(positions)
+
+        # Taking a few rows out of a table of many record batches costs more than slicing them out one by one.
+        rows = []
+
+        for position in positions.to_pylist():
+            idx = bisect.bisect_right(self.batch_starts, position) - 1
+            rows.append(self.batches[idx].slice(position - self.batch_starts[idx], 1))
+
+        return pyarrow.Table.from_batches(rows, schema=self.table.schema)
+
+    def values(self, page, name: str):
+        """
+        Returns the values of a field of a page read from the spool, as the database returned them.
+        """
+        values = page.column(name).to_pylist()
+
+        if name in self.offsets:
+            offsets = page.column(self.offsets[name]).to_pylist()
+            values = [_to_offset(value, offset) for value, offset in zip(values, offsets)]
+
+        return values
+
+
+def _utc_offset(value):
+    if value is None or value.utcoffset() is None:
+        return None
+
+    return int(value.utcoffset().total_seconds())
+
+
+def _to_offset(value, offset):
+    if value is None or offset is None:
+        return value
+
+    return value.astimezone(datetime.timezone(datetime.timedelta(seconds=offset)))
+
+
+class SpoolManager:  # pylint: disable=too-many-instance-attributes
+    def __init__(self, db_service, spool_dir: str, threshold: int = DEFAULT_THRESHOLD,
+                 max_rows: int = DEFAULT_MAX_ROWS, ttl: int = DEFAULT_TTL, max_spools: int = DEFAULT_MAX_SPOOLS,
+                 check_interval: int = DEFAULT_CHECK_INTERVAL):  # pylint: disable=too-many-arguments
+        """
+        Answers table queries from result spools, and spools the results of slow queries, see the module docstring.
+
+        :param db_service: The DBService to run the queries with.
+        :param spool_dir: The directory for the spool files, created if it doesn't exist.
+        :param threshold: Milliseconds a table query must take for its result to be spooled.
+        :param max_rows: The number of rows above which results are not spooled.
+        :param ttl: Seconds a spool is used for.
+        :param max_spools: The number of spools kept, the least recently used are dropped first.
+        :param check_interval: Seconds between checks of a spool's tables for changes.
+        """
+        self.db_service = db_service
+        self.spool_dir = spool_dir
+        self.threshold = threshold
+        self.max_rows = max_rows
+        self.ttl = ttl
+        self.max_spools = max_spools
+        self.check_interval = check_interval
+        self.hits = 0
+        self.misses = 0
+        self._spools = OrderedDict()
+        # Keys of the results being spooled, and of results that can't be spooled, with when to try again.
+        self._building = set()
+        self._skipped = {}
+        self._lock = threading.Lock()
+        self._stopped = False
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        os.makedirs(spool_dir, exist_ok=True)
+        self._remove_old_spools()
+
+    def _remove_old_spools(self):
+        for file_name in os.listdir(self.spool_dir):
+            if SPOOL_FILE_PATTERN.match(file_name):
+                log.debug('Removing spool file %s of a previous run', file_name)
+                os.remove(os.path.join(self.spool_dir, file_name))
+
+    @property
+    def dialect_name(self):
+        return self.db_service.db.dialect.name
+
+    def query_table(self, table_name: str, quargs: QueryArguments):
+        """
+        Queries a table like DBService.query_table, from a spool if one can answer the query. Otherwise the query goes
+        to the database, and if it is slow its result is spooled in the background.
+
+        :return: rows, column_data, next_after
+        """
+        resolved = self._resolve(table_name, quargs)
+
+        if resolved is None:
+            return self.db_service.query_table(table_name, quargs)
+
+        tables, columns, normalized = resolved
+
+        with timing.stage('spool'):
+            result = self._answer(table_name, tables, columns, normalized)
+
+        timing.annotate(spooled=result is not None)
+
+        with self._lock:
+            if result is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if result is not None:
+            return result
+
+        started = time.monotonic()
+        result = self.db_service.query_table(table_name, quargs)
+
+        if (time.monotonic() - started) * 1000 >= self.threshold:
+            self._spool(table_name, tables, normalized)
+
+        return result
+
+    def _resolve(self, table_name: str, quargs: QueryArguments):
+        """
+        Resolves the tables, columns and filters of a query.
+
+        :return: tables, columns, normalized QueryArguments. None if the result of the query can't be spooled.
+        """
+        if quargs.group_by:
+            return None
+
+        table, join_tables = self.db_service._get_query_tables(table_name, quargs.joins)  # pylint: disable=protected-access
+        tables = [table] + join_tables
+        columns = names_to_columns(quargs.column_names, tables)
+
+        if not columns or not all(isinstance(column, Column) for column in columns):
+            return None
+
+        if any(join.outer_join for join in quargs.joins or []) or \
+                any(len(t.primary_key.columns) == 0 for t in tables):
+            # No keyset columns to order the spool by.
+            return None
+
+        quargs = normalize_query_filters(tables, quargs)
+
+        if matches_nothing(quargs):
+            return None
+
+        return tables, columns, quargs
+
+    @staticmethod
+    def _base_key(table_name: str, quargs: QueryArguments):
+        joins = tuple((join.table_name, tuple(join.column_pairs), join.outer_join) for join in quargs.joins or [])
+
+        return table_name, tuple(quargs.column_names or []), joins
+
+    def _answer(self, table_name: str, tables: list, columns: list, quargs: QueryArguments):
+        """
+        Answers a query from the first fresh spool that can, see the module docstring.
+
+        :return: rows, column_data, next_after, or None if no spool can answer the query.
+        """
+        base_key = self._base_key(table_name, quargs)
+
+        with self._lock:
+            spools = [(key, spool) for key, spool in self._spools.items() if key[:3] == base_key]
+
+        for key, spool in spools:
+            if not self._is_fresh(spool):
+                self._drop(key)
+                continue
+
+            filters = extra_filters(spool.filters, quargs.filters, table_name)
+
+            if filters is None:
+                continue
+
+            with spool.pinned() as readable:
+                result = self._read(spool, quargs, tables, columns, filters) if readable else None
+
+            if result is not None:
+                with self._lock:
+                    if key in self._spools:
+                        self._spools.move_to_end(key)
+
+                return result
+
+        return None
+
+    @staticmethod
+    def _keyset_columns(spool: ResultSpool, sort_columns: list):
+        """
+        Returns the keyset columns of a query answered from a spool, as get_keyset_columns does for the database.
+        """
+        keys = list(sort_columns)
+        direction = keys[-1][1] if keys else 'asc'
+
+        for column, _ in spool.keys:
+            if not any(column is key for key, _ in keys):
+                keys.append((column, direction))
+
+        return keys
+
+    def _read(self, spool: ResultSpool, quargs: QueryArguments, tables: list, columns: list,
+              filters: list):  # pylint: disable=too-many-arguments,too-many-locals
+        sort_columns = get_sort_columns(tables, quargs.sorts or [])
+        positions = spool.view(sort_columns, filters, self.dialect_name)
+
+        if positions is False:
+            return None
+
+        if any(column.nullable for column, _ in sort_columns):
+            # The database pages these with OFFSET and has no "after" tokens for them, see get_keyset_columns.
+            if quargs.after is not None:
+                return None
+
+            keys = None
+        else:
+            keys = self._keyset_columns(spool, sort_columns)
+
+        start = quargs.page * quargs.per_page if quargs.per_page > -1 else 0
+
+        if quargs.after is not None:
+            key_names = [column.table.name + '.' + column.name for column, _ in keys]
+
+            try:
+                values = keyset.decode_token(quargs.after, key_names)
+                index = spool.locate([column for column, _ in keys], values, positions)
+            except (ValueError, pyarrow.ArrowInvalid, pyarrow.ArrowNotImplementedError, pyarrow.ArrowTypeError,
+                    TypeError):
+                return None
+
+            if index is None:
+                return None
+
+            start = index + 1
+
+        page = spool.read(positions, start, start + quargs.per_page if quargs.per_page > -1 else None)
+        values = [spool.values(page, spool.field_name(column)) for column in columns]
+        rows = [list(row) for row in zip(*values)]
+        next_after = None
+
+        if keys is not None and rows and len(rows) == quargs.per_page:
+            key_names = [column.table.name + '.' + column.name for column, _ in keys]
+            last = [spool.values(page.slice(len(rows) - 1), spool.field_name(column))[0] for column, _ in keys]
+            next_after = keyset.encode_token(key_names, last)
+
+        timing.annotate(rows=len(rows))
+
+        with timing.stage('format'):
+            if not quargs.format_as_list:
+                labels = [column_label(column) for column in columns]
+                rows = [dict(zip(labels, row)) for row in rows]
+
+            column_data = [column_to_dict(column) for column in columns]
+
+        return rows, column_data, next_after
+
+    def _table_versions(self, tables: list):
+        """
+        Returns the modification counters of tables (see row_counts.table_modifications), or None if the database
+        doesn't keep any.
+        """
+        if self.dialect_name not in row_counts.ESTIMATE_DIALECTS:
+            return None
+
+        with self.db_service.db.connect() as conn:
+            return [row_counts.table_modifications(conn, table) for table in tables]
+
+    def _is_fresh(self, spool: ResultSpool):
+        now = time.monotonic()
+
+        if now >= spool.expires or spool.schema_version != self.db_service.schema_version:
+            return False
+
+        if spool.versions is None or now - spool.checked < self.check_interval:
+            return True
+
+        spool.checked = now
+        fresh = self._table_versions(spool.tables) == spool.versions
+
+        if not fresh:
+            log.debug('Dropping the spool of a query on table %s, its tables changed', spool.table_name)
+
+        return fresh
+
+    def _drop(self, key):
+        with self._lock:
+            spool = self._spools.pop(key, None)
+
+        if spool is not None:
+            spool.delete()
+
+    def _spool(self, table_name: str, tables: list, quargs: QueryArguments):
+        """
+        Queues the result of a query (without its page, sort and "after" token) to be spooled, unless it is already
+        spooled or being spooled.
+        """
+        filters_key = quargs.filters.cache_key(table_name) if quargs.filters is not None else None
+        key = self._base_key(table_name, quargs) + (filters_key,)
+        now = time.monotonic()
+
+        with self._lock:
+            if self._stopped or key in self._spools or key in self._building or self._skipped.get(key, 0) > now:
+                return
+
+            self._building.add(key)
+
+        base = quargs._replace(page=0, per_page=self.max_rows + 1, sorts=None, after=None, format_as_list=True)
+        self._executor.submit(self._build, key, table_name, tables, base, self.db_service.schema_version)
+
+    def _build(self, key, table_name: str, tables: list, quargs: QueryArguments, schema_version: int):  # pylint: disable=too-many-arguments
+        """
+        Spools a result on the spooling thread, see _spool.
+        """
+        spool = self._write_spool(table_name, tables, quargs)
+        evicted = []
+
+        with self._lock:
+            self._building.discard(key)
+            now = time.monotonic()
+            self._skipped = {k: until for k, until in self._skipped.items() if until > now}
+
+            if spool is None:
+                self._skipped[key] = now + self.ttl
+            elif self._stopped:
+                evicted.append(spool)
+            else:
+                spool.expires = now + self.ttl
+                spool.schema_version = schema_version
+                spool.checked = now
+                self._spools[key] = spool
+
+                while len(self._spools) > self.max_spools:
+                    evicted.append(self._spools.popitem(last=False)[1])
+
+        for old in evicted:
+            old.delete()
+
+    def _write_spool(self, table_name: str, tables: list, quargs: QueryArguments):
+        """
+        Runs the query of a spool and writes its result.
+
+        :return: ResultSpool, or None if the result can't be spooled.
+        """
+        started = time.monotonic()
+        path = os.path.join(self.spool_dir, SPOOL_PREFIX + uuid.uuid4().hex + SPOOL_SUFFIX)
+        batches = None
+
+        try:
+            # Read before the query, so changes made while it runs drop the spool.
+            versions = self._table_versions(tables)
+            batches, columns, keys = self.db_service.stream_keyed_batches(table_name, quargs,
+                                                                          disconnected=lambda: self._stopped)
+
+            if keys is None:
+                return None
+
+            spool = ResultSpool(table_name, tables, quargs, columns, keys, path)
+
+            if not spool.write(batches, self.max_rows):
+                log.info('Not spooling the result of a query on table %s, it has more than %s rows or columns that '
+                         'can\'t be spooled', table_name, self.max_rows)
+                return None
+        except QueryCancelledError:
+            return None
+        except Exception:  # pylint: disable=broad-except
+            log.exception('Spooling the result of a query on table %s failed', table_name)
+            return None
+        finally:
+            if batches is not None:
+                batches.close()
+
+        spool.versions = versions
+        log.info('Spooled %s rows of a query on table %s in %.1fs', spool.table.num_rows, table_name,
+                 time.monotonic() - started)
+
+        return spool
+
+    def stats(self):
+        with self._lock:
+            spools = list(self._spools.values())
+
+            return {
+                'spools': len(spools),
+                'bytes': sum(spool.bytes for spool in spools),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+    def shutdown(self):
+        with self._lock:
+            self._stopped = True
+            spools = list(self._spools.values())
+            self._spools.clear()
+
+        self._executor.shutdown(wait=True)
+
+        for spool in spools:
+            spool.delete()
+
+
+def init_spools(db_service, spool_config):
+    """
+    Creates the SpoolManager for the [spool] config section.
+
+    :param db_service: The DBService to run the queries with.
+    :param spool_config: The [spool] config section, None disables result spools.
+    :return: SpoolManager, or None if result spools are disabled.
+    """
+    if spool_config is None:
+        return None
+
+    if pyarrow is None:
+        raise ConfigurationError('The pyarrow package is required to spool query results')
+
+    spool_dir = spool_config.get('dir', os.path.join(tempfile.gettempdir(), 'grice_spool'))
+    max_spools = spool_config.getint('max_spools', DEFAULT_MAX_SPOOLS)
+
+    if max_spools < 1:
+        raise ConfigurationError('The [spool] max_spools must be at least 1')
+
+    dialect_name = db_service.db.dialect.name
+
+    if dialect_name not in row_counts.ESTIMATE_DIALECTS:
+        log.warning('Changes to the tables of %s databases are not detected, spooled results are used until their ttl '
+                    'expires.', dialect_name)
+
+    return SpoolManager(db_service, spool_dir,
+                        spool_config.getint('threshold', DEFAULT_THRESHOLD),
+                        spool_config.getint('max_rows', DEFAULT_MAX_ROWS),
+                        spool_config.getint('ttl', DEFAULT_TTL),
+                        max_spools,
+                        spool_config.getint('check_interval', DEFAULT_CHECK_INTERVAL))
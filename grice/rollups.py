@@ -0,0 +1,454 @@
+import datetime
+import logging
+import threading
+import time
+
+from sqlalchemy import MetaData, Table, Column, BigInteger, Float, Integer, Numeric, select, func, cast, case
+from sqlalchemy.engine import reflection
+
+from grice.complex_filter import ComplexFilter
+from grice.errors import ConfigurationError
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+SECTION_PREFIX = 'rollup:'
+DEFAULT_ROLLUP_REFRESH_INTERVAL = 3600
+GRAINS = ['minute', 'hour', 'day', 'week', 'month', 'year']
+ROW_COUNT = 'row_count'
+# Filters on the time column can only be answered by a rollup if they select whole grains.
+TIME_FILTERS = ['gte', 'lt']
+
+
+def _parse_names(value: str):
+    return [name.strip() for name in value.split(',') if name.strip()]
+
+
+def _measure_column(column_name: str, func_name: str):
+    return '{}__{}'.format(column_name, func_name)
+
+
+def truncate(value, grain: str):
+    """
+    Truncates a date or datetime to the start of its grain, the same way date_trunc does.
+    """
+    if not isinstance(value, datetime.datetime):
+        value = datetime.datetime.combine(value, datetime.time())
+
+    if grain == 'minute':
+        return value.replace(second=0, microsecond=0)
+
+    value = value.replace(minute=0, second=0, microsecond=0)
+
+    if grain == 'hour':
+        return value
+
+    value = value.replace(hour=0)
+
+    if grain == 'week':
+        return value - datetime.timedelta(days=value.weekday())
+
+    if grain == 'month':
+        return value.replace(day=1)
+
+    if grain == 'year':
+        return value.replace(month=1, day=1)
+
+    return value
+
+
+class Rollup:  # pylint: disable=too-many-instance-attributes
+    """
+    A pre-aggregated copy of a table: one row per distinct combination of the group_by columns, with the row count and
+    the count, sum, min and max of every measure column. If a time column and grain are set, the time column is
+    truncated to the grain (with date_trunc, so this requires PostgreSQL) and grouped on as well.
+
+    The rollup is stored in a table, or a materialized view, named after the rollup. Grice creates it if it doesn't
+    exist and refreshes it every refresh_interval seconds, so query results read from it can be up to that old.
+    """
+    def __init__(self, name: str, table_name: str, group_by: list, measures: list, time_column: str = None,  # pylint: disable=too-many-arguments
+                 grain: str = None, materialized: bool = False,
+                 refresh_interval: int = DEFAULT_ROLLUP_REFRESH_INTERVAL):
+        if not group_by and not time_column:
+            raise ConfigurationError('Rollup "{}" needs at least one group_by column or a time_column'.format(name))
+
+        if (time_column is None) != (grain is None):
+            raise ConfigurationError('Rollup "{}" needs both a time_column and a grain, or neither'.format(name))
+
+        if grain is not None and grain not in GRAINS:
+            raise ConfigurationError('Invalid grain "{}" for rollup "{}", valid grains: {}'.format(grain, name, GRAINS))
+
+        self.name = name
+        self.table_name = table_name
+        self.group_by = [column_name for column_name in group_by if column_name != time_column]
+        self.measures = measures
+        self.time_column = time_column
+        self.grain = grain
+        self.materialized = materialized
+        self.refresh_interval = refresh_interval
+        self.ready = False
+        self._table = None
+
+    def table(self, base_table: Table):
+        """
+        Returns the Table the rollup is stored in. Column types are taken from the base table, so the Table is rebuilt
+        when the base table is reflected again.
+
+        :param base_table: The Table the rollup aggregates.
+        :return: SQLAlchemy Table
+        """
+        entry = self._table
+
+        if entry is None or entry[0] is not base_table:
+            missing = [name for name in self.group_names() + self.measures if name not in base_table.columns]
+
+            if missing:
+                msg = 'Rollup "{}": table "{}" has no columns {}'
+                raise ConfigurationError(msg.format(self.name, base_table.name, ', '.join(missing)))
+
+            columns = [Column(column_name, base_table.columns[column_name].type) for column_name in self.group_names()]
+            columns.append(Column(ROW_COUNT, BigInteger))
+
+            for column_name in self.measures:
+                column_type = base_table.columns[column_name].type
+                columns.append(Column(_measure_column(column_name, 'count'), BigInteger))
+
+                if isinstance(column_type, (Integer, Numeric)):
+                    columns.append(Column(_measure_column(column_name, 'sum'), column_type))
+
+                columns.append(Column(_measure_column(column_name, 'min'), column_type))
+                columns.append(Column(_measure_column(column_name, 'max'), column_type))
+
+            entry = (base_table, Table(self.name, MetaData(), *columns))
+            self._table = entry
+
+        return entry[1]
+
+    def group_names(self):
+        """
+        :return: The names of the columns the rollup is grouped on, including the time column.
+        """
+        return self.group_by + ([self.time_column] if self.time_column else [])
+
+    def definition(self, base_table: Table):
+        """
+        Returns the select that computes the rollup from the base table, its columns are in the order of the columns
+        of table(base_table).
+        """
+        group_columns = [base_table.columns[column_name] for column_name in self.group_by]
+
+        if self.time_column:
+            time_column = base_table.columns[self.time_column]
+            group_columns.append(func.date_trunc(self.grain, time_column).label(self.time_column))
+
+        columns = list(group_columns)
+        columns.append(func.count().label(ROW_COUNT))
+        rollup_table = self.table(base_table)
+
+        for column_name in self.measures:
+            column = base_table.columns[column_name]
+
+            for func_name in ['count', 'sum', 'min', 'max']:
+                label = _measure_column(column_name, func_name)
+
+                if label in rollup_table.columns:
+                    columns.append(getattr(func, func_name)(column).label(label))
+
+        return select(columns).group_by(*group_columns)
+
+    def _check_columns(self, conn, base_table: Table):
+        """
+        Returns True if an existing rollup has all the columns the current configuration needs.
+        """
+        inspector = reflection.Inspector.from_engine(conn)
+        existing = {column['name'] for column in inspector.get_columns(self.name)}
+        missing = [column.name for column in self.table(base_table).columns if column.name not in existing]
+
+        if missing:
+            log.error('Rollup %s is missing the columns %s, drop it so it can be recreated', self.name,
+                      ', '.join(missing))
+            return False
+
+        return True
+
+    def refresh(self, conn, base_table: Table, create_only: bool = False):
+        """
+        Creates the rollup if it doesn't exist, and recomputes it from the base table. Rollup tables are emptied and
+        filled again in one statement each, so conn should be in a transaction for readers to never see a partial
+        rollup.
+
+        :param conn: SQLAlchemy connection.
+        :param base_table: The Table the rollup aggregates.
+        :param create_only: If True an existing rollup is used as it is.
+        """
+        exists = conn.dialect.has_table(conn, self.name)
+
+        if exists:
+            if not self._check_columns(conn, base_table):
+                self.ready = False
+                return
+
+            if create_only:
+                self.ready = True
+                return
+
+        preparer = conn.dialect.identifier_preparer
+        name = preparer.quote(self.name)
+        definition = self.definition(base_table)
+
+        if self.materialized and exists:
+            conn.execute('REFRESH MATERIALIZED VIEW {}'.format(name))
+        elif self.materialized:
+            compiled = definition.compile(dialect=conn.dialect, compile_kwargs={'literal_binds': True})
+            conn.execute('CREATE MATERIALIZED VIEW {} AS {}'.format(name, compiled))
+        else:
+            rollup_table = self.table(base_table)
+
+            if not exists:
+                rollup_table.create(conn)
+
+            conn.execute(rollup_table.delete())
+            conn.execute(rollup_table.insert().from_select([column.name for column in rollup_table.columns],
+                                                           definition))
+
+        self.ready = True
+        log.info('Refreshed rollup %s of table %s', self.name, self.table_name)
+
+    def source(self, base_table: Table):
+        """
+        Returns the rollup aliased to the name of the base table, so the filters, sorts and group_by of a query on the
+        base table resolve to the rollup's columns, and the results are labeled the same way.
+        """
+        return self.table(base_table).alias(base_table.name)
+
+    def _is_own_column(self, table_name: str, base_table: Table):
+        return table_name is None or table_name == base_table.name
+
+    def _is_group_column(self, table_name: str, column_name: str, base_table: Table):
+        return self._is_own_column(table_name, base_table) and column_name in self.group_by
+
+    def _filter_is_compatible(self, column_filter, base_table: Table):
+        table_name, column_name = column_filter.table_name, column_filter.column_name
+
+        if self._is_group_column(table_name, column_name, base_table):
+            return True
+
+        if not self._is_own_column(table_name, base_table) or column_name != self.time_column:
+            return False
+
+        if column_filter.filter_type not in TIME_FILTERS or getattr(base_table.columns[column_name].type, 'timezone',
+                                                                     False):
+            return False
+
+        _, values = column_filter.get_bind_values([base_table])
+
+        return all(isinstance(value, datetime.date) and truncate(value, self.grain) == value for value in values)
+
+    def _filters_are_compatible(self, filters, base_table: Table):
+        if isinstance(filters, ComplexFilter):
+            return all(self._filters_are_compatible(f, base_table) for f in filters.list_of_filters)
+
+        return self._filter_is_compatible(filters, base_table)
+
+    def _rewrite_column(self, column_func, source, base_table: Table):  # pylint: disable=too-many-return-statements
+        """
+        Returns the expression that computes a selected column from the rollup, or None if it can't be computed.
+        """
+        if isinstance(column_func, str) or column_func.operator_name or \
+                not self._is_own_column(column_func.table_name, base_table):
+            return None
+
+        column_name, func_name = column_func.column_name, column_func.func_name
+        columns = source.columns
+
+        if func_name is None:
+            return columns[column_name] if column_name in self.group_by else None
+
+        if column_name == self.time_column:
+            return None
+
+        if func_name == 'count':
+            # The sum of integers is numeric on PostgreSQL, the cast keeps counts integers like the table's count.
+            if _measure_column(column_name, 'count') in columns:
+                return cast(func.sum(columns[_measure_column(column_name, 'count')]), BigInteger)
+
+            if column_name in self.group_by:
+                return cast(func.sum(case([(columns[column_name].isnot(None), columns[ROW_COUNT])], else_=0)),
+                            BigInteger)
+
+            base_column = base_table.columns.get(column_name, None)
+
+            if base_column is not None and not base_column.nullable:
+                return cast(func.sum(columns[ROW_COUNT]), BigInteger)
+
+            return None
+
+        if func_name in ('min', 'max') and column_name in self.group_by:
+            return getattr(func, func_name)(columns[column_name])
+
+        if func_name in ('min', 'max', 'sum') and _measure_column(column_name, func_name) in columns:
+            return getattr(func, func_name)(columns[_measure_column(column_name, func_name)])
+
+        if func_name == 'avg' and _measure_column(column_name, 'sum') in columns:
+            total = cast(func.sum(columns[_measure_column(column_name, 'sum')]), Float)
+            return total / func.nullif(func.sum(columns[_measure_column(column_name, 'count')]), 0)
+
+        return None
+
+    def can_answer(self, base_table: Table, quargs, check_columns: bool = True):
+        """
+        Checks whether a query on the base table gives the same result when it is computed from the rollup: it must
+        group on a subset of the rollup's group_by columns, select only those columns and aggregates that can be
+        computed from the rollup (count, sum, min, max, and avg), and only filter on the group_by columns, or on whole
+        grains of the time column.
+
+        :param base_table: The main table of the query.
+        :param quargs: QueryArguments
+        :param check_columns: If False the selected columns are not checked, for queries that only count the groups.
+        :return: bool
+        """
+        if not self.ready or base_table.name != self.table_name or quargs.joins or quargs.after is not None:
+            return False
+
+        if not quargs.group_by or any(
+                isinstance(group, str) or group.func_name or group.operator_name or
+                not self._is_group_column(group.table_name, group.column_name, base_table) for group in quargs.group_by):
+            return False
+
+        if check_columns:
+            if not quargs.column_names:
+                return False
+
+            group_names = {group.column_name for group in quargs.group_by}
+            source = self.source(base_table)
+
+            for column_func in quargs.column_names:
+                if self._rewrite_column(column_func, source, base_table) is None:
+                    return False
+
+                if column_func.func_name is None and column_func.column_name not in group_names:
+                    return False
+
+        if quargs.filters is not None and not self._filters_are_compatible(quargs.filters, base_table):
+            return False
+
+        return all(self._is_group_column(sort.table_name, sort.column_name, base_table) for sort in quargs.sorts or [])
+
+    def rewrite_columns(self, source, column_funcs: list, base_columns: list, base_table: Table):
+        """
+        Returns the select columns that compute column_funcs from the rollup. Aggregates are labeled with the anonymous
+        label of the column they replace, so the result rows have the same keys as the rows of the base table query.
+
+        :param source: The rollup, as returned by source(base_table).
+        :param column_funcs: The ColumnFunctions of a query that can_answer accepted.
+        :param base_columns: The columns the query selects from the base table, in the same order.
+        :param base_table: The main table of the query.
+        :return: list of SQLAlchemy columns and labeled expressions.
+        """
+        columns = []
+
+        for column_func, base_column in zip(column_funcs, base_columns):
+            column = self._rewrite_column(column_func, source, base_table)
+
+            if column_func.func_name is not None:
+                column = column.label(base_column.anon_label)
+
+            columns.append(column)
+
+        return columns
+
+
+def find_rollup(rollups: list, base_table: Table, quargs, check_columns: bool = True):
+    """
+    Finds the rollup to answer a query from. If several can, the one with the fewest group_by columns is used, as it
+    has the fewest rows.
+
+    :param rollups: list of Rollup
+    :param base_table: The main table of the query.
+    :param quargs: QueryArguments
+    :param check_columns: See Rollup.can_answer.
+    :return: Rollup, or None
+    """
+    candidates = [rollup for rollup in rollups if rollup.can_answer(base_table, quargs, check_columns)]
+
+    if not candidates:
+        return None
+
+    return min(candidates, key=lambda rollup: len(rollup.group_names()))
+
+
+def rollup_from_config(rollup_config):
+    """
+    Creates a Rollup from a [rollup:<name>] section of the config file.
+
+    :param rollup_config: The config section.
+    :return: Rollup
+    """
+    name = rollup_config.name[len(SECTION_PREFIX):]
+
+    try:
+        table_name = rollup_config['table']
+    except KeyError:
+        raise ConfigurationError('Entry "table" required in section "{}"'.format(rollup_config.name))
+
+    return Rollup(
+        name,
+        table_name,
+        _parse_names(rollup_config.get('group_by', '')),
+        _parse_names(rollup_config.get('measures', '')),
+        time_column=rollup_config.get('time_column', None),
+        grain=rollup_config.get('grain', None),
+        materialized=rollup_config.get('storage', 'table') == 'materialized_view',
+        refresh_interval=rollup_config.getint('refresh_interval', DEFAULT_ROLLUP_REFRESH_INTERVAL),
+    )
+
+
+def init_rollups(rollup_configs):
+    """
+    Creates the Rollups declared in the config file.
+
+    :param rollup_configs: list of [rollup:<name>] config sections, can be None.
+    :return: list of Rollup
+    """
+    rollups = [rollup_from_config(rollup_config) for rollup_config in rollup_configs or []]
+
+    for rollup in rollups:
+        log.info('Rollup %s of table %s grouped by %s', rollup.name, rollup.table_name,
+                 ', '.join(rollup.group_names()))
+
+    return rollups
+
+
+class RollupRefresher(threading.Thread):
+    """
+    Creates missing rollups when it starts, then refreshes each rollup every refresh_interval seconds (rollups with a
+    refresh_interval of 0 are only created, they are refreshed by something else).
+    """
+    def __init__(self, db_service, rollups: list):
+        super().__init__(name='grice-rollup-refresher', daemon=True)
+        self.db_service = db_service
+        self.rollups = rollups
+        self._stopped = threading.Event()
+
+    def _refresh(self, rollup: 'Rollup', create_only: bool):
+        try:
+            self.db_service.refresh_rollup(rollup, create_only)
+        except Exception:  # pylint: disable=broad-except
+            log.exception('Refreshing rollup %s failed', rollup.name)
+
+    def run(self):
+        due = {}
+
+        for rollup in self.rollups:
+            self._refresh(rollup, True)
+
+            if rollup.refresh_interval > 0:
+                due[rollup.name] = time.monotonic() + rollup.refresh_interval
+
+        while due and not self._stopped.wait(max(min(due.values()) - time.monotonic(), 0)):
+            for rollup in self.rollups:
+                if rollup.name in due and due[rollup.name] <= time.monotonic():
+                    self._refresh(rollup, False)
+                    due[rollup.name] = time.monotonic() + rollup.refresh_interval
+
+    def stop(self):
+        self._stopped.set()
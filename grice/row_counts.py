@@ -0,0 +1,93 @@
+import logging
+
+from sqlalchemy import Table, select, func
+from sqlalchemy.sql import Select
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+DEFAULT_EXACT_COUNT_THRESHOLD = 100000
+DEFAULT_COUNT_CACHE_TTL = 60
+ESTIMATE_DIALECTS = ['postgresql']
+
+
+def exact_count(conn, query: Select):
+    """
+    Counts the rows a query returns.
+
+    :param conn: SQLAlchemy connection.
+    :param query: A select without limit, offset or ordering.
+    :return: int
+    """
+    return conn.execute(select([func.count()]).select_from(query.alias('counted'))).scalar()
+
+
+def table_row_estimate(conn, table: Table):
+    """
+    Returns the planner's estimate of the number of rows in a table (pg_class.reltuples), which is kept up to date by
+    ANALYZE and autovacuum and costs nothing to read.
+
+    :param conn: SQLAlchemy connection.
+    :param table: SQLAlchemy Table.
+    :return: int, or None if the estimate is not available (i.e. the table has never been analyzed).
+    """
+    if conn.dialect.name not in ESTIMATE_DIALECTS:
+        return None
+
+    name = conn.dialect.identifier_preparer.format_table(table)
+    estimate = conn.execute('SELECT reltuples FROM pg_class WHERE oid = to_regclass(%(name)s)', {'name': name}).scalar()
+
+    if estimate is None or estimate < 0:
+        return None
+
+    return int(estimate)
+
+
+def table_modifications(conn, table: Table):
+    """
+    Returns the number of rows inserted, updated and deleted in a table according to the statistics collector
+    (pg_stat_user_tables), along with its number of live rows so truncates count too. A change of the result means
+    the table changed, changes are counted when their transaction ends.
+
+    :param conn: SQLAlchemy connection to the primary, replicas keep their own statistics.
+    :param table: SQLAlchemy Table.
+    :return: tuple, or None if the statistics are not available.
+    """
+    if conn.dialect.name not in ESTIMATE_DIALECTS:
+        return None
+
+    name = conn.dialect.identifier_preparer.format_table(table)
+    row = conn.execute('SELECT n_tup_ins, n_tup_upd, n_tup_del, n_live_tup FROM pg_stat_user_tables '
+                       'WHERE relid = to_regclass(%(name)s)', {'name': name}).first()
+
+    return tuple(row) if row is not None else None
+
+
+def explain_estimate(conn, compiled, params: dict = None):
+    """
+    Returns the planner's estimates for a compiled statement, via EXPLAIN. The statement is planned but not executed.
+
+    :param conn: SQLAlchemy connection, the dialect must be one of ESTIMATE_DIALECTS.
+    :param compiled: A statement compiled for the connection's dialect.
+    :param params: The parameters the statement is executed with, on top of the values bound when it was compiled.
+    :return: cost, rows. cost is the planner's total cost, in its own arbitrary units.
+    """
+    plan = conn.execute('EXPLAIN (FORMAT JSON) ' + str(compiled), compiled.construct_params(params)).scalar()
+
+    return float(plan[0]['Plan']['Total Cost']), int(plan[0]['Plan']['Plan Rows'])
+
+
+def explain_row_estimate(conn, query: Select):
+    """
+    Returns the planner's estimate of the number of rows a query returns, via EXPLAIN. The query is planned but not
+    executed.
+
+    :param conn: SQLAlchemy connection.
+    :param query: A select.
+    :return: int, or None if the dialect does not support estimates.
+    """
+    if conn.dialect.name not in ESTIMATE_DIALECTS:
+        return None
+
+    _, rows = explain_estimate(conn, query.compile(dialect=conn.dialect))
+
+    return rows
@@ -0,0 +1,194 @@
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+import threading
+
+import sqlalchemy
+from sqlalchemy import MetaData, text
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+DEFAULT_REFRESH_INTERVAL = 60
+
+# Seconds between a table being reflected and the schema snapshot being saved, when there is no SchemaRefresher.
+SNAPSHOT_SAVE_DELAY = 1
+
+INFORMATION_SCHEMA_COLUMNS = text("""
+SELECT c.table_name, c.column_name, c.data_type, c.is_nullable, c.column_default, c.ordinal_position,
+       c.character_maximum_length, c.numeric_precision, c.numeric_scale
+FROM information_schema.columns c
+JOIN information_schema.tables t ON t.table_schema = c.table_schema AND t.table_name = c.table_name
+WHERE t.table_type = 'BASE TABLE' AND c.table_schema = :schema
+ORDER BY c.table_name, c.ordinal_position
+""")
+
+# The columns of primary keys, unique constraints and foreign keys, with the columns foreign keys refer to.
+INFORMATION_SCHEMA_CONSTRAINTS = text("""
+SELECT tc.table_name, tc.constraint_type, tc.constraint_name, kcu.column_name, kcu.ordinal_position,
+       ref.table_name, ref.column_name
+FROM information_schema.table_constraints tc
+JOIN information_schema.key_column_usage kcu
+  ON kcu.constraint_schema = tc.constraint_schema AND kcu.constraint_name = tc.constraint_name
+  AND kcu.table_name = tc.table_name
+LEFT JOIN information_schema.referential_constraints rc
+  ON rc.constraint_schema = tc.constraint_schema AND rc.constraint_name = tc.constraint_name
+LEFT JOIN information_schema.key_column_usage ref
+  ON ref.constraint_schema = rc.unique_constraint_schema AND ref.constraint_name = rc.unique_constraint_name
+  AND ref.ordinal_position = kcu.position_in_unique_constraint
+WHERE tc.table_schema = :schema AND tc.constraint_type IN ('PRIMARY KEY', 'UNIQUE', 'FOREIGN KEY')
+ORDER BY tc.table_name, tc.constraint_type, tc.constraint_name, kcu.ordinal_position, ref.table_name, ref.column_name
+""")
+
+SNAPSHOT_VERSION = 1
+
+SQLITE_TABLES = text("SELECT name, sql FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name")
+
+
+def table_fingerprints(conn):
+    """
+    Returns a fingerprint of the definition of every table in the default schema, using two catalog queries. A
+    table's fingerprint changes when its columns are added, dropped, renamed, change type, length, precision or scale,
+    or when its primary key, unique constraints or foreign keys change.
+
+    :param conn: SQLAlchemy connection.
+    :return: dict of table_name -> fingerprint string.
+    """
+    definitions = {}
+
+    if conn.dialect.name == 'sqlite':
+        # The CREATE TABLE statement includes the columns and the constraints.
+        results = [conn.execute(SQLITE_TABLES)]
+    else:
+        schema = conn.dialect.default_schema_name
+        results = [conn.execute(INFORMATION_SCHEMA_COLUMNS, schema=schema),
+                   conn.execute(INFORMATION_SCHEMA_CONSTRAINTS, schema=schema)]
+
+    for rows in results:
+        for row in rows:
+            definitions.setdefault(row[0], []).append(repr(tuple(row[1:])))
+
+    return {name: hashlib.sha1('\n'.join(definition).encode('utf-8')).hexdigest()
+            for name, definition in definitions.items()}
+
+
+def remove_tables(meta: MetaData, table_names):
+    """
+    Removes tables from a MetaData so they are reflected again on their next use. Tables with foreign keys to a removed
+    table are removed too, otherwise their foreign keys would keep pointing at the old Table object.
+
+    :param meta: SQLAlchemy MetaData.
+    :param table_names: The names of the tables to remove.
+    :return: set of the names of all removed tables.
+    """
+    pending = [name for name in table_names if name in meta.tables]
+    removed = set()
+
+    while pending:
+        name = pending.pop()
+
+        if name in removed:
+            continue
+
+        removed.add(name)
+        pending.extend(key for key, table in meta.tables.items()
+                       if any(fk.target_fullname.rsplit('.', 1)[0] == name for fk in table.foreign_keys))
+
+    for name in removed:
+        meta.remove(meta.tables[name])
+
+    return removed
+
+
+def save_snapshot(path: str, meta: MetaData, fingerprints: dict, database: str):
+    """
+    Writes reflected MetaData and the table fingerprints it was reflected from to a local file. The file is replaced
+    atomically so a crash while saving never leaves a truncated snapshot behind.
+
+    :param path: The snapshot file path.
+    :param meta: The reflected MetaData.
+    :param fingerprints: The table fingerprints from table_fingerprints.
+    :param database: A string identifying the database, so a snapshot is never loaded for a different database.
+    """
+    snapshot = {
+        'version': SNAPSHOT_VERSION,
+        'sqlalchemy': sqlalchemy.__version__,
+        'database': database,
+        'fingerprints': fingerprints,
+        'meta': meta,
+    }
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.grice-schema-')
+
+    try:
+        with os.fdopen(fd, 'wb') as snapshot_file:
+            pickle.dump(snapshot, snapshot_file, pickle.HIGHEST_PROTOCOL)
+
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def load_snapshot(path: str, fingerprints: dict, database: str):
+    """
+    Loads a snapshot written by save_snapshot and validates it against the current table fingerprints. Tables whose
+    definition changed since the snapshot was taken are dropped from the returned MetaData, so they get reflected
+    again.
+
+    The snapshot is unpickled, so it must only ever be written by Grice itself.
+
+    :param path: The snapshot file path.
+    :param fingerprints: The current table fingerprints from table_fingerprints.
+    :param database: A string identifying the database, must match the one the snapshot was saved with.
+    :return: MetaData, or None if there is no usable snapshot.
+    """
+    try:
+        with open(path, 'rb') as snapshot_file:
+            snapshot = pickle.load(snapshot_file)
+    except FileNotFoundError:
+        return None
+    except Exception:  # pylint: disable=broad-except
+        log.warning('Ignoring unreadable schema snapshot %s', path, exc_info=True)
+        return None
+
+    if not isinstance(snapshot, dict) or snapshot.get('version') != SNAPSHOT_VERSION or \
+            snapshot.get('sqlalchemy') != sqlalchemy.__version__ or snapshot.get('database') != database:
+        log.info('Ignoring schema snapshot %s, it was saved by a different version or for a different database', path)
+        return None
+
+    meta = snapshot['meta']
+    previous = snapshot['fingerprints']
+    stale = remove_tables(meta, [name for name in meta.tables
+                                 if name not in fingerprints or previous.get(name) != fingerprints[name]])
+
+    log.info('Loaded %s tables from schema snapshot %s, %s were stale', len(meta.tables), path, len(stale))
+
+    return meta
+
+
+class SchemaRefresher(threading.Thread):
+    """
+    Periodically calls DBService.refresh_schema so schema changes are picked up without a restart, and saves the schema
+    snapshot if one is configured.
+    """
+    def __init__(self, db_service, interval: int = DEFAULT_REFRESH_INTERVAL):
+        super().__init__(name='grice-schema-refresher', daemon=True)
+        self.db_service = db_service
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                changed = self.db_service.refresh_schema()
+                self.db_service.save_schema_snapshot()
+            except Exception:  # pylint: disable=broad-except
+                log.exception('Schema refresh failed')
+            else:
+                if changed:
+                    log.info('Schema changed for tables: %s', ', '.join(sorted(changed)))
+
+    def stop(self):
+        self._stopped.set()
@@ -0,0 +1,127 @@
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+slow_log = logging.getLogger('grice.slow_query')  # pylint: disable=invalid-name
+
+# Milliseconds, 0 disables the slow query log.
+DEFAULT_SLOW_QUERY_THRESHOLD = 0
+
+_local = threading.local()  # pylint: disable=invalid-name
+
+
+class RequestTimer:
+    """
+    Collects how long each stage of a request took, along with details about the query it ran (info) for the slow query
+    log. A stage that runs more than once (i.e. several queries in one request) accumulates its time.
+    """
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = OrderedDict()
+        self.info = {}
+
+    def add(self, name: str, seconds: float):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def stage_ms(self):
+        """
+        :return: OrderedDict of stage name -> milliseconds, in the order the stages first ran.
+        """
+        return OrderedDict((name, round(seconds * 1000, 3)) for name, seconds in self.stages.items())
+
+    def server_timing(self):
+        """
+        :return: The stages and the total time so far as a Server-Timing header value.
+        """
+        metrics = ['{};dur={}'.format(name, ms) for name, ms in self.stage_ms().items()]
+        metrics.append('total;dur={}'.format(round(self.elapsed() * 1000, 3)))
+
+        return ', '.join(metrics)
+
+
+def start():
+    """
+    Starts timing a request on the current thread.
+
+    :return: RequestTimer
+    """
+    timer = RequestTimer()
+    _local.timer = timer
+
+    return timer
+
+
+def stop():
+    """
+    Stops timing the request on the current thread. Stages that run later, i.e. while a streamed response is sent, are
+    not recorded.
+
+    :return: The RequestTimer, or None if no request was being timed.
+    """
+    timer = current()
+    _local.timer = None
+
+    return timer
+
+
+def current():
+    return getattr(_local, 'timer', None)
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Times the body of a with statement as a stage of the current request. Does nothing outside of a timed request.
+    """
+    timer = current()
+
+    if timer is None:
+        yield
+        return
+
+    started = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        timer.add(name, time.perf_counter() - started)
+
+
+def annotate(**info):
+    """
+    Adds details about the current request (i.e. the SQL it ran) to the slow query log entry.
+    """
+    timer = current()
+
+    if timer is not None:
+        timer.info.update(info)
+
+
+def log_slow_request(timer: RequestTimer, threshold: int, **fields):
+    """
+    Writes a JSON entry to the grice.slow_query log if a request took at least threshold milliseconds.
+
+    :param timer: The RequestTimer of the request.
+    :param threshold: Milliseconds, 0 disables the log.
+    :param fields: Details about the request to log, i.e. the route and the response size.
+    :return: True if the request was logged.
+    """
+    total_ms = round(timer.elapsed() * 1000, 3)
+
+    if threshold <= 0 or total_ms < threshold:
+        return False
+
+    entry = OrderedDict(fields)
+    entry.update(timer.info)
+    entry['total_ms'] = total_ms
+    entry['stages_ms'] = timer.stage_ms()
+    slow_log.warning(json.dumps(entry, default=str))
+
+    return True
@@ -0,0 +1,192 @@
+"""
+Large IN and NOT IN lists.
+
+column.in_ binds every value of a list to its own parameter, so a filter with thousands of values makes an enormous
+statement that is slow to compile, can't share a cached statement with lists of another length, and can exceed the
+parameter limit of the driver. Lists with at least value_list_threshold values are filtered differently:
+
+- on PostgreSQL the list is bound as a single array parameter: column = ANY(:values), or column <> ALL(:values).
+- on other databases the values are loaded into a temporary table before the query runs, and the query filters with
+  column IN (SELECT value FROM grice_values_N). The temporary table is dropped when the query is done.
+"""
+import logging
+from contextlib import contextmanager
+from itertools import count
+from typing import List
+
+from sqlalchemy import MetaData, Table, Column, select, not_, bindparam, any_, all_
+from sqlalchemy.dialects import postgresql
+
+from grice import timing
+from grice.complex_filter import ColumnFilter, ComplexFilter, convert_url_value, get_column
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+DEFAULT_VALUE_LIST_THRESHOLD = 500
+ARRAY_DIALECTS = ['postgresql']
+VALUE_LIST_FILTERS = ['in', 'not_in']
+TABLE_PREFIX = 'grice_values_'
+INSERT_BATCH_SIZE = 5000
+
+
+class ValueListFilter(ColumnFilter):  # pylint: disable=too-few-public-methods
+    def __init__(self, column_filter: ColumnFilter, values: list, table_name: str = None):
+        """
+        An in or not_in filter with a long list of values, see the module docstring.
+
+        :param column_filter: The ColumnFilter this filter replaces, its column must be set.
+        :param values: The values, converted to the column type.
+        :param table_name: The name of the temporary table to load the values into, or None to bind the values as an
+        array.
+        """
+        super().__init__(column_filter.qualified_name, column_filter.filter_type, value=values,
+                         column=column_filter.column)
+        self.values_table = None
+
+        if table_name is not None:
+            self.values_table = Table(table_name, MetaData(), Column('value', column_filter.column.type),
+                                      prefixes=['TEMPORARY'])
+
+    def _get_expression(self, column: Column, names=None):
+        self.column = column
+
+        if self.values_table is None:
+            values = bindparam(next(names) if names is not None else None, self.value,
+                               type_=postgresql.ARRAY(column.type))
+
+            return column == any_(values) if self.filter_type == 'in' else column != all_(values)
+
+        expression = column.in_(select([self.values_table.c.value]))
+
+        return expression if self.filter_type == 'in' else not_(expression)
+
+    def get_bind_values(self, tables: List[Table]):
+        """
+        Returns the values this filter binds to the statement: the whole list as one array, or nothing if the values are
+        read from a temporary table.
+        """
+        if get_column(self.qualified_name, tables) is None:
+            return (self.table_name, self.column_name, self.filter_type, None), []
+
+        if self.values_table is None:
+            return (self.table_name, self.column_name, self.filter_type, 'array'), [self.value]
+
+        return (self.table_name, self.column_name, self.filter_type, self.values_table.name), []
+
+
+def _list_values(column_filter: ColumnFilter):
+    """
+    Returns the values of a list filter converted to the column type, or None if they can't be converted. Values from a
+    JSON body aren't converted when the filter is parsed, but an array parameter needs values of the array's type.
+    """
+    values = []
+
+    for value in column_filter.value:
+        if isinstance(value, str):
+            try:
+                value = convert_url_value(value, column_filter.column)
+            except (ValueError, TypeError):
+                return None
+
+        values.append(value)
+
+    return values
+
+
+def _replace_lists(filters, use_arrays: bool, threshold: int, table_names):
+    if isinstance(filters, ComplexFilter):
+        children = [_replace_lists(f, use_arrays, threshold, table_names) for f in filters.list_of_filters]
+        return ComplexFilter(children, filters.is_and)
+
+    if (not isinstance(filters, ColumnFilter) or isinstance(filters, ValueListFilter) or
+            filters.filter_type not in VALUE_LIST_FILTERS or filters.column is None or
+            not isinstance(filters.value, (list, tuple)) or len(filters.value) < threshold):
+        return filters
+
+    values = _list_values(filters)
+
+    if values is None:
+        return filters
+
+    return ValueListFilter(filters, values, None if use_arrays else next(table_names))
+
+
+def use_value_lists(filters, dialect_name: str, threshold: int = DEFAULT_VALUE_LIST_THRESHOLD):
+    """
+    Replaces the in and not_in filters with at least threshold values by ValueListFilters.
+
+    :param filters: A filter tree normalized by filter_normalization.normalize_filters, so every filter has its column.
+    :param dialect_name: The name of the database dialect.
+    :param threshold: The number of values from which a list is replaced, 0 disables value lists.
+    :return: The filter tree.
+    """
+    if not threshold:
+        return filters
+
+    table_names = (TABLE_PREFIX + str(idx) for idx in count())
+
+    return _replace_lists(filters, dialect_name in ARRAY_DIALECTS, threshold, table_names)
+
+
+def value_tables(filters):
+    """
+    Returns the ValueListFilters of a filter tree that read their values from a temporary table.
+    """
+    if isinstance(filters, ComplexFilter):
+        return [f for child in filters.list_of_filters for f in value_tables(child)]
+
+    if isinstance(filters, ValueListFilter) and filters.values_table is not None:
+        return [filters]
+
+    return []
+
+
+def _insert_values(conn, table: Table, values: list):
+    """
+    Inserts values into a temporary table. The rows are sent with the DBAPI cursor's executemany, because building
+    SQLAlchemy parameters for every row takes longer than the insert itself.
+    """
+    insert = table.insert().compile(dialect=conn.dialect)
+    processor = table.c.value.type.bind_processor(conn.dialect)
+
+    if processor is not None:
+        values = [processor(value) for value in values]
+
+    rows = [(value,) for value in values] if insert.positional else [{'value': value} for value in values]
+    cursor = conn.connection.cursor()
+
+    try:
+        for start in range(0, len(rows), INSERT_BATCH_SIZE):
+            cursor.executemany(str(insert), rows[start:start + INSERT_BATCH_SIZE])
+    finally:
+        cursor.close()
+
+
+@contextmanager
+def loaded(conn, value_filters: list):
+    """
+    Creates and fills the temporary tables of ValueListFilters on a connection, and drops them on exit. The time spent
+    filling the tables is recorded as the "load" stage.
+
+    :param conn: SQLAlchemy connection the query runs on, temporary tables are only visible on that connection.
+    :param value_filters: list of ValueListFilter, see value_tables.
+    """
+    created = []
+
+    try:
+        for value_filter in value_filters:
+            table = value_filter.values_table
+
+            with timing.stage('load'):
+                table.create(conn)
+                created.append(table)
+                _insert_values(conn, table, value_filter.value)
+
+        yield
+    finally:
+        for table in created:
+            try:
+                table.drop(conn)
+            except Exception:  # pylint: disable=broad-except
+                # The connection is probably broken, which drops its temporary tables anyway.
+                log.warning('Could not drop temporary table %s', table.name, exc_info=True)
@@ -0,0 +1,128 @@
+import fnmatch
+
+from grice.cache import MemoryCache, QueryCache, RedisCache, query_cache_key
+from grice.complex_filter import ColumnFilter, ComplexFilter
+from grice.db_service import QueryArguments
+
+ROWS = ([{'tests.id': 1, 'tests.result': 'pass'}], [{'name': 'id'}, {'name': 'result'}], None)
+
+
+class LocalRedis:
+    """
+    An in-memory stand-in for a redis-py client, with the methods RedisCache uses. Values are stored as bytes, the way
+    Redis returns them, and expire like keys set with ex.
+    """
+    def __init__(self):
+        self.entries = {}
+        self.now = 0
+
+    def get(self, key: str):
+        entry = self.entries.get(key, None)
+
+        if entry is None or entry[0] <= self.now:
+            self.entries.pop(key, None)
+            return None
+
+        return entry[1]
+
+    def set(self, key: str, value: bytes, ex: int = None):
+        assert isinstance(value, bytes)
+        self.entries[key] = (self.now + ex if ex is not None else float('inf'), value)
+
+    def scan_iter(self, match: str = '*'):
+        return [key for key in list(self.entries) if fnmatch.fnmatchcase(key, match)]
+
+    def delete(self, key: str):
+        self.entries.pop(key, None)
+
+
+def _quargs(page=0, filters=None):
+    return QueryArguments(['id', 'result'], page, 50, filters, None, None, None, False, None)
+
+
+def test_redis_cache_round_trip_and_ttl():
+    client = LocalRedis()
+    cache = QueryCache(RedisCache(client), ttl=30)
+    cache.set('tests', _quargs(), ROWS)
+
+    assert cache.get('tests', _quargs()) == ROWS
+    assert cache.get('tests', _quargs()) is not ROWS
+
+    client.now = 31
+
+    assert cache.get('tests', _quargs()) is None
+
+
+def test_redis_cache_clear_only_removes_its_prefix():
+    client = LocalRedis()
+    client.set('other:key', b'kept')
+    cache = QueryCache(RedisCache(client, 'grice:'))
+    cache.set('tests', _quargs(), ROWS)
+    cache.clear()
+
+    assert cache.get('tests', _quargs()) is None
+    assert client.get('other:key') == b'kept'
+
+
+def test_hit_and_miss_counters():
+    cache = QueryCache(MemoryCache())
+
+    assert cache.get('tests', _quargs()) is None
+
+    cache.set('tests', _quargs(), ROWS)
+
+    assert cache.get('tests', _quargs()) == ROWS
+    assert cache.get('tests', _quargs(page=1)) is None
+    assert cache.stats() == {'hits': 1, 'misses': 2, 'hit_ratio': 1 / 3}
+
+
+def test_table_ttl_zero_disables_caching():
+    client = LocalRedis()
+    cache = QueryCache(RedisCache(client), ttl=30, table_ttls={'events': 0})
+    cache.set('events', _quargs(), ROWS)
+    cache.set('tests', _quargs(), ROWS)
+
+    assert cache.get('events', _quargs()) is None
+    assert cache.get('tests', _quargs()) == ROWS
+    assert len(client.entries) == 1
+    # Lookups on tables that are never cached are not misses.
+    assert cache.stats()['misses'] == 0
+
+
+def test_results_above_max_rows_are_not_cached():
+    cache = QueryCache(MemoryCache(), max_rows=1)
+    two_rows = (ROWS[0] * 2,) + ROWS[1:]
+    cache.set('tests', _quargs(), two_rows)
+    cache.set('tests', _quargs(page=1), ROWS)
+
+    assert cache.get('tests', _quargs()) is None
+    assert cache.get('tests', _quargs(page=1)) == ROWS
+
+
+def test_memory_cache_evicts_least_recently_used():
+    cache = MemoryCache(max_entries=2)
+    cache.set('a', 1, 30)
+    cache.set('b', 2, 30)
+    cache.get('a')
+    cache.set('c', 3, 30)
+
+    assert cache.get('a') == 1
+    assert cache.get('b') is None
+    assert cache.get('c') == 3
+
+
+def test_memory_cache_expires_entries():
+    cache = MemoryCache()
+    cache.set('a', 1, -1)
+
+    assert cache.get('a') is None
+
+
+def test_key_depends_on_schema_version():
+    quargs = _quargs(filters=ComplexFilter([ColumnFilter('tests.result', 'eq', value='pass')]))
+    cache = QueryCache(MemoryCache())
+    cache.set('tests', quargs, ROWS, schema_version=1)
+
+    assert query_cache_key('tests', quargs, 1) != query_cache_key('tests', quargs, 2)
+    assert cache.get('tests', quargs, schema_version=1) == ROWS
+    assert cache.get('tests', quargs, schema_version=2) is None
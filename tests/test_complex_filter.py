@@ -0,0 +1,27 @@
+from itertools import count
+
+from sqlalchemy import Column, Integer, MetaData, String, Table
+
+from grice.complex_filter import ColumnFilter
+
+TESTS = Table('tests', MetaData(), Column('id', Integer, primary_key=True), Column('result', String(10)))
+
+
+def _compile(column_filter):
+    names = ('p{}'.format(idx) for idx in count())
+    return str(column_filter.get_expression([TESTS], names))
+
+
+def test_null_filters_compile_to_is_null():
+    assert _compile(ColumnFilter('tests.result', 'eq', value=None)) == 'tests.result IS NULL'
+    assert _compile(ColumnFilter('tests.result', 'neq', value=None)) == 'tests.result IS NOT NULL'
+    assert _compile(ColumnFilter('tests.result', 'eq', value='pass')) == 'tests.result = :p0'
+
+
+def test_null_filters_have_their_own_shape():
+    null_shape, null_values = ColumnFilter('tests.result', 'eq', value=None).get_bind_values([TESTS])
+    value_shape, value_values = ColumnFilter('tests.result', 'eq', value='pass').get_bind_values([TESTS])
+
+    assert null_shape != value_shape
+    assert null_values == []
+    assert value_values == ['pass']
@@ -0,0 +1,66 @@
+import configparser
+
+from sqlalchemy import Column, Integer, MetaData, String, Table, create_engine
+
+from grice.complex_filter import ColumnFilter, ComplexFilter
+from grice.db_service import DBService, QueryArguments
+from grice.filter_normalization import normalize_filters
+
+RESULTS = [None, 'pass', 'fail', 'pass', None, 'skip']
+
+
+def _service(tmp_path):
+    url = 'sqlite:///' + str(tmp_path / 'filters.db')
+    meta = MetaData()
+    tests = Table('tests', meta, Column('id', Integer, primary_key=True), Column('result', String(10)),
+                  Column('score', Integer))
+    db_engine = create_engine(url)
+    meta.create_all(db_engine)
+    db_engine.execute(tests.insert(), [{'id': i, 'result': RESULTS[i % len(RESULTS)], 'score': i % 7 or None}
+                                       for i in range(60)])
+
+    config = configparser.ConfigParser()
+    config.read_dict({'database': {'url': url}})
+
+    return DBService(config['database']), db_engine
+
+
+def _count(service, filters):
+    quargs = QueryArguments(['id'], 0, -1, filters, None, None, None, False, None)
+    rows, _, _ = service.query_table('tests', quargs)
+
+    return len(rows)
+
+
+def _sql_count(db_engine, where):
+    return db_engine.execute('SELECT count(*) FROM tests WHERE ' + where).scalar()
+
+
+def test_or_keeps_is_null_out_of_in_list(tmp_path):
+    service, db_engine = _service(tmp_path)
+    filters = ComplexFilter([ColumnFilter('tests.result', 'eq', value=None),
+                             ColumnFilter('tests.result', 'eq', value='pass'),
+                             ColumnFilter('tests.result', 'eq', value='fail')], False)
+
+    assert _count(service, filters) == _sql_count(db_engine, "result IS NULL OR result IN ('pass', 'fail')")
+
+
+def test_or_with_ranges_keeps_is_null(tmp_path):
+    service, db_engine = _service(tmp_path)
+    filters = ComplexFilter([ColumnFilter('tests.score', 'eq', value=None),
+                             ColumnFilter('tests.score', 'gt', value=4),
+                             ColumnFilter('tests.score', 'eq', value=5),
+                             ColumnFilter('tests.score', 'eq', value=1)], False)
+
+    assert _count(service, filters) == _sql_count(db_engine, 'score IS NULL OR score > 4 OR score = 1')
+
+
+def test_and_with_null_in_not_in_is_not_folded(tmp_path):
+    service, db_engine = _service(tmp_path)
+    tables = [service._get_table('tests')]  # pylint: disable=protected-access
+    filters = ComplexFilter([ColumnFilter('tests.score', 'not_in', value=[None, 3]),
+                             ColumnFilter('tests.score', 'gt', value=1)], True)
+    normalized = normalize_filters(filters, tables)
+
+    assert len(normalized.list_of_filters) == 2
+    assert _count(service, filters) == _sql_count(db_engine, 'score NOT IN (NULL, 3) AND score > 1')
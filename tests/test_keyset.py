@@ -0,0 +1,61 @@
+import configparser
+
+from sqlalchemy import Column, Integer, MetaData, String, Table, create_engine
+
+from grice.db_service import ColumnSort, DBService, QueryArguments
+
+ROWS = 25
+PER_PAGE = 4
+
+
+def _service(tmp_path):
+    url = 'sqlite:///' + str(tmp_path / 'keyset.db')
+    meta = MetaData()
+    tests = Table('tests', meta, Column('id', Integer, primary_key=True), Column('result', String(10), nullable=True))
+    db_engine = create_engine(url)
+    meta.create_all(db_engine)
+    # Every third row has a NULL result, and the other results repeat so pages split rows with equal sort values.
+    db_engine.execute(tests.insert(), [{'id': i, 'result': None if i % 3 == 0 else 'r{}'.format(i % 4)}
+                                       for i in range(ROWS)])
+
+    config = configparser.ConfigParser()
+    config.read_dict({'database': {'url': url}})
+
+    return DBService(config['database'])
+
+
+def _page_through(service, quargs):
+    ids = []
+
+    while True:
+        rows, _, next_after = service.query_table('tests', quargs)
+        ids.extend(row['tests.id'] for row in rows)
+
+        if next_after is not None:
+            quargs = quargs._replace(after=next_after)
+        elif len(rows) == quargs.per_page:
+            quargs = quargs._replace(page=quargs.page + 1)
+        else:
+            return ids
+
+
+def test_nullable_sort_column_pages_every_row(tmp_path):
+    service = _service(tmp_path)
+
+    for direction in ('asc', 'desc'):
+        sorts = [ColumnSort('tests', 'result', direction)]
+        quargs = QueryArguments(['id', 'result'], 0, PER_PAGE, None, sorts, None, None, False, None)
+        ids = _page_through(service, quargs)
+
+        assert len(ids) == ROWS
+        assert sorted(ids) == list(range(ROWS))
+
+
+def test_not_null_sort_column_pages_with_tokens(tmp_path):
+    service = _service(tmp_path)
+    sorts = [ColumnSort('tests', 'id', 'desc')]
+    quargs = QueryArguments(['id', 'result'], 0, PER_PAGE, None, sorts, None, None, False, None)
+    _, _, next_after = service.query_table('tests', quargs)
+
+    assert next_after is not None
+    assert _page_through(service, quargs) == list(reversed(range(ROWS)))